@@ -0,0 +1,546 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local agent which owns the service registrations and heartbeats for all
+the processes on a host.
+
+Processes talk to the agent over a Unix domain socket. Every request and
+response is a single JSON object on its own line:
+
+    {"op": "register", "id": "web-1", "heartbeat_timeout": 30,
+     "payload": {"tags": ["web"]}}
+    {"op": "deregister", "id": "web-1"}
+    {"op": "list"}
+
+Responses always have an "ok" key and carry an "error" message when it is
+false. Registrations outlive the connection which created them, so they
+survive worker restarts until they are explicitly deregistered.
+
+By default the socket is /tmp/service-registry-<uid>/agent.sock, in a
+directory which only the user running the agent can access.
+"""
+
+__all__ = [
+    'HeartbeatAgent',
+    'AgentClient',
+    'get_socket_path'
+]
+
+import os
+import sys
+import stat
+import errno
+import socket
+import signal
+import logging
+import threading
+import SocketServer
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from optparse import OptionParser
+
+from constants import DEFAULT_API_URL
+from constants import AGENT_SOCKET_DIR, AGENT_SOCKET_NAME
+from constants import AGENT_TIMEOUT, AGENT_REGISTER_WAIT
+from errors import AgentError, ValidationError
+
+SERVICE_EXISTS_ERROR = 'serviceWithThisIdExists'
+
+logger = logging.getLogger(__name__)
+
+
+def get_socket_path():
+    """
+    Return the default path of the agent socket for the current user.
+    """
+    return os.path.join(AGENT_SOCKET_DIR % {'uid': os.getuid()},
+                        AGENT_SOCKET_NAME)
+
+
+def _check_socket_dir(directory, create=False):
+    """
+    Make sure the directory of the default socket belongs to the current
+    user and nobody else can access it, creating it if C{create} is set.
+
+    @raise AgentError: Another user owns it or it is open to others.
+    """
+    if create:
+        try:
+            os.mkdir(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    try:
+        st = os.lstat(directory)
+    except OSError as e:
+        # No agent has ever run, connecting fails as usual.
+        if e.errno != errno.ENOENT:
+            raise
+
+        return
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 077:
+        raise AgentError('%s is not a private directory of the current '
+                         'user' % (directory))
+
+
+class Registration(object):
+    def __init__(self, client, service_id, heartbeat_timeout, payload=None,
+                 retry_delay=2):
+        """
+        Creates a service and keeps heartbeating it in a background thread,
+        creating it again whenever heartbeating fails, until stop() is
+        called.
+        """
+        self.client = client
+        self.service_id = service_id
+        self.heartbeat_timeout = heartbeat_timeout
+        self.payload = payload
+        self.retry_delay = retry_delay
+        self.heartbeater = None
+        self.error = None
+        self.attempted = threading.Event()
+        self._stopped = threading.Event()
+        self._remove = True
+        self._thread = None
+
+    @property
+    def registered(self):
+        return self.heartbeater is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, remove=True):
+        self._remove = remove
+        self._stopped.set()
+        heartbeater = self.heartbeater
+
+        if heartbeater:
+            heartbeater.stop()
+
+            if remove:
+                self._remove_service()
+
+    def _remove_service(self):
+        try:
+            self.client.services.remove(self.service_id)
+        except Exception:
+            logger.exception('Failed to remove service %s' %
+                             (self.service_id))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                _, heartbeater = self.client.services.create(
+                    self.service_id, self.heartbeat_timeout,
+                    payload=self.payload)
+            except ValidationError as e:
+                self.error = e
+
+                if e.type != SERVICE_EXISTS_ERROR:
+                    # Retrying won't fix an invalid registration.
+                    self._stopped.set()
+                    self.attempted.set()
+                    return
+            except Exception as e:
+                self.error = e
+                logger.exception('Failed to create service %s' %
+                                 (self.service_id))
+            else:
+                self.error = None
+                self.heartbeater = heartbeater
+                self.attempted.set()
+
+                if self._stopped.is_set():
+                    # Stopped while the service was being created.
+                    self.heartbeater = None
+
+                    if self._remove:
+                        self._remove_service()
+
+                    return
+
+                try:
+                    heartbeater.start()
+                except Exception as e:
+                    self.error = e
+                    logger.exception('Failed to heartbeat service %s' %
+                                     (self.service_id))
+
+                self.heartbeater = None
+
+            self.attempted.set()
+            self._stopped.wait(self.retry_delay)
+
+    def to_dict(self):
+        return {'id': self.service_id,
+                'heartbeat_timeout': self.heartbeat_timeout,
+                'registered': self.registered,
+                'error': str(self.error) if self.error else None}
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                break
+
+            try:
+                command = json.loads(line)
+                response = self.server.agent.handle_command(command)
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class HeartbeatAgent(object):
+    def __init__(self, client, socket_path=None, mode=0600,
+                 retry_delay=2, register_wait=AGENT_REGISTER_WAIT):
+        """
+        @param client: Client used to create, heartbeat and remove the
+        services.
+        @type client: L{Client}
+        @param socket_path: Path of the Unix domain socket to listen on,
+        defaults to L{get_socket_path}().
+        @type socket_path: C{str}
+        @param mode: Permissions of the socket file.
+        @type mode: C{int}
+        @param retry_delay: Seconds to wait before creating a service again
+        after a failure.
+        @type retry_delay: C{float}
+        @param register_wait: Maximum number of seconds a register request
+        waits for the service to be created before it is answered.
+        @type register_wait: C{float}
+        """
+        self.client = client
+        self.socket_path = socket_path or get_socket_path()
+        self.mode = mode
+        self._default_path = socket_path is None
+        self.retry_delay = retry_delay
+        self.register_wait = register_wait
+        self.registrations = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def register(self, service_id, heartbeat_timeout, payload=None):
+        """
+        Register a service unless it already is. Returns the
+        L{Registration}.
+        """
+        update_payload = False
+
+        self._lock.acquire()
+        try:
+            registration = self.registrations.get(service_id, None)
+
+            if registration:
+                if registration.heartbeat_timeout != heartbeat_timeout:
+                    raise AgentError('Service %s is already registered with '
+                                     'heartbeat_timeout %s' %
+                                     (service_id,
+                                      registration.heartbeat_timeout))
+
+                if registration.payload == payload:
+                    return registration
+
+                if not registration.registered:
+                    # Still being created, with the new payload.
+                    registration.payload = payload
+                    return registration
+
+                update_payload = True
+            else:
+                registration = Registration(self.client, service_id,
+                                            heartbeat_timeout,
+                                            payload=payload,
+                                            retry_delay=self.retry_delay)
+                self.registrations[service_id] = registration
+                registration.start()
+        finally:
+            self._lock.release()
+
+        if update_payload:
+            # Not holding the lock, which every other client waits for.
+            self.client.services.update(service_id, payload or {})
+
+            self._lock.acquire()
+            try:
+                registration.payload = payload
+            finally:
+                self._lock.release()
+
+            return registration
+
+        registration.attempted.wait(self.register_wait)
+
+        if isinstance(registration.error, ValidationError) and \
+           registration.error.type != SERVICE_EXISTS_ERROR:
+            self._lock.acquire()
+            try:
+                if self.registrations.get(service_id) is registration:
+                    del self.registrations[service_id]
+            finally:
+                self._lock.release()
+
+            raise registration.error
+
+        return registration
+
+    def deregister(self, service_id, remove=True):
+        """
+        Stop heartbeating a service and, if C{remove} is True, remove it
+        from the registry.
+        """
+        self._lock.acquire()
+        try:
+            registration = self.registrations.pop(service_id, None)
+        finally:
+            self._lock.release()
+
+        if not registration:
+            raise AgentError('Service %s is not registered' % (service_id))
+
+        registration.stop(remove=remove)
+
+    def handle_command(self, command):
+        op = command.get('op', None)
+
+        try:
+            if op == 'register':
+                registration = self.register(
+                    command['id'], command['heartbeat_timeout'],
+                    payload=command.get('payload', None))
+                return {'ok': True, 'registered': registration.registered}
+            elif op == 'deregister':
+                self.deregister(command['id'])
+                return {'ok': True}
+            elif op == 'list':
+                self._lock.acquire()
+                try:
+                    registrations = self.registrations.values()
+                finally:
+                    self._lock.release()
+
+                return {'ok': True,
+                        'services': [registration.to_dict() for
+                                     registration in registrations]}
+        except KeyError as e:
+            return {'ok': False, 'error': 'Missing field: %s' % (e.args[0])}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+        return {'ok': False, 'error': 'Invalid op: %s' % (op)}
+
+    def serve_forever(self):
+        """
+        Listen on the socket and handle requests until shutdown() is
+        called.
+
+        @raise AgentError: Another agent is listening on the socket, or
+        something else than a socket is in its place.
+        """
+        if self._default_path:
+            _check_socket_dir(os.path.dirname(self.socket_path), create=True)
+
+        self._remove_stale_socket()
+
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.agent = self
+        os.chmod(self.socket_path, self.mode)
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _remove_stale_socket(self):
+        try:
+            st = os.lstat(self.socket_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+
+            raise
+
+        if not stat.S_ISSOCK(st.st_mode):
+            raise AgentError('%s is not a socket' % (self.socket_path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            # Nothing is listening, the socket was left behind by an agent
+            # which didn't exit cleanly.
+            if e.errno != errno.ECONNREFUSED:
+                raise
+        else:
+            raise AgentError('An agent is already listening on %s' %
+                             (self.socket_path))
+        finally:
+            sock.close()
+
+        os.unlink(self.socket_path)
+
+    def shutdown(self, remove=True):
+        """
+        Stop serving requests and deregister all the services.
+        """
+        if self._server:
+            self._server.shutdown()
+
+        for service_id in list(self.registrations.keys()):
+            try:
+                self.deregister(service_id, remove=remove)
+            except AgentError:
+                pass
+
+
+class AgentClient(object):
+    def __init__(self, socket_path=None, timeout=AGENT_TIMEOUT):
+        """
+        Registers services through a L{HeartbeatAgent} running on the same
+        host.
+
+        @param socket_path: Path of the agent's Unix domain socket, defaults
+        to L{get_socket_path}().
+        @type socket_path: C{str}
+        @param timeout: Socket timeout in seconds.
+        @type timeout: C{float}
+        """
+        self.socket_path = socket_path or get_socket_path()
+        self.timeout = timeout
+        self._default_path = socket_path is None
+
+    def register(self, service_id, heartbeat_timeout, payload=None):
+        """
+        Ask the agent to create and heartbeat a service. Returns True if the
+        service has already been created, False if the agent is still
+        trying to.
+        """
+        command = {'op': 'register', 'id': service_id,
+                   'heartbeat_timeout': heartbeat_timeout}
+
+        if payload:
+            command['payload'] = payload
+
+        return self._call(command)['registered']
+
+    def deregister(self, service_id):
+        return self._call({'op': 'deregister', 'id': service_id})['ok']
+
+    def list(self):
+        return self._call({'op': 'list'})['services']
+
+    def _call(self, command):
+        # Don't talk to an agent of another user which took the place of
+        # the directory.
+        if self._default_path:
+            _check_socket_dir(os.path.dirname(self.socket_path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(command) + '\n')
+            line = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+
+        if not line:
+            raise AgentError('Agent closed the connection')
+
+        response = json.loads(line)
+
+        if not response.get('ok', False):
+            raise AgentError(response.get('error', 'Unknown error'))
+
+        return response
+
+
+def main():
+    from client import Client
+
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--socket', dest='socket_path', default=None,
+                      help='Path of the Unix domain socket to listen on, '
+                           'defaults to %s' % (get_socket_path()))
+    parser.add_option('--username', dest='username',
+                      default=os.environ.get('RACKSPACE_USERNAME', None),
+                      help='Rackspace username')
+    parser.add_option('--api-key', dest='api_key',
+                      default=os.environ.get('RACKSPACE_API_KEY', None),
+                      help='Rackspace API key')
+    parser.add_option('--region', dest='region', default='us',
+                      help='Rackspace region')
+    parser.add_option('--base-url', dest='base_urls', action='append',
+                      help='Cloud Registry URL, can be given more than once')
+
+    (options, args) = parser.parse_args()
+
+    if not options.username or not options.api_key:
+        parser.error('--username and --api-key are required')
+
+    logging.basicConfig(level=logging.INFO)
+
+    client = Client(options.username, options.api_key,
+                    base_url=options.base_urls or DEFAULT_API_URL,
+                    region=options.region)
+    agent = HeartbeatAgent(client, socket_path=options.socket_path)
+
+    shutdown_threads = []
+
+    def on_signal(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so it can't be
+        # called from the thread which is serving.
+        thread = threading.Thread(target=agent.shutdown)
+        thread.start()
+        shutdown_threads.append(thread)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    agent.serve_forever()
+
+    for thread in shutdown_threads:
+        thread.join()
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'Authenticator'
+]
+
+import threading
+
+from calendar import timegm
+from time import time
+
+from dateutil import parser
+from libcloud.common.types import InvalidCredsError, MalformedResponseError
+from libcloud.compute.drivers.rackspace import RackspaceNodeDriver
+
+import forksafe
+
+from constants import DEFAULT_AUTH_URLS, AUTH_TOKEN_EXPIRY_MARGIN
+from errors import InvalidCredentialsError
+
+
+class Authenticator(object):
+    def __init__(self, username, api_key, region):
+        """
+        Holds the auth token for a single account. One instance can be
+        shared by any number of clients and threads.
+
+        @param username: Rackspace username.
+        @type username: C{str}
+        @param api_key: Rackspace API key.
+        @type api_key: C{str}
+        @param region: Rackspace region.
+        @type region: C{str}
+        """
+        valid_regions = DEFAULT_AUTH_URLS.keys()
+        if region not in valid_regions:
+            raise ValueError('Invalid region %s. Valid regions are: %s' % (
+                             region, ', '.join(valid_regions)))
+
+        auth_url = DEFAULT_AUTH_URLS[region]
+
+        if not auth_url.endswith('/'):
+            auth_url += '/'
+
+        self.username = username
+        self.api_key = api_key
+        self.region = region
+        self.auth_url = auth_url
+        self.auth_headers = None
+        self.auth_token_expires = None
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def get_headers(self, force=False, rejected=None):
+        """
+        Return the auth headers, authenticating first if there is no token
+        yet, the token is about to expire or C{force} is True.
+
+        @param rejected: Headers the API answered with a 401. A new token is
+        only fetched if they are still the current ones, so a burst of
+        requests rejected at once authenticates once.
+        @type rejected: C{dict}
+        """
+        self._lock.acquire()
+        try:
+            if rejected is not None:
+                # Another thread may have renewed the token already.
+                force = force or self.auth_headers == rejected
+
+            if not force and self._is_valid():
+                return self.auth_headers
+
+            self.auth_headers = self._authenticate()
+            return self.auth_headers
+        finally:
+            self._lock.release()
+
+    def _after_fork(self):
+        # The token is kept, children don't need to authenticate again.
+        self._lock = threading.Lock()
+
+    def _is_valid(self):
+        if not self.auth_headers or not self.auth_token_expires:
+            return False
+
+        return self.auth_token_expires > (time() + AUTH_TOKEN_EXPIRY_MARGIN)
+
+    def _authenticate(self):
+        try:
+            driver = RackspaceNodeDriver(self.username, self.api_key,
+                                         ex_force_auth_url=self.auth_url,
+                                         ex_force_auth_version='2.0',
+                                         ex_force_service_region=self.region)
+            driver.connection._populate_hosts_and_request_paths()
+            auth_token = driver.connection.auth_token
+            tenant_id = driver.connection.request_path.split('/')[-1]
+            expires = driver.connection.auth_token_expires
+            expires_datetime = parser.parse(expires)
+            self.auth_token_expires = timegm(expires_datetime.utctimetuple())
+            return {'X-Auth-Token': auth_token,
+                    'X-Tenant-Id': tenant_id}
+        except (InvalidCredsError, MalformedResponseError):
+            raise InvalidCredentialsError('The username or password you'
+                                          ' entered is incorrect. Please'
+                                          ' try again.')
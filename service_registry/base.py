@@ -13,49 +13,230 @@
 # limitations under the License.
 
 __all__ = [
-    'BaseClient'
+    'BaseClient',
+    'create_session'
 ]
 
+import sys
+import errno
+import socket
 import httplib
+import threading
 import requests
 
-from time import mktime, time
-
 try:
     import simplejson as json
 except:
     import json
 
-from dateutil import parser
-from libcloud.common.types import InvalidCredsError, MalformedResponseError
-from libcloud.compute.drivers.rackspace import RackspaceNodeDriver
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import forksafe
 
-from constants import DEFAULT_AUTH_URLS
 from constants import MAX_401_RETRIES
 from constants import ACCEPTABLE_STATUS_CODES
-from errors import (APIError, ValidationError, InvalidCredentialsError)
+from constants import DEFAULT_MAX_WORKERS
+from constants import STREAM_CHUNK_SIZE
+from constants import DEFAULT_TIMEOUT
+from constants import IDEMPOTENT_METHODS
+from auth import Authenticator
+from deadline import bind, get_deadline
+from endpoints import EndpointSet
+from errors import APIError, ValidationError, DeadlineExceededError
+from ratelimit import CRITICAL, NORMAL, BULK
+from singleflight import SingleFlight
+from streaming import StreamingListing
+
+# Errors of a connection that was never established.
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def _was_not_sent(error):
+    """
+    Return True if the request which failed with C{error} didn't reach the
+    server because the connection couldn't be established.
+    """
+    reason = error.args and error.args[0]
+    # requests wraps socket errors of the connection pool in MaxRetryError.
+    reason = getattr(reason, 'reason', reason)
+
+    if isinstance(reason, socket.gaierror):
+        return True
+
+    return (isinstance(reason, socket.error) and
+            reason.errno in CONNECT_ERRNOS)
+
+
+def _is_unavailable(error):
+    """
+    Return True if C{error} means the registry couldn't be reached or failed
+    to answer, rather than that it rejected the request.
+    """
+    if isinstance(error, ValidationError):
+        return error.code >= httplib.INTERNAL_SERVER_ERROR
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def create_session(pool_size=None):
+    """
+    Return a new HTTP session, keeping up to C{pool_size} connections per
+    host if given.
+    """
+    session = requests.Session()
+
+    if pool_size:
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    return session
 
 
 class BaseClient(object):
-    def __init__(self, base_url, username, api_key, region):
-        self.base_url = base_url
+    def __init__(self, base_url, username, api_key, region,
+                 coalesce_gets=True, authenticator=None, session=None,
+                 executor=None, endpoints=None, timeout=DEFAULT_TIMEOUT,
+                 rate_limiter=None, priority_limiter=None,
+                 negative_cache=None, catalog=None):
+        """
+        @param base_url: The base Cloud Registry URL, or a list of them.
+        @type base_url: C{str} or C{list}
+        @param coalesce_gets: If True, concurrent identical GET requests
+        made through this client share a single HTTP request and all
+        receive the same result object (or error).
+        @type coalesce_gets: C{bool}
+        @param authenticator: Auth token holder shared with other clients for
+        the same account. A new one is created if not provided.
+        @type authenticator: L{Authenticator}
+        @param session: HTTP session (connection pool) shared with other
+        clients. A new one is created if not provided.
+        @type session: C{requests.Session}
+        @param executor: Executor used by the *_async methods. A new one is
+        created on first use if not provided.
+        @type executor: C{concurrent.futures.Executor}
+        @param endpoints: Endpoint set shared with other clients. Built from
+        C{base_url} if not provided.
+        @type endpoints: L{EndpointSet}
+        @param timeout: Socket timeout in seconds for connecting and for
+        every read, None to wait forever. Lowered further inside a
+        deadline() block.
+        @type timeout: C{float}
+        @param rate_limiter: Rate budget every request has to go through,
+        usually shared by all the clients of an account.
+        @type rate_limiter: L{RateLimiter}
+        @param priority_limiter: Admission limit every request has to go
+        through, in the lane of its class: CRITICAL for heartbeats and
+        other POST requests, BULK for listings and NORMAL for the rest.
+        @type priority_limiter: L{PriorityLimiter}
+        @param negative_cache: Cache of the services and configuration
+        values found not to exist.
+        @type negative_cache: L{NegativeCache}
+        @param catalog: Local snapshot which single lookups and listings are
+        served from when the registry can't be reached or fails with a 5xx
+        response.
+        @type catalog: L{Catalog}
+        """
         self.username = username
         self.api_key = api_key
-        self.auth_headers = None
-        self.auth_token_expires = None
         self.region = region
 
-        valid_regions = DEFAULT_AUTH_URLS.keys()
-        if region not in valid_regions:
-            raise ValueError('Invalid region %s. Valid regions are: %s' % (
-                             region, ', '.join(valid_regions)))
-
-        auth_url = DEFAULT_AUTH_URLS[region]
-
-        if not auth_url.endswith('/'):
-            auth_url += '/'
-
-        self.auth_url = auth_url
+        if not authenticator:
+            authenticator = Authenticator(username, api_key, region)
+
+        self.authenticator = authenticator
+        self.auth_url = authenticator.auth_url
+        self.session = session or requests.Session()
+        self._owns_session = session is None
+
+        if not endpoints:
+            endpoints = EndpointSet(base_url, session=self.session)
+
+        self.endpoints = endpoints
+        self.base_url = endpoints.urls[0]
+        self.coalesce_gets = coalesce_gets
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.priority_limiter = priority_limiter
+        self.negative_cache = negative_cache
+        self.catalog = catalog
+        self._executor = executor
+        self._owns_executor = False
+        self._executor_lock = threading.Lock()
+        self._inflight = SingleFlight()
+        forksafe.register(self)
+
+    @property
+    def auth_headers(self):
+        return self.authenticator.auth_headers
+
+    @property
+    def auth_token_expires(self):
+        return self.authenticator.auth_token_expires
+
+    @property
+    def executor(self):
+        forksafe.check()
+
+        if self._executor is None:
+            self._executor_lock.acquire()
+            try:
+                if self._executor is None:
+                    self._executor = \
+                        ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS)
+                    self._owns_executor = True
+            finally:
+                self._executor_lock.release()
+
+        return self._executor
+
+    def __getattr__(self, name):
+        # foo_async(*args) submits foo(*args) to the executor and returns
+        # a concurrent.futures.Future.
+        if not name.endswith('_async') or name.startswith('_'):
+            raise AttributeError(name)
+
+        method = getattr(self, name[:-len('_async')])
+
+        if not callable(method):
+            raise AttributeError(name)
+
+        def submit(*args, **kwargs):
+            return self.executor.submit(bind(method), *args, **kwargs)
+
+        submit.__name__ = name
+        return submit
+
+    def _get_client_kwargs(self):
+        """
+        Keyword arguments for constructing another client which shares
+        auth, connections and worker threads with this one.
+        """
+        return {'coalesce_gets': self.coalesce_gets,
+                'authenticator': self.authenticator,
+                'session': self.session,
+                'executor': self._executor,
+                'endpoints': self.endpoints,
+                'timeout': self.timeout,
+                'rate_limiter': self.rate_limiter,
+                'priority_limiter': self.priority_limiter,
+                'negative_cache': self.negative_cache,
+                'catalog': self.catalog}
+
+    def _after_fork(self):
+        # Locks and in-flight calls may belong to threads of the parent and
+        # pooled connections share their sockets with it.
+        self._executor_lock = threading.Lock()
+        self._inflight = SingleFlight()
+
+        if self._owns_session:
+            self.session = requests.Session()
+
+        if self._owns_executor:
+            self._executor = None
+            self._owns_executor = False
 
     def get_id_from_url(self, url):
         return url.split('/')[-1]
@@ -71,29 +252,242 @@ class BaseClient(object):
 
         return options
 
+    def _list(self, path, options, model_class, as_models=False,
+              stream=False, timeout=None, fallback=None):
+        """
+        Issue a listing request.
+
+        With C{stream}, a L{StreamingListing} is returned which parses the
+        values while the response body is being read instead of after it
+        has been buffered in full. C{stream} and C{timeout} are only passed
+        on when they are set.
+
+        Unless C{stream} is set, C{fallback(catalog)} is returned instead if
+        the registry is unavailable (see L{_call_or_fallback}).
+        """
+        kwargs = {}
+
+        if stream:
+            kwargs['stream'] = True
+            fallback = None
+
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+
+        result = self._call_or_fallback(fallback, self.request, 'GET', path,
+                                        options=options, **kwargs)
+
+        return self._to_models(result, model_class) if as_models else result
+
+    def _to_models(self, result, model_class):
+        """
+        Replace the raw dictionaries in a listing response with instances
+        of C{model_class}.
+        """
+        if isinstance(result, StreamingListing):
+            result.model_class = model_class
+            return result
+
+        result = dict(result)
+        result['values'] = [model_class.from_dict(value) for value in
+                            result['values']]
+        return result
+
+    def _iterate_pages(self, list_method, *args, **kwargs):
+        """
+        Call a listing method repeatedly, following next_marker, and yield
+        every page.
+        """
+        while True:
+            result = list_method(*args, **kwargs)
+            yield result
+
+            marker = result['metadata'].get('next_marker', None)
+
+            if not marker:
+                break
+
+            kwargs['marker'] = marker
+
+    def _call_concurrently(self, fn, items, max_concurrency=None):
+        """
+        Call C{fn(item)} for every item with at most C{max_concurrency}
+        calls in flight at once (L{DEFAULT_MAX_WORKERS} if not given).
+
+        The calls run on threads of their own rather than on the executor,
+        so C{max_concurrency} isn't capped by its number of workers and
+        this can be called from one of them. The HTTP session still keeps
+        only its pool size of connections open between requests.
+
+        Returns a list of (item, result, error) tuples in the order of
+        C{items}, where error is the exception raised by the call or None.
+        """
+        items = list(items)
+
+        if not items:
+            return []
+
+        max_workers = min(max_concurrency or DEFAULT_MAX_WORKERS, len(items))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        try:
+            futures = [(item, executor.submit(bind(fn), item))
+                       for item in items]
+        finally:
+            executor.shutdown(wait=False)
+
+        results = []
+
+        for item, future in futures:
+            try:
+                results.append((item, future.result(), None))
+            except Exception as e:
+                results.append((item, None, e))
+
+        return results
+
+    def _get_checking_misses(self, key, path, timeout=None, fallback=None):
+        """
+        GET C{path}. With a negative cache, a not found error cached under
+        C{key} is raised without a request and a new one is cached.
+
+        C{fallback(catalog)} is returned instead if the registry is
+        unavailable (see L{_call_or_fallback}).
+        """
+        return self._call_or_fallback(fallback, self._get_unless_missing,
+                                      key, path, timeout=timeout)
+
+    def _get_unless_missing(self, key, path, timeout=None):
+        if self.negative_cache is None:
+            return self.request('GET', path, timeout=timeout)
+
+        error = self.negative_cache.get(key)
+
+        if error is not None:
+            raise error
+
+        version = self.negative_cache.version
+
+        try:
+            return self.request('GET', path, timeout=timeout)
+        except ValidationError as e:
+            if e.code == httplib.NOT_FOUND:
+                self.negative_cache.add(key, e, version)
+
+            raise
+
+    def _call_or_fallback(self, fallback, fn, *args, **kwargs):
+        """
+        Return C{fn(*args, **kwargs)}. If it fails because the registry
+        can't be reached, times out or answers with a 5xx error, return
+        C{fallback(catalog)} instead, as long as this client has a catalog
+        and the fallback finds something in its snapshot. Otherwise the
+        error is raised.
+        """
+        try:
+            return fn(*args, **kwargs)
+        except (requests.RequestException, ValidationError) as e:
+            if fallback is None or self.catalog is None or \
+                    not _is_unavailable(e):
+                raise
+
+            exc_info = sys.exc_info()
+            result = fallback(self.catalog)
+
+            if result is None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            return result
+
+    def _invalidate_misses(self, key):
+        if self.negative_cache is not None:
+            self.negative_cache.discard(key)
+
+    def _get_request_key(self, path, options, timeout=None):
+        return (path, tuple(sorted((options or {}).items())), timeout)
+
     def request(self, method, path, options=None, payload=None,
-                heartbeater=None, re_authenticate=False, retry_count=0):
-        self.auth_headers = self._authenticate(force=re_authenticate)
-        tenant_id = self.auth_headers['X-Tenant-Id']
-        request_url = self.base_url + tenant_id + path
+                heartbeater=None, re_authenticate=False, retry_count=0,
+                stream=False, priority=None, timeout=None):
+        """
+        Send a request to the registry and return its parsed response.
+
+        @param priority: Lane of the request in the priority limiter.
+        Derived from the method and options if not given.
+        @type priority: C{int}
+        @param timeout: Socket timeout in seconds for this request only,
+        instead of the client's. Still lowered inside a deadline() block.
+        @type timeout: C{float}
+        """
+        forksafe.check()
+
+        if priority is None:
+            priority = self._get_priority(method, options)
+
+        if stream:
+            # A streamed body can only be read once, so it can't be shared.
+            return self._request(method=method, path=path, options=options,
+                                 re_authenticate=re_authenticate,
+                                 retry_count=retry_count, stream=True,
+                                 priority=priority, timeout=timeout)
+
+        if method == 'GET' and self.coalesce_gets:
+            key = self._get_request_key(path, options, timeout)
+            return self._inflight.do(key, self._request, method=method,
+                                     path=path, options=options,
+                                     re_authenticate=re_authenticate,
+                                     retry_count=retry_count,
+                                     priority=priority, timeout=timeout)
+
+        return self._request(method=method, path=path, options=options,
+                             payload=payload, heartbeater=heartbeater,
+                             re_authenticate=re_authenticate,
+                             retry_count=retry_count, priority=priority,
+                             timeout=timeout)
+
+    def _get_priority(self, method, options):
+        if method == 'POST':
+            return CRITICAL
+
+        # Only listings are paginated, so only they have query options.
+        if options is not None:
+            return BULK
+
+        return NORMAL
+
+    def _request(self, method, path, options=None, payload=None,
+                 heartbeater=None, re_authenticate=False, retry_count=0,
+                 stream=False, priority=NORMAL, timeout=None,
+                 rejected_headers=None):
+        auth_headers = self._authenticate(force=re_authenticate,
+                                          rejected=rejected_headers)
+        tenant_id = auth_headers['X-Tenant-Id']
 
         if method not in ['GET', 'POST', 'PUT', 'DELETE']:
             raise ValueError('Invalid method: %s' % (method))
 
         data = json.dumps(payload) if payload else None
-        request_kwargs = {'method': method.lower(), 'url': request_url,
-                          'headers': self.auth_headers, 'params': options,
-                          'data': data}
+        request_kwargs = {'method': method.lower(),
+                          'headers': auth_headers, 'params': options,
+                          'data': data, 'stream': stream}
 
         if retry_count < MAX_401_RETRIES:
             retry_count += 1
-            r = requests.request(**request_kwargs)
+
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            r = self._send(tenant_id + path, request_kwargs, priority,
+                           timeout)
 
             if r.status_code == httplib.UNAUTHORIZED:
-                return self.request(method=method, path=path, options=options,
-                                    payload=payload, heartbeater=heartbeater,
-                                    re_authenticate=True,
-                                    retry_count=retry_count)
+                return self._request(method=method, path=path,
+                                     options=options, payload=payload,
+                                     heartbeater=heartbeater,
+                                     retry_count=retry_count,
+                                     stream=stream, priority=priority,
+                                     timeout=timeout,
+                                     rejected_headers=auth_headers)
         else:
             raise APIError('API returned 401')
 
@@ -108,6 +502,10 @@ class BaseClient(object):
         if method == 'GET':
             _check_status_code(r.status_code, 'GET')
 
+            if stream:
+                chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                return StreamingListing(chunks, close=r.close)
+
             return r.json()
         elif method == 'POST':
             if int(r.headers.get('content-length', 0)) > 0:
@@ -135,27 +533,72 @@ class BaseClient(object):
 
             return True
 
-    def _authenticate(self, force=False):
-        if self.auth_headers:
-            current_time = time()
-            if not force and (self.auth_token_expires and
-                             (self.auth_token_expires < current_time)):
-                return self.auth_headers
+    def _send(self, path, request_kwargs, priority=NORMAL, timeout=None):
+        """
+        Send a request to the best endpoint, failing over to the next one
+        on connection errors and 5xx responses. POST requests aren't
+        idempotent and only fail over if the connection couldn't be
+        established. The last endpoint's response or error is returned or
+        raised as is.
+
+        With a priority limiter, a slot in the lane of C{priority} is held
+        until the response headers have arrived. C{timeout} overrides the
+        client's timeout if given.
+        """
+        if not self.priority_limiter:
+            return self._send_to_endpoints(path, request_kwargs, timeout)
+
+        self.priority_limiter.acquire(priority)
         try:
-            driver = RackspaceNodeDriver(self.username, self.api_key,
-                                         ex_force_auth_url=self.auth_url,
-                                         ex_force_auth_version='2.0',
-                                         ex_force_service_region=self.region)
-            driver.connection._populate_hosts_and_request_paths()
-            auth_token = driver.connection.auth_token
-            tenant_id = driver.connection.request_path.split('/')[-1]
-            expires = driver.connection.auth_token_expires
-            expires_datetime = parser.parse(expires)
-            self.auth_token_expires = \
-                mktime(expires_datetime.timetuple())
-            return {'X-Auth-Token': auth_token,
-                    'X-Tenant-Id': tenant_id}
-        except (InvalidCredsError, MalformedResponseError):
-            raise InvalidCredentialsError('The username or password you'
-                                          ' entered is incorrect. Please'
-                                          ' try again.')
+            return self._send_to_endpoints(path, request_kwargs, timeout)
+        finally:
+            self.priority_limiter.release(priority)
+
+    def _send_to_endpoints(self, path, request_kwargs, timeout=None):
+        endpoints = self.endpoints.ordered()
+        current_deadline = get_deadline()
+        idempotent = request_kwargs['method'].upper() in IDEMPOTENT_METHODS
+
+        if timeout is None:
+            timeout = self.timeout
+
+        for index, endpoint in enumerate(endpoints):
+            is_last = (index == len(endpoints) - 1)
+            endpoint_timeout = timeout
+
+            if current_deadline:
+                endpoint_timeout = current_deadline.get_timeout(timeout)
+
+            try:
+                r = self.session.request(url=endpoint.url + path,
+                                         timeout=endpoint_timeout,
+                                         **request_kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if current_deadline and current_deadline.expired():
+                    # Our own time budget ran out, the endpoint is fine.
+                    raise DeadlineExceededError('Deadline exceeded')
+
+                self.endpoints.record_failure(endpoint)
+
+                if is_last or not (idempotent or _was_not_sent(e)):
+                    raise
+
+                continue
+
+            if r.status_code >= httplib.INTERNAL_SERVER_ERROR:
+                self.endpoints.record_failure(endpoint)
+
+                if idempotent and not is_last:
+                    continue
+            else:
+                self.endpoints.record_success(endpoint)
+
+            return r
+
+    def _authenticate(self, force=False, rejected=None):
+        current_deadline = get_deadline()
+
+        if current_deadline:
+            current_deadline.check()
+
+        return self.authenticator.get_headers(force=force, rejected=rejected)
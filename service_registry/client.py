@@ -20,48 +20,150 @@ __all__ = [
     'AccountClient'
 ]
 
+from collections import OrderedDict
 from copy import deepcopy
-from time import sleep
+from time import sleep, time
+
+import csv
+import httplib
+import threading
+
+import drain
+import forksafe
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from concurrent.futures import ThreadPoolExecutor
 
 from constants import DEFAULT_API_URL, MAX_HEARTBEAT_TIMEOUT
-from base import BaseClient
-from heartbeater import HeartBeater
-from errors import ValidationError
+from constants import DEFAULT_MAX_WORKERS, DEFAULT_TIMEOUT
+from constants import CONFIGURATION_WRITE_WINDOW, KNOWN_PAYLOADS_SIZE
+from auth import Authenticator
+from columnar import ServiceColumns, get_csv_names, get_csv_row
+from columnar import write_csv_header, write_csv_row
+from deadline import bind, deadline, get_deadline
+from base import BaseClient, create_session
+from endpoints import EndpointSet
+from heartbeater import HeartBeater, get_phase
+from errors import ValidationError, DeadlineExceededError
+from models import Service, Event, ConfigurationValue
+from negativecache import NegativeCache, SERVICES, CONFIGURATION
+from poller import EventsPoller
+from snapshot import Catalog
+from writebehind import WriteBehindBuffer
 
 
 class EventsClient(BaseClient):
-    def __init__(self, base_url, username, api_key, region):
+    def __init__(self, base_url, username, api_key, region, **kwargs):
         super(EventsClient, self).__init__(base_url, username,
-                                           api_key, region)
+                                           api_key, region, **kwargs)
         self.events_path = '/events'
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, as_models=False, stream=False,
+             timeout=None):
         options = self._get_options_object(marker=marker, limit=limit)
-        return self.request('GET', self.events_path, options=options)
+        return self._list(self.events_path, options, Event,
+                          as_models=as_models, stream=stream,
+                          timeout=timeout)
+
+    def iterate(self, marker=None, as_models=False):
+        """
+        Iterate over every event published after the one with the id
+        C{marker}, or over the whole feed, one page at a time.
+        """
+        for page in self._iterate_pages(self.list, marker=marker,
+                                        as_models=as_models):
+            for event in page['values']:
+                event_id = event.id if as_models else event.get('id', None)
+
+                # Markers are inclusive, skip the last event already seen.
+                if marker and event_id == marker:
+                    continue
+
+                yield event
+
+    def get_head(self, marker=None):
+        """
+        Return the id of the newest event, or C{marker} if none has been
+        published after it. Only the last event of every page is looked
+        at, so reading from a recent C{marker} is cheap.
+        """
+        head = marker
+
+        for page in self._iterate_pages(self.list, marker=marker):
+            for event in reversed(page['values']):
+                if event.get('id', None):
+                    head = event['id']
+                    break
+
+        return head
 
 
 class ServicesClient(BaseClient):
-    def __init__(self, base_url, username, api_key, region):
+    def __init__(self, base_url, username, api_key, region,
+                 registration_limiter=None, **kwargs):
+        """
+        @param registration_limiter: Admission limit on the number of
+        services being created at once, usually shared by every client of
+        the process.
+        @type registration_limiter: L{ConcurrencyLimiter}
+
+        Any other keyword arguments are passed to L{BaseClient}.
+        """
         super(ServicesClient, self).__init__(base_url, username,
-                                             api_key, region)
+                                             api_key, region, **kwargs)
         self.services_path = '/services'
+        self.registration_limiter = registration_limiter
+
+        # Last payload this client has successfully sent for every service,
+        # used by update_many() to skip updates which change nothing. Least
+        # recently sent first, so the oldest are dropped once it holds
+        # KNOWN_PAYLOADS_SIZE of them.
+        self._known_payloads = OrderedDict()
+        self._known_payloads_lock = threading.Lock()
+
+    def _after_fork(self):
+        super(ServicesClient, self)._after_fork()
+        self._known_payloads_lock = threading.Lock()
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, as_models=False, stream=False,
+             timeout=None):
         options = self._get_options_object(marker=marker, limit=limit)
-        return self.request('GET', self.services_path, options=options)
 
-    def list_for_tag(self, tag, marker=None, limit=None):
+        def fallback(catalog):
+            return catalog.list_services_page(marker=marker, limit=limit)
+
+        return self._list(self.services_path, options, Service,
+                          as_models=as_models, stream=stream,
+                          timeout=timeout, fallback=fallback)
+
+    def list_for_tag(self, tag, marker=None, limit=None, as_models=False,
+                     stream=False, timeout=None):
         options = self._get_options_object(marker=marker, limit=limit)
         options['tag'] = tag
 
-        return self.request('GET', self.services_path, options=options)
+        def fallback(catalog):
+            return catalog.list_services_page(tag=tag, marker=marker,
+                                              limit=limit)
+
+        return self._list(self.services_path, options, Service,
+                          as_models=as_models, stream=stream,
+                          timeout=timeout, fallback=fallback)
 
-    def get(self, service_id):
+    def get(self, service_id, timeout=None):
         path = '%s/%s' % (self.services_path, service_id)
 
-        return self.request('GET', path)
+        def fallback(catalog):
+            return catalog.get_service(service_id)
 
-    def create(self, service_id, heartbeat_timeout, payload=None):
+        return self._get_checking_misses((SERVICES, service_id), path,
+                                         timeout=timeout, fallback=fallback)
+
+    def create(self, service_id, heartbeat_timeout, payload=None,
+               adaptive=False, timeout=None):
         payload = deepcopy(payload) if payload else {}
         payload['id'] = service_id
         payload['heartbeat_timeout'] = heartbeat_timeout
@@ -71,138 +173,752 @@ class ServicesClient(BaseClient):
                                   self.api_key,
                                   self.region,
                                   None,
-                                  heartbeat_timeout)
+                                  heartbeat_timeout,
+                                  adaptive=adaptive,
+                                  **self._get_client_kwargs())
+
+        if self.registration_limiter:
+            self.registration_limiter.acquire()
 
-        return self.request('POST', self.services_path, payload=payload,
-                            heartbeater=heartbeater)
+        try:
+            sent = time()
+            result = self.request('POST', self.services_path,
+                                  payload=payload, heartbeater=heartbeater,
+                                  timeout=timeout)
+        finally:
+            if self.registration_limiter:
+                self.registration_limiter.release()
 
-    def heartbeat(self, service_id, token):
+            self._invalidate_misses((SERVICES, service_id))
+
+        heartbeater.last_sent = sent
+        drain.track(heartbeater)
+        self._remember_payload(service_id, payload)
+
+        return result
+
+    def heartbeat(self, service_id, token, timeout=None):
         path = '%s/%s/heartbeat' % (self.services_path, service_id)
         payload = {'token': token}
 
-        return self.request('POST', path, payload=payload)
+        return self.request('POST', path, payload=payload, timeout=timeout)
 
-    def update(self, service_id, payload):
+    def update(self, service_id, payload, timeout=None):
         path = '%s/%s' % (self.services_path, service_id)
 
-        return self.request('PUT', path, payload=payload)
+        try:
+            result = self.request('PUT', path, payload=payload,
+                                  timeout=timeout)
+        except ValidationError as e:
+            if e.code == httplib.NOT_FOUND:
+                self._forget_payload(service_id)
+
+            raise
+
+        self._remember_payload(service_id, payload, merge=True)
+
+        return result
+
+    def update_many(self, payloads, max_concurrency=DEFAULT_MAX_WORKERS,
+                    current=None):
+        """
+        Update many services at once, at most C{max_concurrency} at a time,
+        skipping the ones whose payload matches their known state.
+
+        @param payloads: Update payloads by service id.
+        @type payloads: C{dict}
+        @param max_concurrency: Maximum number of updates in flight. They
+        run on threads of their own, not on the executor, so this isn't
+        limited by C{max_workers}.
+        @type max_concurrency: C{int}
+        @param current: Current services by id, as dictionaries or
+        L{Service} models (for example C{ServicesWatcher.services}). For
+        the services which are not in it, the payloads previously sent by
+        this client are used, as long as no event seen by
+        C{events_poller} says the service has expired or been removed
+        since.
+        @type current: C{dict}
+
+        @return: A report with the 'updated' and 'unchanged' service ids and
+        an 'errors' dictionary mapping the ids of the failed updates to
+        their exception.
+        @rtype: C{dict}
+        """
+        report = {'updated': [], 'unchanged': [], 'errors': {}}
+        service_ids = []
+
+        for service_id in sorted(payloads.keys()):
+            if current and service_id in current:
+                known = current[service_id]
+
+                if isinstance(known, Service):
+                    known = known.to_dict()
+            else:
+                known = self._get_known_payload(service_id)
+
+            if known is not None and \
+               self._payload_matches(known, payloads[service_id]):
+                report['unchanged'].append(service_id)
+            else:
+                service_ids.append(service_id)
+
+        def update(service_id):
+            return self.update(service_id, payloads[service_id])
+
+        for service_id, _, error in self._call_concurrently(update,
+                                                            service_ids,
+                                                            max_concurrency):
+            if error:
+                report['errors'][service_id] = error
+            else:
+                report['updated'].append(service_id)
+
+        return report
+
+    def export_columnar(self, fp=None, format='binary', metadata_keys=None,
+                        limit=None):
+        """
+        Walk all the pages of the services list and build column arrays of
+        the catalog, one page at a time.
+
+        @param fp: File to write the columns to. If not given the columns
+        are returned.
+        @type fp: C{file}
+        @param format: 'binary' for the format read by L{read_columnar} or
+        'csv'.
+        @type format: C{str}
+        @param metadata_keys: Metadata keys to export as CSV columns. When
+        given, the CSV is written page by page without keeping the catalog
+        in memory, otherwise the columns are built first to find all the
+        metadata keys.
+        @type metadata_keys: C{list}
+        @param limit: Page size.
+        @type limit: C{int}
+
+        @return: The L{ServiceColumns}, or the number of services written
+        if C{fp} is given.
+        """
+        if format not in ('binary', 'csv'):
+            raise ValueError('Invalid format: %s' % (format))
+
+        pages = self._iterate_pages(self.list, limit=limit)
+
+        if fp is not None and format == 'csv' and metadata_keys is not None:
+            writer = csv.writer(fp)
+            write_csv_header(writer, get_csv_names(metadata_keys))
+            count = 0
 
-    def remove(self, service_id):
+            for page in pages:
+                for service in page['values']:
+                    write_csv_row(writer, get_csv_row(service, metadata_keys))
+                    count += 1
+
+            return count
+
+        columns = ServiceColumns()
+
+        for page in pages:
+            for service in page['values']:
+                columns.append(service)
+
+        if fp is None:
+            return columns
+
+        if format == 'csv':
+            columns.write_csv(csv.writer(fp))
+        else:
+            columns.write(fp)
+
+        return columns.rows
+
+    def remove(self, service_id, timeout=None):
         path = '%s/%s' % (self.services_path, service_id)
+        result = self.request('DELETE', path, timeout=timeout)
+        drain.untrack(service_id)
+        self._forget_payload(service_id)
 
-        return self.request('DELETE', path)
+        return result
 
     def register(self, service_id, heartbeat_timeout, payload=None,
-                 retry_delay=2):
-        retry_count = MAX_HEARTBEAT_TIMEOUT / retry_delay
-        success = False
-        retry_counter = 0
+                 retry_delay=2, adaptive=False, spread=0):
+        """
+        Create a service, retrying while a previous instance with the same
+        id has not expired yet.
+
+        @param spread: Delay the first attempt by up to this many seconds,
+        by an amount derived from the service id, so a whole cluster
+        restarting at once doesn't register in the same instant.
+        @type spread: C{float}
+        """
+        retry_count = int(MAX_HEARTBEAT_TIMEOUT / retry_delay)
         last_err = None
-        result = None
 
-        def do_register(success, result, retry_counter, last_err):
-            if success and (retry_counter < retry_count):
-                return result
+        if spread:
+            delay = get_phase(service_id, spread)
+            current_deadline = get_deadline()
 
-            elif (not success) and (retry_counter == retry_count):
-                return last_err
-            try:
-                result = self.create(service_id=service_id,
-                                     heartbeat_timeout=heartbeat_timeout,
-                                     payload=payload)
-                success = True
+            # Leave at least half of the time budget for registering.
+            if current_deadline:
+                delay = min(delay, max(current_deadline.remaining() / 2, 0))
+
+            sleep(delay)
 
-                return do_register(success, result, retry_counter, last_err)
+        for _ in xrange(retry_count):
+            try:
+                return self.create(service_id=service_id,
+                                   heartbeat_timeout=heartbeat_timeout,
+                                   payload=payload, adaptive=adaptive)
             except ValidationError as e:
-                last_err = e.args[0]
-                if last_err.type == 'serviceWithThisIdExists':
-                    retry_counter += 1
-                    sleep(retry_delay)
+                if e.type != 'serviceWithThisIdExists':
+                    return e
+
+                last_err = e
+
+            # Don't sleep past the deadline, there would be no time left to
+            # retry.
+            current_deadline = get_deadline()
 
-                    return do_register(success, result, retry_counter,
-                                       last_err)
-                else:
-                    return last_err
+            if current_deadline and \
+               current_deadline.remaining() < retry_delay:
+                raise DeadlineExceededError('Deadline exceeded while waiting'
+                                            ' for %s to expire' %
+                                            (service_id))
 
-        return do_register(success, result, retry_counter, last_err)
+            sleep(retry_delay)
+
+        return last_err
+
+    def handle_event(self, event):
+        """
+        Forget the payload sent for a service which an event (a dictionary
+        or L{Event}) says has timed out or been removed, possibly by another
+        process, since whoever registers it next may send another one.
+        """
+        if isinstance(event, dict):
+            event_type = event.get('type', None)
+            payload = event.get('payload', None) or {}
+        else:
+            event_type = event.type
+            payload = event.payload or {}
+
+        if event_type in ('service.timeout', 'service.remove'):
+            self._forget_payload(payload.get('id', None))
+
+    def _get_known_payload(self, service_id):
+        self._known_payloads_lock.acquire()
+        try:
+            return self._known_payloads.get(service_id, None)
+        finally:
+            self._known_payloads_lock.release()
+
+    def _remember_payload(self, service_id, payload, merge=False):
+        self._known_payloads_lock.acquire()
+        try:
+            known = self._known_payloads.pop(service_id, None)
+            known = dict(known) if known and merge else {}
+            known.update(deepcopy(payload))
+            self._known_payloads[service_id] = known
+
+            while len(self._known_payloads) > KNOWN_PAYLOADS_SIZE:
+                self._known_payloads.popitem(last=False)
+        finally:
+            self._known_payloads_lock.release()
+
+    def _forget_payload(self, service_id):
+        self._known_payloads_lock.acquire()
+        try:
+            self._known_payloads.pop(service_id, None)
+        finally:
+            self._known_payloads_lock.release()
+
+    def _payload_matches(self, known, payload):
+        for key, value in payload.iteritems():
+            if key not in known or known[key] != value:
+                return False
+
+        return True
 
 
 class ConfigurationClient(BaseClient):
-    def __init__(self, base_url, username, api_key, region):
+    def __init__(self, base_url, username, api_key, region, **kwargs):
         super(ConfigurationClient, self).__init__(base_url, username,
-                                                  api_key, region)
+                                                  api_key, region, **kwargs)
         self.configuration_path = '/configuration'
 
-    def list(self, marker=None, limit=None):
+    def list(self, marker=None, limit=None, as_models=False, stream=False,
+             timeout=None):
         options = self._get_options_object(marker=marker, limit=limit)
-        return self.request('GET', self.configuration_path, options=options)
 
-    def list_for_namespace(self, namespace, marker=None, limit=None):
-        options = self._get_options_object(marker=marker, limit=limit)
+        def fallback(catalog):
+            return catalog.list_configuration_page(marker=marker,
+                                                   limit=limit)
 
-        if namespace[0] != '/':
-            namespace = '/%s' % (namespace)
-
-        if namespace[len(namespace) - 1] != '/':
-            namespace += '/'
+        return self._list(self.configuration_path, options,
+                          ConfigurationValue, as_models=as_models,
+                          stream=stream, timeout=timeout, fallback=fallback)
 
+    def list_for_namespace(self, namespace, marker=None, limit=None,
+                           as_models=False, stream=False, timeout=None):
+        options = self._get_options_object(marker=marker, limit=limit)
+        namespace = self._normalize_namespace(namespace)
         path = '%s%s' % (self.configuration_path, namespace)
 
-        return self.request('GET', path, options=options)
+        def fallback(catalog):
+            return catalog.list_configuration_page(namespace=namespace,
+                                                   marker=marker,
+                                                   limit=limit)
 
-    def get(self, configuration_id):
+        return self._list(path, options, ConfigurationValue,
+                          as_models=as_models, stream=stream,
+                          timeout=timeout, fallback=fallback)
+
+    def get(self, configuration_id, timeout=None):
         path = '%s/%s' % (self.configuration_path, configuration_id)
-        return self.request('GET', path)
+        key = (CONFIGURATION, configuration_id.lstrip('/'))
+
+        def fallback(catalog):
+            return catalog.get_configuration(configuration_id)
 
-    def set(self, configuration_id, value):
+        return self._get_checking_misses(key, path, timeout=timeout,
+                                         fallback=fallback)
+
+    def set(self, configuration_id, value, timeout=None):
         path = '%s/%s' % (self.configuration_path, configuration_id)
         payload = {'value': value}
 
-        return self.request('PUT', path, payload=payload)
+        try:
+            return self.request('PUT', path, payload=payload,
+                                timeout=timeout)
+        finally:
+            self._invalidate_misses((CONFIGURATION,
+                                     configuration_id.lstrip('/')))
 
-    def remove(self, configuration_id):
+    def remove(self, configuration_id, timeout=None):
         path = '%s/%s' % (self.configuration_path, configuration_id)
-        return self.request('DELETE', path)
+        return self.request('DELETE', path, timeout=timeout)
+
+    def write_behind(self, window=CONFIGURATION_WRITE_WINDOW,
+                     max_concurrency=DEFAULT_MAX_WORKERS, on_error=None):
+        """
+        Return a L{WriteBehindBuffer} with the set() and remove() methods
+        of this client, which only writes the last value of every id within
+        C{window} seconds, in the background.
+
+        @param on_error: Called as C{on_error(configuration_id, exception)}
+        for every write which fails.
+        @type on_error: C{callable}
+        @rtype: L{WriteBehindBuffer}
+        """
+        return WriteBehindBuffer(self, window=window,
+                                 max_concurrency=max_concurrency,
+                                 on_error=on_error)
+
+    def export(self, namespace, fp, limit=None):
+        """
+        Write every value in a namespace to a file-like object as
+        newline-delimited JSON, one {"id": ..., "value": ...} object per
+        line, fetching one page at a time.
+
+        @return: Number of values written.
+        @rtype: C{int}
+        """
+        count = 0
+
+        for page in self._iterate_pages(self.list_for_namespace, namespace,
+                                        limit=limit):
+            for value in page['values']:
+                fp.write(json.dumps({'id': value['id'],
+                                     'value': value['value']}) + '\n')
+                count += 1
+
+        return count
+
+    def sync(self, desired_tree, namespace=None, remove=True,
+             max_concurrency=DEFAULT_MAX_WORKERS, dry_run=False):
+        """
+        Bring the remote configuration in line with C{desired_tree},
+        issuing only the set and remove calls which are needed, at most
+        C{max_concurrency} at a time.
+
+        @param desired_tree: Desired values by configuration id. Nested
+        dictionaries are namespaces, so {'api': {'key-1': 'a'}} is the same
+        as {'/api/key-1': 'a'}. Ids are reported with a leading slash.
+        @type desired_tree: C{dict}
+        @param namespace: Only compare against (and remove from) this
+        namespace. Pass '/' to sync the whole configuration.
+        @type namespace: C{str}
+        @param remove: Remove remote values which are not in the tree. This
+        requires a namespace, so that an empty or partial tree can't remove
+        the whole configuration by accident.
+        @type remove: C{bool}
+        @param max_concurrency: Maximum number of calls in flight.
+        @type max_concurrency: C{int}
+        @param dry_run: Only report what would change.
+        @type dry_run: C{bool}
+
+        @return: A report with the 'created', 'updated', 'removed' and
+        'unchanged' configuration ids and an 'errors' dictionary mapping the
+        ids of the failed calls to their exception.
+        @rtype: C{dict}
+        """
+        desired = self._flatten_tree(desired_tree)
+
+        if remove and not namespace:
+            raise ValueError('Removing values requires a namespace, '
+                             'pass namespace=\'/\' to sync the whole '
+                             'configuration')
+
+        if namespace:
+            namespace = self._normalize_namespace(namespace)
+
+        if namespace and namespace != '/':
+            pages = self._iterate_pages(self.list_for_namespace, namespace)
+
+            for configuration_id in desired:
+                if not configuration_id.startswith(namespace):
+                    raise ValueError('%s is not in namespace %s' %
+                                     (configuration_id, namespace))
+        else:
+            pages = self._iterate_pages(self.list)
+
+        current = {}
+        remote_ids = {}
+
+        for page in pages:
+            for value in page['values']:
+                configuration_id = '/%s' % (value['id'].lstrip('/'))
+                current[configuration_id] = value['value']
+                remote_ids[configuration_id] = value['id']
+
+        report = {'created': [], 'updated': [], 'removed': [],
+                  'unchanged': [], 'errors': {}}
+        calls = []
+
+        for configuration_id in sorted(desired.keys()):
+            value = desired[configuration_id]
+
+            if configuration_id not in current:
+                report['created'].append(configuration_id)
+            elif current[configuration_id] != value:
+                report['updated'].append(configuration_id)
+            else:
+                report['unchanged'].append(configuration_id)
+                continue
+
+            calls.append((self.set, configuration_id, value))
+
+        if remove:
+            for configuration_id in sorted(current.keys()):
+                if configuration_id not in desired:
+                    report['removed'].append(configuration_id)
+                    calls.append((self.remove, remote_ids[configuration_id]))
+
+        if dry_run:
+            return report
+
+        def call(args):
+            return args[0](*args[1:])
+
+        for args, _, error in self._call_concurrently(call, calls,
+                                                      max_concurrency):
+            if error:
+                report['errors']['/%s' % (args[1].lstrip('/'))] = error
+
+        return report
+
+    def _flatten_tree(self, tree, prefix=''):
+        values = {}
+
+        for key, value in tree.iteritems():
+            key = '%s/%s' % (prefix, key.strip('/'))
+
+            if isinstance(value, dict):
+                values.update(self._flatten_tree(value, key))
+            else:
+                values[key] = value
+
+        return values
+
+    def _normalize_namespace(self, namespace):
+        if namespace[0] != '/':
+            namespace = '/%s' % (namespace)
+
+        if namespace[len(namespace) - 1] != '/':
+            namespace += '/'
+
+        return namespace
 
 
 class AccountClient(BaseClient):
-    def __init__(self, base_url, username, api_key, region):
+    def __init__(self, base_url, username, api_key, region, **kwargs):
         super(AccountClient, self).__init__(base_url, username,
-                                            api_key, region)
+                                            api_key, region, **kwargs)
         self.limits_path = '/limits'
 
-    def get_limits(self):
-        return self.request('GET', self.limits_path)
+    def get_limits(self, timeout=None):
+        return self.request('GET', self.limits_path, timeout=timeout)
 
 
 class Client(object):
     """
     The main client to be instantiated by the user.
+
+    A single instance can be shared by any number of threads. All the
+    sub-clients share one auth token, one HTTP connection pool and one
+    bounded pool of worker threads.
     """
     def __init__(self, username, api_key,
-                 base_url=DEFAULT_API_URL, region='us'):
+                 base_url=DEFAULT_API_URL, region='us', coalesce_gets=True,
+                 max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 snapshot_path=None, session=None, executor=None,
+                 endpoints=None, rate_limiter=None,
+                 registration_limiter=None, authenticator=None,
+                 priority_limiter=None, negative_cache_ttl=None,
+                 events_marker=None, snapshot_interval=None):
         """
         @param username: Rackspace username.
         @type username: C{str}
         @param api_key: Rackspace API key.
         @type api_key: C{str}
-        @param base_url: The base Cloud Registry URL.
-        @type base_url: C{str}
+        @param base_url: The base Cloud Registry URL, or a list of URLs of
+        several registry endpoints. With more than one, every request goes
+        to the healthy endpoint with the lowest round-trip time and fails
+        over to the next one on connection errors and 5xx responses.
+        @type base_url: C{str} or C{list}
         @param region: Rackspace region.
         @type region: C{str}
+        @param coalesce_gets: Share one HTTP request between concurrent
+        identical GET requests.
+        @type coalesce_gets: C{bool}
+        @param max_workers: Size of the worker pool used by submit(), map()
+        and the *_async methods, and of the HTTP connection pool.
+        @type max_workers: C{int}
+        @param timeout: Socket timeout in seconds for connecting and for
+        every read of every request, None to wait forever.
+        @type timeout: C{float}
+        @param snapshot_path: If given, C{catalog} serves lookups from the
+        snapshot stored in this file right away, while it is refreshed from
+        the registry in the background. The services and configuration
+        lookups and listings fall back to it when the registry can't be
+        reached or fails with a 5xx response.
+        @type snapshot_path: C{str}
+        @param session: HTTP session, or any transport with the same
+        request() method (see L{service_registry.transport}), to use instead
+        of creating one. It is not closed by close().
+        @type session: C{requests.Session}
+        @param executor: Worker pool to use instead of creating one. It is
+        not shut down by close().
+        @type executor: C{concurrent.futures.Executor}
+        @param endpoints: Endpoint set to use instead of building one from
+        C{base_url}.
+        @type endpoints: L{EndpointSet}
+        @param rate_limiter: Rate budget shared by all the requests of this
+        client, heartbeats excepted.
+        @type rate_limiter: L{RateLimiter}
+        @param registration_limiter: Admission limit on the number of
+        services being created at once by services.create() and
+        services.register().
+        @type registration_limiter: L{ConcurrencyLimiter}
+        @param authenticator: Auth token holder to use instead of
+        authenticating with C{username} and C{api_key}.
+        @type authenticator: L{Authenticator}
+        @param priority_limiter: Admission limit on the number of requests
+        in flight, which lets heartbeats and service creation through
+        before single reads and writes, and those before listings.
+        @type priority_limiter: L{PriorityLimiter}
+        @param negative_cache_ttl: If given, services.get() and
+        configuration.get() remember for this many seconds which ids don't
+        exist and raise the same not found error again without a request.
+        Creating or setting an id through this client, or an event about it
+        seen by C{events_poller}, makes it looked up again.
+        @type negative_cache_ttl: C{float}
+        @param events_marker: Id of a recent event, for example the
+        C{marker} of C{events_poller} saved by an earlier run. The poller
+        looks for the head of the events feed from there instead of reading
+        the whole feed.
+        @type events_marker: C{str}
+        @param snapshot_interval: If given along with C{snapshot_path}, the
+        snapshot is refreshed again every this many seconds in a background
+        thread.
+        @type snapshot_interval: C{float}
         """
         self.username = username
         self.api_key = api_key
         self.base_url = base_url
         self.region = region
 
-        self.services = ServicesClient(self.base_url, self.username,
-                                       self.api_key, self.region)
+        self.max_workers = max_workers
+
+        self.authenticator = authenticator or Authenticator(username,
+                                                            api_key, region)
+        self._owns_session = session is None
+        self._owns_executor = executor is None
+        self._owns_endpoints = endpoints is None
+
+        self.session = session or create_session(max_workers)
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.endpoints = endpoints or EndpointSet(base_url,
+                                                  session=self.session)
+        self.rate_limiter = rate_limiter
+        self.priority_limiter = priority_limiter
+        self.negative_cache = None
+        self.events_marker = events_marker
+
+        self.catalog = None
+
+        if negative_cache_ttl:
+            self.negative_cache = NegativeCache(ttl=negative_cache_ttl)
+
+        if snapshot_path:
+            self.catalog = Catalog(self, snapshot_path,
+                                   interval=snapshot_interval)
+
+        kwargs = {'coalesce_gets': coalesce_gets,
+                  'authenticator': self.authenticator,
+                  'session': self.session,
+                  'executor': self.executor,
+                  'endpoints': self.endpoints,
+                  'timeout': timeout,
+                  'rate_limiter': rate_limiter,
+                  'priority_limiter': priority_limiter,
+                  'negative_cache': self.negative_cache,
+                  'catalog': self.catalog}
+
+        self.services = ServicesClient(
+            self.base_url, self.username, self.api_key, self.region,
+            registration_limiter=registration_limiter, **kwargs)
         self.events = EventsClient(self.base_url, self.username,
-                                   self.api_key, self.region)
+                                   self.api_key, self.region, **kwargs)
         self.configuration = ConfigurationClient(self.base_url,
                                                  self.username,
                                                  self.api_key,
-                                                 self.region)
+                                                 self.region, **kwargs)
         self.account = AccountClient(self.base_url, self.username,
-                                     self.api_key, self.region)
+                                     self.api_key, self.region, **kwargs)
+
+        self._events_poller = None
+        self._events_poller_lock = threading.Lock()
+
+        # Registered after the sub-clients, so they are reset first.
+        forksafe.register(self)
+
+        if self.catalog:
+            self.catalog.load()
+            self.catalog.refresh_async()
+
+            if snapshot_interval:
+                self.catalog.start_thread()
+
+    @property
+    def events_poller(self):
+        """
+        The L{EventsPoller} shared by everything using this client, started
+        in a background thread on first use.
+        """
+        forksafe.check()
+
+        if self._events_poller is None:
+            self._events_poller_lock.acquire()
+            try:
+                if self._events_poller is None:
+                    poller = EventsPoller(self, marker=self.events_marker)
+
+                    poller.add_listener(self.services.handle_event)
+
+                    if self.negative_cache is not None:
+                        poller.add_listener(self.negative_cache.handle_event)
+
+                    poller.start_thread()
+                    self._events_poller = poller
+            finally:
+                self._events_poller_lock.release()
+
+        return self._events_poller
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Call C{fn(client, *args, **kwargs)} on the worker pool.
+
+        @rtype: C{concurrent.futures.Future}
+        """
+        forksafe.check()
+        return self.executor.submit(bind(fn), self, *args, **kwargs)
+
+    def map(self, fn, *iterables, **kwargs):
+        """
+        Call C{fn(client, *items)} for every item of the iterables on the
+        worker pool and return an iterator over the results, in order.
+
+        @param timeout: Maximum number of seconds to wait for the results.
+        @type timeout: C{float}
+        """
+        forksafe.check()
+
+        def call(*items):
+            return fn(self, *items)
+
+        return self.executor.map(bind(call), *iterables, **kwargs)
+
+    def _after_fork(self):
+        # The worker threads don't exist in the child and the pooled
+        # connections share their sockets with the parent. Resources which
+        # were passed in are rebuilt by their owner.
+        session = self.session
+        executor = self.executor
+
+        if self._owns_session:
+            session = create_session(self.max_workers)
+
+        if self._owns_executor:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        self._set_transport(session, executor)
+
+        if self._owns_endpoints:
+            self.endpoints.session = session
+
+        self._events_poller_lock = threading.Lock()
+
+    def _set_transport(self, session, executor):
+        self.session = session
+        self.executor = executor
+
+        for sub_client in (self.services, self.events, self.configuration,
+                           self.account):
+            sub_client.session = session
+            sub_client._executor = executor
+
+    def deadline(self, timeout):
+        """
+        Context manager giving everything the current thread does inside it,
+        including calls submitted to the worker pool, a total time budget
+        of C{timeout} seconds. L{DeadlineExceededError} is raised once it
+        is spent.
+
+            with client.deadline(10):
+                client.services.register('my-service-1', 30)
+        """
+        return deadline(timeout)
+
+    def close(self):
+        """
+        Wait for all the submitted calls to finish and release the worker
+        threads and HTTP connections, unless they were passed in.
+        """
+        if self._events_poller:
+            self._events_poller.stop()
+
+        if self.catalog:
+            self.catalog.stop()
+
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,310 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Column oriented view of the service catalog.
+
+Every column is a compact array: numeric columns (heartbeat_timeout,
+last_seen) are arrays of doubles with NaN for missing values and all the
+other columns (id, tags and one 'metadata.<key>' column per metadata key)
+are arrays of codes into a table of their distinct values, -1 standing for
+a missing value. Counting services by region or version only touches the
+codes of one column.
+
+Binary file layout, integers little-endian:
+
+    magic               8 bytes, 'SRCOL001'
+    rows, columns       uint32 each
+    for every column:
+        name            uint16 length + UTF-8
+        kind            1 byte, 'd' for numeric or 's' for encoded
+        numeric         rows doubles
+        encoded         uint32 value count, every value as uint32
+                        length + UTF-8, then rows int32 codes
+"""
+
+__all__ = [
+    'ServiceColumns',
+    'read_columnar',
+    'get_csv_names',
+    'get_csv_row',
+    'write_csv_header',
+    'write_csv_row'
+]
+
+import sys
+import array
+import struct
+
+from constants import COLUMNAR_TAG_SEPARATOR
+
+MAGIC = 'SRCOL001'
+NUMERIC, ENCODED = 'd', 's'
+NUMERIC_COLUMNS = ('heartbeat_timeout', 'last_seen')
+FIXED_COLUMNS = ('id', 'heartbeat_timeout', 'last_seen', 'tags')
+METADATA_PREFIX = 'metadata.'
+NAN = float('nan')
+
+
+class Column(object):
+    def __init__(self, name, kind, rows=0):
+        self.name = name
+        self.kind = kind
+
+        if kind == NUMERIC:
+            self.data = array.array('d', [NAN]) * rows
+        else:
+            self.data = array.array('i', [-1]) * rows
+            self.values = []
+            self.codes = {}
+
+    def append(self, value):
+        if self.kind == NUMERIC:
+            self.data.append(NAN if value is None else float(value))
+            return
+
+        if value is None:
+            self.data.append(-1)
+            return
+
+        code = self.codes.get(value, None)
+
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+
+        self.data.append(code)
+
+    def get(self, index):
+        value = self.data[index]
+
+        if self.kind == NUMERIC:
+            return None if value != value else value
+
+        return None if value == -1 else self.values[value]
+
+
+class ServiceColumns(object):
+    def __init__(self):
+        """
+        Column arrays built one service at a time with append().
+        """
+        self.rows = 0
+        self.columns = {}
+        self.names = []
+
+        for name in FIXED_COLUMNS:
+            self._add_column(name, NUMERIC if name in NUMERIC_COLUMNS
+                             else ENCODED)
+
+    def append(self, service):
+        """
+        Add a service dictionary (or L{Service}) as a new row.
+        """
+        if not isinstance(service, dict):
+            service = service.to_dict()
+
+        values = {'id': service.get('id', None),
+                  'heartbeat_timeout': service.get('heartbeat_timeout', None),
+                  'last_seen': service.get('last_seen', None),
+                  'tags': join_tags(service.get('tags', None))}
+
+        for key, value in (service.get('metadata', None) or {}).iteritems():
+            values[METADATA_PREFIX + key] = value
+
+        for name in values:
+            if name not in self.columns:
+                self._add_column(name, ENCODED)
+
+        for name in self.names:
+            self.columns[name].append(values.get(name, None))
+
+        self.rows += 1
+
+    def column(self, name):
+        """
+        Return the values of a column as a list, None for missing values.
+        """
+        column = self.columns[name]
+        return [column.get(index) for index in xrange(self.rows)]
+
+    def row(self, index):
+        return [self.columns[name].get(index) for name in self.names]
+
+    def value_counts(self, name):
+        """
+        Return a dictionary mapping every value of an encoded column (None
+        for missing) to the number of rows which have it.
+        """
+        column = self.columns[name]
+
+        if column.kind != ENCODED:
+            raise ValueError('%s is not an encoded column' % (name))
+
+        counts = [0] * (len(column.values) + 1)
+
+        for code in column.data:
+            counts[code] += 1
+
+        result = dict(zip(column.values, counts))
+
+        if counts[-1]:
+            result[None] = counts[-1]
+
+        return result
+
+    def write(self, fp):
+        """
+        Write the columns to a binary file, see the module documentation.
+        """
+        fp.write(MAGIC)
+        fp.write(struct.pack('<II', self.rows, len(self.names)))
+
+        for name in self.names:
+            column = self.columns[name]
+            _write_string(fp, name, '<H')
+            fp.write(column.kind)
+
+            if column.kind == ENCODED:
+                fp.write(struct.pack('<I', len(column.values)))
+
+                for value in column.values:
+                    _write_string(fp, value, '<I')
+
+            _write_array(fp, column.data)
+
+    def write_csv(self, writer):
+        """
+        Write a header and one row per service to a C{csv.writer}.
+        """
+        write_csv_header(writer, self.names)
+
+        for index in xrange(self.rows):
+            write_csv_row(writer, self.row(index))
+
+    def _add_column(self, name, kind):
+        self.columns[name] = Column(name, kind, self.rows)
+        self.names.append(name)
+
+
+def read_columnar(fp):
+    """
+    Read a file written by L{ServiceColumns.write}.
+
+    @rtype: L{ServiceColumns}
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columnar services file')
+
+    result = ServiceColumns()
+    result.names = []
+    result.columns = {}
+    result.rows, count = struct.unpack('<II', fp.read(8))
+
+    for _ in xrange(count):
+        name = _read_string(fp, '<H')
+        kind = fp.read(1)
+        column = Column(name, kind)
+
+        if kind == ENCODED:
+            length, = struct.unpack('<I', fp.read(4))
+            column.values = [_read_string(fp, '<I') for _ in xrange(length)]
+            column.codes = dict([(value, code) for code, value
+                                 in enumerate(column.values)])
+
+        column.data = _read_array(fp, column.data.typecode, result.rows)
+        result.columns[name] = column
+        result.names.append(name)
+
+    return result
+
+
+def get_csv_names(metadata_keys):
+    return list(FIXED_COLUMNS) + [METADATA_PREFIX + key
+                                  for key in metadata_keys]
+
+
+def get_csv_row(service, metadata_keys):
+    """
+    Return the values of a service dictionary for the columns returned by
+    get_csv_names().
+    """
+    metadata = service.get('metadata', None) or {}
+
+    return [service.get('id', None), service.get('heartbeat_timeout', None),
+            service.get('last_seen', None),
+            join_tags(service.get('tags', None))] + \
+        [metadata.get(key, None) for key in metadata_keys]
+
+
+def join_tags(tags):
+    if tags is None:
+        return None
+
+    return COLUMNAR_TAG_SEPARATOR.join(tags)
+
+
+def write_csv_header(writer, names):
+    writer.writerow([_encode(name) for name in names])
+
+
+def write_csv_row(writer, values):
+    writer.writerow(['' if value is None else _encode(value)
+                     for value in values])
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+
+    return str(value)
+
+
+def _write_string(fp, value, length_format):
+    if not isinstance(value, basestring):
+        value = unicode(value)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    fp.write(struct.pack(length_format, len(value)))
+    fp.write(value)
+
+
+def _read_string(fp, length_format):
+    length, = struct.unpack(length_format,
+                            fp.read(struct.calcsize(length_format)))
+    return fp.read(length).decode('utf-8')
+
+
+def _write_array(fp, data):
+    if sys.byteorder == 'big':
+        data = array.array(data.typecode, data)
+        data.byteswap()
+
+    fp.write(data.tostring())
+
+
+def _read_array(fp, typecode, length):
+    data = array.array(typecode)
+    data.fromstring(fp.read(data.itemsize * length))
+
+    if sys.byteorder == 'big':
+        data.byteswap()
+
+    return data
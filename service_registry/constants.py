@@ -21,6 +21,68 @@ DEFAULT_AUTH_URLS = {'us': US_AUTH_URL,
 DEFAULT_API_URL = 'https://dfw.registry.api.rackspacecloud.com/v1.0/'
 MAX_HEARTBEAT_TIMEOUT = 120
 MAX_401_RETRIES = 1
+DEFAULT_MAX_WORKERS = 10
+STREAM_CHUNK_SIZE = 8192
+DEFAULT_TIMEOUT = 30
+
+# Multi-endpoint selection, all values in seconds.
+ENDPOINT_PROBE_INTERVAL = 60
+ENDPOINT_PROBE_TIMEOUT = 5
+ENDPOINT_RETRY_DELAY = 10
+ENDPOINT_MAX_RETRY_DELAY = 300
+# Requests that may be sent again to the next endpoint after a 5xx response
+# or a timeout. Others fail over only if they couldn't be sent at all.
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+# The agent socket lives in a directory of its user's own, so other users
+# can neither connect to it nor put another socket in its place.
+AGENT_SOCKET_DIR = '/tmp/service-registry-%(uid)d'
+AGENT_SOCKET_NAME = 'agent.sock'
+AGENT_TIMEOUT = 10
+AGENT_REGISTER_WAIT = 5
+
+# Number of heartbeat round-trip times kept per service.
+HEARTBEAT_RTT_WINDOW = 100
+# Upper bounds of the heartbeat margin histogram buckets, as fractions of
+# the heartbeat timeout.
+HEARTBEAT_MARGIN_BUCKETS = (0, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0)
+# Largest fraction of the interval by which the first heartbeat of a
+# service is brought forward to spread services out of phase.
+HEARTBEAT_PHASE_SPREAD = 0.5
+# Seconds between attempts to send a heartbeat which failed with a
+# connection error or a timeout.
+HEARTBEAT_RETRY_DELAY = 1
+
+DRAIN_TIMEOUT = 5
+DRAIN_MAX_CONCURRENCY = 50
+
+EVENT_LOG_SEGMENT_SIZE = 16 * 1024 * 1024
+# Number of events between two entries of an event log segment index.
+EVENT_LOG_INDEX_INTERVAL = 64
+
+EVENTS_POLLER_MIN_INTERVAL = 1
+EVENTS_POLLER_MAX_INTERVAL = 60
+EVENTS_POLLER_QUEUE_SIZE = 1000
+
+# Joins the tags of a service in columnar and CSV exports.
+COLUMNAR_TAG_SEPARATOR = ','
+
+# Seconds configuration writes are buffered for by write-behind buffers.
+CONFIGURATION_WRITE_WINDOW = 0.5
+
+# Seconds and number of not found lookups remembered by negative caches.
+NEGATIVE_CACHE_TTL = 5
+NEGATIVE_CACHE_SIZE = 1000
+
+# Number of distinct tags, metadata keys and event types models share a
+# single copy of.
+INTERNED_STRINGS_SIZE = 10000
+
+# Number of services whose last sent payload update_many() remembers.
+KNOWN_PAYLOADS_SIZE = 1000
+
+# Re-authenticate this many seconds before the auth token actually expires.
+AUTH_TOKEN_EXPIRY_MARGIN = 60
 
 
 ACCEPTABLE_STATUS_CODES = {'GET': (httplib.OK,),
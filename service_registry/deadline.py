@@ -0,0 +1,131 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deadlines put a single time budget on everything a thread does inside a
+deadline() block: authentication, retries, failover and every page of a
+paginated listing.
+
+    with deadline(5):
+        client.services.register('web-1', 30)
+"""
+
+__all__ = [
+    'Deadline',
+    'deadline',
+    'get_deadline',
+    'bind'
+]
+
+import threading
+
+from contextlib import contextmanager
+from time import time
+
+from errors import DeadlineExceededError
+
+_local = threading.local()
+
+
+class Deadline(object):
+    __slots__ = ('expires',)
+
+    def __init__(self, timeout):
+        self.expires = time() + timeout
+
+    def remaining(self):
+        return self.expires - time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        """
+        Raise L{DeadlineExceededError} if the deadline has passed.
+        """
+        if self.expired():
+            raise DeadlineExceededError('Deadline exceeded')
+
+    def get_timeout(self, timeout=None):
+        """
+        Return the smaller of C{timeout} and the remaining time.
+        """
+        self.check()
+        remaining = self.remaining()
+
+        if timeout is None:
+            return remaining
+
+        return min(timeout, remaining)
+
+
+def get_deadline():
+    """
+    Return the innermost active L{Deadline} of the current thread, or None.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def deadline(timeout):
+    """
+    Run the block with a deadline of C{timeout} seconds. A nested deadline
+    can only make the time budget smaller, never larger.
+    """
+    current = get_deadline()
+    new = Deadline(timeout)
+
+    if current and current.expires < new.expires:
+        new = current
+
+    _push(new)
+
+    try:
+        yield new
+    finally:
+        _pop()
+
+
+def bind(fn):
+    """
+    Wrap C{fn} so it runs under the current thread's deadline, whichever
+    thread ends up calling it.
+    """
+    current = get_deadline()
+
+    if not current:
+        return fn
+
+    def wrapped(*args, **kwargs):
+        _push(current)
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _pop()
+
+    return wrapped
+
+
+def _push(value):
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    _local.stack.append(value)
+    return value
+
+
+def _pop():
+    _local.stack.pop()
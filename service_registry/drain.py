@@ -0,0 +1,197 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Graceful shutdown: stop heartbeating and remove every service this process
+has created, in parallel, so consumers stop routing to it right away
+instead of after the heartbeat timeout.
+
+    from service_registry import drain
+    drain.install()
+"""
+
+__all__ = [
+    'drain',
+    'install',
+    'get_active'
+]
+
+import os
+import atexit
+import signal
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import forksafe
+
+from constants import DRAIN_TIMEOUT, DRAIN_MAX_CONCURRENCY
+from deadline import bind, deadline
+from errors import DeadlineExceededError
+
+
+class _ActiveServices(object):
+    """
+    Heartbeaters of the services created and not yet removed by this
+    process, keyed by service id.
+    """
+    def __init__(self):
+        # Reentrant, as the signal handler drains on the main thread, which
+        # may already hold the lock in track() or untrack().
+        self.lock = threading.RLock()
+        self.heartbeaters = {}
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # The services inherited over a fork belong to the parent.
+        self.lock = threading.RLock()
+        self.heartbeaters = {}
+
+
+_active = _ActiveServices()
+
+
+def track(heartbeater):
+    """
+    Remember a heartbeater whose service has just been created.
+    """
+    forksafe.check()
+
+    _active.lock.acquire()
+    try:
+        _active.heartbeaters[heartbeater.service_id] = heartbeater
+    finally:
+        _active.lock.release()
+
+
+def untrack(service_id):
+    """
+    Forget a service which has been removed.
+    """
+    forksafe.check()
+
+    _active.lock.acquire()
+    try:
+        return _active.heartbeaters.pop(service_id, None)
+    finally:
+        _active.lock.release()
+
+
+def get_active():
+    """
+    Return the heartbeaters of all the services this process has created
+    and not removed yet.
+    """
+    forksafe.check()
+
+    _active.lock.acquire()
+    try:
+        return list(_active.heartbeaters.values())
+    finally:
+        _active.lock.release()
+
+
+def drain(timeout=DRAIN_TIMEOUT, remove=True,
+          max_concurrency=DRAIN_MAX_CONCURRENCY):
+    """
+    Stop all the heartbeaters of this process and remove their services in
+    parallel, giving up after C{timeout} seconds.
+
+    @param timeout: Total time budget in seconds.
+    @type timeout: C{float}
+    @param remove: Remove the services from the registry. If False they are
+    only left to time out.
+    @type remove: C{bool}
+    @param max_concurrency: Maximum number of removals in flight.
+    @type max_concurrency: C{int}
+
+    @return: Dictionary mapping every service id to None if it has been
+    removed or to the exception which prevented it.
+    @rtype: C{dict}
+    """
+    forksafe.check()
+
+    _active.lock.acquire()
+    try:
+        heartbeaters = _active.heartbeaters.values()
+        _active.heartbeaters.clear()
+    finally:
+        _active.lock.release()
+
+    for heartbeater in heartbeaters:
+        heartbeater.stop()
+
+    results = {}
+
+    if not remove or not heartbeaters:
+        return results
+
+    def remove_service(heartbeater):
+        path = '/services/%s' % (heartbeater.service_id)
+        heartbeater.request('DELETE', path)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_concurrency,
+                                                  len(heartbeaters)))
+
+    try:
+        with deadline(timeout) as current:
+            futures = dict([(executor.submit(bind(remove_service),
+                                             heartbeater),
+                             heartbeater.service_id)
+                            for heartbeater in heartbeaters])
+            wait(futures.keys(), timeout=max(current.remaining(), 0))
+    finally:
+        executor.shutdown(wait=False)
+
+    for future, service_id in futures.iteritems():
+        if not future.done():
+            future.cancel()
+            results[service_id] = DeadlineExceededError('Deadline exceeded')
+        else:
+            results[service_id] = future.exception()
+
+    return results
+
+
+def install(signals=(signal.SIGTERM,), use_atexit=True,
+            timeout=DRAIN_TIMEOUT):
+    """
+    Drain when the process receives one of C{signals} and, if
+    C{use_atexit} is True, when the interpreter exits.
+
+    After draining on a signal the previous handler is called, or, if there
+    was none, the signal is delivered again with the default action.
+    """
+    for signum in signals:
+        previous = signal.getsignal(signum)
+        signal.signal(signum, _get_signal_handler(previous, timeout))
+
+    if use_atexit:
+        atexit.register(drain, timeout=timeout)
+
+
+def _get_signal_handler(previous, timeout):
+    def handler(signum, frame):
+        drain(timeout=timeout)
+
+        if callable(previous):
+            return previous(signum, frame)
+
+        if previous == signal.SIG_IGN:
+            return
+
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    return handler
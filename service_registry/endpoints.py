@@ -0,0 +1,209 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'Endpoint',
+    'EndpointSet'
+]
+
+import threading
+import requests
+
+from time import time
+
+import forksafe
+
+from constants import ENDPOINT_PROBE_INTERVAL, ENDPOINT_PROBE_TIMEOUT
+from constants import ENDPOINT_RETRY_DELAY, ENDPOINT_MAX_RETRY_DELAY
+
+# Weight of a new probe sample in the smoothed RTT.
+RTT_SMOOTHING = 0.3
+
+
+class Endpoint(object):
+    __slots__ = ('url', 'rtt', 'failures', 'down_until')
+
+    def __init__(self, url):
+        if not url.endswith('/'):
+            url += '/'
+
+        self.url = url
+        self.rtt = None
+        self.failures = 0
+        self.down_until = 0
+
+    def is_healthy(self, now=None):
+        return self.down_until <= (now or time())
+
+    def __repr__(self):
+        return '<Endpoint url=%s, rtt=%s, failures=%s>' % (self.url, self.rtt,
+                                                           self.failures)
+
+
+class EndpointSet(object):
+    def __init__(self, urls, session=None,
+                 probe_interval=ENDPOINT_PROBE_INTERVAL,
+                 probe_timeout=ENDPOINT_PROBE_TIMEOUT,
+                 retry_delay=ENDPOINT_RETRY_DELAY):
+        """
+        A list of registry endpoints ordered by health and round-trip time.
+
+        Round-trip times are measured by periodically probing every endpoint
+        in the background. Endpoints which fail are skipped for
+        C{retry_delay} seconds, doubling on every consecutive failure.
+
+        @param urls: Base Cloud Registry URLs.
+        @type urls: C{list}
+        @param session: HTTP session used for probing.
+        @type session: C{requests.Session}
+        @param probe_interval: Seconds between two probes of the endpoints.
+        @type probe_interval: C{float}
+        @param probe_timeout: Timeout for a single probe request.
+        @type probe_timeout: C{float}
+        @param retry_delay: Seconds a failed endpoint is skipped for.
+        @type retry_delay: C{float}
+        """
+        if isinstance(urls, basestring):
+            urls = [urls]
+
+        if not urls:
+            raise ValueError('At least one endpoint URL is required')
+
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.session = session or requests.Session()
+        self._owns_session = session is None
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._last_probe = None
+        self._probing = False
+        forksafe.register(self)
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def ordered(self):
+        """
+        Return the endpoints in the order they should be tried: healthy
+        endpoints by ascending RTT, then unhealthy ones as a last resort.
+        """
+        if len(self.endpoints) == 1:
+            return list(self.endpoints)
+
+        self._maybe_probe()
+
+        now = time()
+        healthy = []
+        unhealthy = []
+
+        for index, endpoint in enumerate(self.endpoints):
+            if endpoint.is_healthy(now):
+                # Endpoints which have not been probed yet keep the
+                # configured order, after the ones which have.
+                rtt = endpoint.rtt if endpoint.rtt is not None else \
+                    float('inf')
+                healthy.append((rtt, index, endpoint))
+            else:
+                unhealthy.append((endpoint.down_until, index, endpoint))
+
+        healthy.sort()
+        unhealthy.sort()
+        return [item[2] for item in healthy + unhealthy]
+
+    def record_success(self, endpoint):
+        endpoint.failures = 0
+        endpoint.down_until = 0
+
+    def record_failure(self, endpoint):
+        endpoint.failures += 1
+        delay = self.retry_delay * (2 ** (endpoint.failures - 1))
+        endpoint.down_until = time() + min(delay, ENDPOINT_MAX_RETRY_DELAY)
+
+    def record_rtt(self, endpoint, rtt):
+        if endpoint.rtt is None:
+            endpoint.rtt = rtt
+        else:
+            endpoint.rtt = ((1 - RTT_SMOOTHING) * endpoint.rtt +
+                            RTT_SMOOTHING * rtt)
+
+    def probe(self):
+        """
+        Measure the round-trip time to every endpoint, in parallel.
+
+        Any HTTP response counts as a successful probe, an endpoint which
+        can't be reached is marked as failed.
+        """
+        threads = [threading.Thread(target=self._probe_endpoint,
+                                    args=(endpoint,))
+                   for endpoint in self.endpoints]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    def _probe_endpoint(self, endpoint):
+        start = time()
+
+        try:
+            self.session.request(method='get', url=endpoint.url,
+                                 timeout=self.probe_timeout)
+        except requests.RequestException:
+            self.record_failure(endpoint)
+            return
+
+        self.record_rtt(endpoint, time() - start)
+        self.record_success(endpoint)
+
+    def _after_fork(self):
+        # A probe running in the parent doesn't exist here, the measured
+        # RTTs and failures are kept.
+        self._lock = threading.Lock()
+        self._probing = False
+
+        if self._owns_session:
+            self.session = requests.Session()
+
+    def _maybe_probe(self):
+        self._lock.acquire()
+        try:
+            if self._probing:
+                return
+
+            if self._last_probe and \
+               (time() - self._last_probe) < self.probe_interval:
+                return
+
+            self._probing = True
+        finally:
+            self._lock.release()
+
+        thread = threading.Thread(target=self._run_probe)
+        thread.daemon = True
+        thread.start()
+
+    def _run_probe(self):
+        try:
+            self.probe()
+        finally:
+            self._lock.acquire()
+            try:
+                self._last_probe = time()
+                self._probing = False
+            finally:
+                self._lock.release()
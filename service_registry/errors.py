@@ -15,7 +15,10 @@
 __all__ = [
     'ValidationError',
     'APIError',
-    'InvalidCredentialsError'
+    'InvalidCredentialsError',
+    'AgentError',
+    'DeadlineExceededError',
+    'ReplayError'
 ]
 
 
@@ -41,3 +44,15 @@ class APIError(Exception):
 
 class InvalidCredentialsError(APIError):
     pass
+
+
+class AgentError(APIError):
+    pass
+
+
+class DeadlineExceededError(APIError):
+    pass
+
+
+class ReplayError(APIError):
+    pass
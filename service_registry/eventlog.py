@@ -0,0 +1,445 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local history of the events feed, so past events can be queried by time,
+type or service without paging through the whole feed again.
+
+    log = EventLog('/var/lib/registry-events', client)
+    log.poll()
+
+    for event in log.query(start=1346967000000, end=1346967300000,
+                           types=['service.join', 'service.remove']):
+        print event.service.id
+
+Events are appended as JSON lines to segment files. Every segment has a
+sparse index file holding the (timestamp, offset) of every
+C{index_interval}-th event, so a range query seeks close to its start
+instead of reading the segment from the beginning. Old segments are
+deleted whole according to the C{max_age} and C{max_bytes} policy.
+"""
+
+__all__ = [
+    'EventLog'
+]
+
+import os
+import errno
+import struct
+import threading
+
+from bisect import bisect_left
+from time import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+import forksafe
+
+from constants import EVENT_LOG_SEGMENT_SIZE, EVENT_LOG_INDEX_INTERVAL
+from models import Event
+
+INDEX_ENTRY = struct.Struct('>qQ')
+
+
+class Segment(object):
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory, '%020d.log' % (number))
+        self.index_path = os.path.join(directory, '%020d.idx' % (number))
+        self.timestamps = []
+        self.offsets = []
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.last_id = None
+        self.size = 0
+        self.unindexed = 0
+
+    def load(self):
+        """
+        Read the index and the events after its last entry, dropping a
+        partly written last line and index entries which point past it.
+        """
+        if os.path.exists(self.index_path):
+            fp = open(self.index_path, 'rb')
+
+            try:
+                data = fp.read()
+            finally:
+                fp.close()
+
+            length = len(data) - len(data) % INDEX_ENTRY.size
+
+            for offset in xrange(0, length, INDEX_ENTRY.size):
+                timestamp, position = INDEX_ENTRY.unpack_from(data, offset)
+                self.timestamps.append(timestamp)
+                self.offsets.append(position)
+
+        if not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+
+        fp = open(self.path, 'rb')
+
+        try:
+            size = os.fstat(fp.fileno()).st_size
+
+            while self.offsets and self.offsets[-1] >= size:
+                self.timestamps.pop()
+                self.offsets.pop()
+
+            position = self.offsets[-1] if self.offsets else 0
+            fp.seek(position)
+            count = 0
+
+            for line in fp:
+                if not line.endswith('\n'):
+                    break
+
+                self._update(json.loads(line))
+                position += len(line)
+                count += 1
+
+            # The first line read is the one the last index entry points to.
+            self.unindexed = count - 1 if self.offsets else count
+        finally:
+            fp.close()
+
+        if self.timestamps:
+            self.first_timestamp = self.timestamps[0]
+
+        self.size = position
+
+        if position < size:
+            fp = open(self.path, 'r+b')
+
+            try:
+                fp.truncate(position)
+            finally:
+                fp.close()
+
+        self._write_index()
+
+    def _update(self, data):
+        timestamp = data.get('timestamp', None) or 0
+
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+
+        self.last_timestamp = max(self.last_timestamp or 0, timestamp)
+        self.last_id = data.get('id', None) or self.last_id
+
+    def _write_index(self):
+        fp = open(self.index_path, 'wb')
+
+        try:
+            for timestamp, offset in zip(self.timestamps, self.offsets):
+                fp.write(INDEX_ENTRY.pack(timestamp, offset))
+        finally:
+            fp.close()
+
+    def iterate(self, start=None, size=None):
+        """
+        Yield every event dictionary of the segment, starting close to the
+        first one at or after C{start}, up to C{size} bytes into the file
+        (the size of the segment when not given). Nothing is yielded if the
+        segment has been removed.
+        """
+        position = 0
+
+        if size is None:
+            size = self.size
+
+        if start is not None:
+            index = bisect_left(self.timestamps, start) - 1
+
+            if index >= 0:
+                position = self.offsets[index]
+
+        try:
+            fp = open(self.path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            return
+
+        try:
+            fp.seek(position)
+
+            for line in fp:
+                if position + len(line) > size:
+                    break
+
+                position += len(line)
+                yield json.loads(line)
+        finally:
+            fp.close()
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class EventLog(object):
+    def __init__(self, directory, client=None, interval=5,
+                 segment_size=EVENT_LOG_SEGMENT_SIZE,
+                 index_interval=EVENT_LOG_INDEX_INTERVAL, max_age=None,
+                 max_bytes=None):
+        """
+        @param directory: Directory holding the segment and index files,
+        created if needed.
+        @type directory: C{str}
+        @param client: Client used by poll() to read the events feed.
+        @type client: L{Client}
+        @param interval: Seconds between two polls of the events feed.
+        @type interval: C{float}
+        @param segment_size: A new segment is started once the current one
+        reaches this many bytes.
+        @type segment_size: C{int}
+        @param index_interval: Number of events between two index entries.
+        @type index_interval: C{int}
+        @param max_age: Delete segments whose newest event is older than
+        this many seconds.
+        @type max_age: C{float}
+        @param max_bytes: Delete the oldest segments while the log is
+        bigger than this.
+        @type max_bytes: C{int}
+        """
+        self.directory = directory
+        self.client = client
+        self.interval = interval
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.segments = []
+        self._file = None
+        self._index_file = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        forksafe.register(self)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        numbers = sorted([int(name[:-len('.log')])
+                          for name in os.listdir(directory)
+                          if name.endswith('.log') and
+                          name[:-len('.log')].isdigit()])
+
+        for number in numbers:
+            segment = Segment(directory, number)
+            segment.load()
+            self.segments.append(segment)
+
+        if not self.segments:
+            self._add_segment(0)
+
+    @property
+    def marker(self):
+        """
+        Id of the last event in the log, where the next poll() resumes.
+        """
+        for segment in reversed(self.segments):
+            if segment.last_id:
+                return segment.last_id
+
+        return None
+
+    @property
+    def size(self):
+        return sum([segment.size for segment in self.segments])
+
+    def append(self, events):
+        """
+        Append events (dictionaries or L{Event}) to the log. They are
+        expected in the order of the feed.
+        """
+        forksafe.check()
+
+        self._lock.acquire()
+        try:
+            self._open()
+            segment = self.segments[-1]
+
+            for event in events:
+                if isinstance(event, Event):
+                    event = event.to_dict()
+
+                line = json.dumps(event, separators=(',', ':')) + '\n'
+
+                if not segment.offsets or \
+                   segment.unindexed >= self.index_interval:
+                    timestamp = max(event.get('timestamp', None) or 0,
+                                    segment.last_timestamp or 0)
+                    segment.timestamps.append(timestamp)
+                    segment.offsets.append(segment.size)
+                    segment.unindexed = 0
+                    self._index_file.write(INDEX_ENTRY.pack(timestamp,
+                                                            segment.size))
+                else:
+                    segment.unindexed += 1
+
+                self._file.write(line)
+                segment.size += len(line)
+                segment._update(event)
+
+                if segment.size >= self.segment_size:
+                    self._flush()
+                    self._add_segment(segment.number + 1)
+                    self._compact()
+                    self._open()
+                    segment = self.segments[-1]
+
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def poll(self):
+        """
+        Append all the events published since the last one in the log and
+        return how many there were.
+        """
+        new_events = list(self.client.events.iterate(self.marker))
+        self.append(new_events)
+        return len(new_events)
+
+    def start(self):
+        """
+        Poll the events feed every C{interval} seconds until stop() is
+        called.
+        """
+        self._stopped.clear()
+
+        while not self._stopped.is_set():
+            self.poll()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop polling.
+        """
+        self._stopped.set()
+
+    def query(self, start=None, end=None, types=None, service_id=None,
+              as_models=True):
+        """
+        Iterate over the events logged between C{start} and C{end}
+        (inclusive, in milliseconds since the epoch like the feed's
+        timestamps), optionally only the ones of the given types or about
+        the given service.
+        """
+        types = set(types) if types else None
+
+        # Only what has been flushed by the time the query starts is read.
+        # Segments deleted by a compaction in the meantime are skipped, the
+        # ones already being read stay readable until they are closed.
+        self._lock.acquire()
+        try:
+            segments = [(segment, segment.size) for segment in self.segments]
+        finally:
+            self._lock.release()
+
+        for segment, size in segments:
+            if segment.last_timestamp is None or \
+               (start is not None and segment.last_timestamp < start):
+                continue
+
+            if end is not None and segment.first_timestamp > end:
+                break
+
+            for event in segment.iterate(start, size):
+                timestamp = event.get('timestamp', None) or 0
+
+                if start is not None and timestamp < start:
+                    continue
+
+                if end is not None and timestamp > end:
+                    break
+
+                if types and event.get('type', None) not in types:
+                    continue
+
+                if service_id is not None and \
+                   (event.get('payload', None) or {}).get('id') != service_id:
+                    continue
+
+                yield Event.from_dict(event) if as_models else event
+
+    def compact(self):
+        """
+        Delete the segments which fall outside of the retention policy. The
+        current segment is always kept.
+        """
+        self._lock.acquire()
+        try:
+            self._compact()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._close_files()
+        finally:
+            self._lock.release()
+
+    def _after_fork(self):
+        # Everything appended has been flushed, the files are reopened by
+        # the next append().
+        self._lock = threading.Lock()
+        self._close_files()
+
+    def _compact(self):
+        if self.max_age is not None:
+            oldest = (time() - self.max_age) * 1000
+
+            while len(self.segments) > 1:
+                if (self.segments[0].last_timestamp or 0) >= oldest:
+                    break
+
+                self.segments.pop(0).remove()
+
+        if self.max_bytes is not None:
+            while len(self.segments) > 1 and self.size > self.max_bytes:
+                self.segments.pop(0).remove()
+
+    def _add_segment(self, number):
+        self._close_files()
+        segment = Segment(self.directory, number)
+        segment.load()
+        self.segments.append(segment)
+
+    def _open(self):
+        if self._file is None:
+            segment = self.segments[-1]
+            self._file = open(segment.path, 'ab')
+            self._index_file = open(segment.index_path, 'ab')
+
+    def _flush(self):
+        self._file.flush()
+        self._index_file.flush()
+
+    def _close_files(self):
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+            self._file = None
+            self._index_file = None
@@ -0,0 +1,113 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Detection of os.fork() so objects can rebuild the state a child process
+can't use: locks which were held by threads of the parent, pooled
+connections whose sockets are shared with it and worker threads which
+don't exist anymore.
+
+Objects register() themselves and check() is called at the entry points of
+the library. The first check() in a new process calls the _after_fork()
+method of every registered object which is still alive, in the order they
+were registered. Other threads calling check() meanwhile wait until every
+object has been reset.
+"""
+
+__all__ = [
+    'register',
+    'check'
+]
+
+import os
+import threading
+import weakref
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_refs = []
+_prune_at = 64
+
+# Serialize the resets by process id, so that the lock of a child is one no
+# thread of the parent can be holding. An RLock, since _after_fork() may
+# register() new objects.
+_reset_locks = {}
+# Process whose objects are being reset.
+_resetting = None
+
+
+def register(obj):
+    """
+    Call C{obj._after_fork()} in every forked child, without keeping
+    C{obj} alive.
+    """
+    global _prune_at
+
+    check()
+
+    _lock.acquire()
+    try:
+        _refs.append(weakref.ref(obj))
+
+        if len(_refs) >= _prune_at:
+            _refs[:] = [ref for ref in _refs if ref() is not None]
+            _prune_at = max(len(_refs) * 2, 64)
+    finally:
+        _lock.release()
+
+
+def check():
+    """
+    Reset the registered objects if this is the first call since the
+    process was forked.
+    """
+    global _lock, _pid, _resetting
+
+    pid = os.getpid()
+
+    if pid == _pid:
+        return
+
+    # setdefault() is atomic, every thread of the process gets the same
+    # lock.
+    reset_lock = _reset_locks.setdefault(pid, threading.RLock())
+    reset_lock.acquire()
+    try:
+        if pid == _pid or pid == _resetting:
+            # Reset by another thread, or check() was called by an
+            # _after_fork() method.
+            return
+
+        _resetting = pid
+
+        try:
+            # The lock may have been held by another thread of the parent.
+            _lock = threading.Lock()
+
+            for ref in list(_refs):
+                obj = ref()
+
+                if obj is not None:
+                    obj._after_fork()
+
+            # Other threads only skip the reset once it's complete.
+            _pid = pid
+        finally:
+            _resetting = None
+
+        for other_pid in list(_reset_locks):
+            if other_pid != pid:
+                _reset_locks.pop(other_pid, None)
+    finally:
+        reset_lock.release()
@@ -13,18 +13,114 @@
 # limitations under the License.
 
 __all__ = [
-    'HeartBeater'
+    'HeartBeater',
+    'HeartbeatStats',
+    'get_phase'
 ]
 
+import re
+import httplib
 import random
-from time import sleep
+import threading
+import requests
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from math import ceil
+from time import time
+
+import forksafe
 
 from base import BaseClient
+from constants import HEARTBEAT_RTT_WINDOW, HEARTBEAT_MARGIN_BUCKETS
+from constants import HEARTBEAT_PHASE_SPREAD, HEARTBEAT_RETRY_DELAY
+from deadline import deadline
+from errors import APIError, ValidationError, DeadlineExceededError
+from ratelimit import CRITICAL
+from ring import hash_key
+
+# Tokens which can be put in the request body as they are.
+SAFE_TOKEN_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+# Heartbeat responses which hold nothing but a token, read without a JSON
+# decoder.
+TOKEN_RE = re.compile(r'^\s*\{\s*"token"\s*:\s*"([A-Za-z0-9_-]*)"\s*\}\s*$')
+
+
+def get_phase(key, period):
+    """
+    Return an offset between 0 and C{period} derived from C{key}, the same
+    in every process, so that services started at the same moment spread
+    their requests over the period.
+    """
+    return hash_key(key or '') / float(2 ** 64) * period
+
+
+class HeartbeatStats(object):
+    def __init__(self, heartbeat_timeout, near_miss_margin,
+                 window=HEARTBEAT_RTT_WINDOW,
+                 buckets=HEARTBEAT_MARGIN_BUCKETS):
+        """
+        Round-trip times of the last C{window} heartbeats and the margin
+        which was left before the service would have timed out.
+
+        The margin of a beat is the time between the previous beat being
+        sent and this one being acknowledged, subtracted from the heartbeat
+        timeout. That is a lower bound of what the registry actually saw.
+        The margin histogram maps the upper bound of every bucket, as a
+        fraction of the heartbeat timeout, to the number of beats which
+        fell in it. The 0 bucket counts beats which arrived too late.
+        """
+        self.heartbeat_timeout = heartbeat_timeout
+        self.near_miss_margin = near_miss_margin
+        self.window = window
+        self.rtts = []
+        self.beats = 0
+        self.near_misses = 0
+        self.last_margin = None
+        self.margin_histogram = dict([(bound, 0) for bound in buckets])
+        self._buckets = sorted(buckets)
+
+    def record(self, rtt, margin):
+        self.rtts.append(rtt)
+
+        if len(self.rtts) > self.window:
+            del self.rtts[0]
+
+        self.beats += 1
+        self.last_margin = margin
+
+        if margin < self.near_miss_margin:
+            self.near_misses += 1
+
+        fraction = margin / float(self.heartbeat_timeout)
+
+        for bound in self._buckets:
+            if fraction <= bound:
+                self.margin_histogram[bound] += 1
+                break
+
+    def rtt_percentile(self, percentile):
+        """
+        Return the given percentile of the recent round-trip times, or None
+        if there haven't been any heartbeats yet.
+        """
+        if not self.rtts:
+            return None
+
+        # Nearest-rank method.
+        rtts = sorted(self.rtts)
+        index = int(ceil(len(rtts) * percentile / 100.0)) - 1
+        return rtts[max(index, 0)]
 
 
 class HeartBeater(BaseClient):
     def __init__(self, base_url, username, api_key, region,
-                 service_id, heartbeat_timeout):
+                 service_id, heartbeat_timeout, adaptive=False,
+                 safety_factor=3, min_margin=None, near_miss_margin=None,
+                 phase_spread=HEARTBEAT_PHASE_SPREAD, **kwargs):
         """
         HeartBeater will start heartbeating a service once start() is called,
         and stop heartbeating it when stop() is called.
@@ -40,13 +136,52 @@ class HeartBeater(BaseClient):
         @param heartbeat_timeout: The amount of time after which a service will
         time out if a heartbeat is not received.
         @type heartbeat_timeout: C{int}
+        @param adaptive: Instead of beating at a fixed fraction of the
+        timeout, space the beats as widely as possible while keeping a
+        margin of p99 RTT * C{safety_factor} (and at least C{min_margin})
+        before the timeout. The interval shrinks as soon as latency rises.
+        @type adaptive: C{bool}
+        @param safety_factor: Multiple of the p99 RTT kept as margin.
+        @type safety_factor: C{float}
+        @param min_margin: Smallest margin in seconds kept in adaptive mode,
+        defaults to 10% of the heartbeat timeout.
+        @type min_margin: C{float}
+        @param near_miss_margin: Beats which leave less than this many
+        seconds before the timeout are counted as near misses, in both
+        modes. Defaults to half of C{min_margin}.
+        @type near_miss_margin: C{float}
+        @param phase_spread: The first beat is brought forward by up to this
+        fraction of the interval, by an amount derived from the service id,
+        so services created together don't keep beating in step. 0 to
+        disable.
+        @type phase_spread: C{float}
+
+        Any other keyword arguments are passed to L{BaseClient}, except for
+        C{rate_limiter}: heartbeats are never held back by a rate budget, so
+        a busy account can't lose its registrations.
         """
-        super(HeartBeater, self).__init__(base_url, username, api_key, region)
+        kwargs.pop('rate_limiter', None)
+        super(HeartBeater, self).__init__(base_url, username, api_key, region,
+                                          **kwargs)
         self.service_id = service_id
         self.heartbeat_timeout = heartbeat_timeout
         self.heartbeat_interval = self._calculate_interval(heartbeat_timeout)
+        self.adaptive = adaptive
+        self.safety_factor = safety_factor
+        self.min_margin = min_margin or max(heartbeat_timeout * 0.1, 0.5)
+        self.near_miss_margin = near_miss_margin or (self.min_margin / 2.0)
+        self.phase_spread = phase_spread
+        self.stats = HeartbeatStats(heartbeat_timeout, self.near_miss_margin)
         self.next_token = None
+        self.last_sent = time()
         self._stopped = False
+        self._wakeup = threading.Event()
+
+        # Heartbeat request prepared for the current auth token, see
+        # _send_heartbeat().
+        self._prepared_for = None
+        self._prepared_path = None
+        self._prepared_kwargs = None
 
     def _calculate_interval(self, heartbeat_timeout):
         if heartbeat_timeout < 15:
@@ -54,24 +189,132 @@ class HeartBeater(BaseClient):
         else:
             return (heartbeat_timeout * 0.8)
 
+    def _calculate_adaptive_interval(self):
+        p99 = self.stats.rtt_percentile(99)
+
+        if p99 is None:
+            return self.heartbeat_interval
+
+        margin = max(p99 * self.safety_factor, self.min_margin)
+        interval = self.heartbeat_timeout - margin
+
+        # Never beat more often than a tenth of the timeout, however bad the
+        # latency gets.
+        return max(interval, self.heartbeat_timeout * 0.1)
+
+    def _get_wait_time(self):
+        if not self.adaptive:
+            interval = self.heartbeat_interval
+
+            if interval > 5:
+                interval = (interval + random.randrange(-3, 1))
+
+            return interval
+
+        # Measured from when the previous beat was sent, with a little
+        # jitter which can only make the wait shorter.
+        interval = self._calculate_adaptive_interval()
+        interval -= random.uniform(0, min(1.0, interval * 0.05))
+        return interval - (time() - self.last_sent)
+
+    def _send_heartbeat(self, token):
+        """
+        Send a heartbeat and return the next token.
+
+        This is the general request() path cut down to what a heartbeat
+        needs: the URL, headers and request arguments are prepared once per
+        auth token and only the body changes from one beat to the next.
+        """
+        forksafe.check()
+        auth_headers = self._authenticate()
+
+        for retry in (False, True):
+            if auth_headers is not self._prepared_for:
+                self._prepare_heartbeat(auth_headers)
+
+            request_kwargs = self._prepared_kwargs
+
+            if token and SAFE_TOKEN_RE.match(token):
+                request_kwargs['data'] = '{"token": "%s"}' % (token)
+            else:
+                request_kwargs['data'] = json.dumps({'token': token})
+
+            r = self._send(self._prepared_path, request_kwargs, CRITICAL)
+
+            if r.status_code != httplib.UNAUTHORIZED:
+                break
+
+            if retry:
+                raise APIError('API returned 401')
+
+            auth_headers = self._authenticate(rejected=auth_headers)
+
+        if r.status_code != httplib.OK:
+            data = r.json()
+            raise ValidationError(type=data['type'], code=data['code'],
+                                  message=data['message'],
+                                  txnId=data.get('txnId', None),
+                                  details=data['details'])
+
+        match = TOKEN_RE.match(r.content)
+
+        if match:
+            return match.group(1)
+
+        return r.json()['token']
+
+    def _after_fork(self):
+        # The heartbeating thread is not running in the child, the parent
+        # keeps beating for the service.
+        super(HeartBeater, self)._after_fork()
+        self._wakeup = threading.Event()
+
+    def _prepare_heartbeat(self, auth_headers):
+        self._prepared_path = '%s/services/%s/heartbeat' % (
+            auth_headers['X-Tenant-Id'], self.service_id)
+        self._prepared_kwargs = {'method': 'post',
+                                 'headers': dict(auth_headers),
+                                 'params': None, 'data': None,
+                                 'stream': False}
+        self._prepared_for = auth_headers
+
     def _start_heartbeating(self):
-        path = '/services/%s/heartbeat' % (self.service_id)
-        payload = {'token': self.next_token}
+        phase = get_phase(self.service_id,
+                          self.heartbeat_interval * self.phase_spread)
+        wait_time = self._get_wait_time() - phase
+
+        while not self._stopped:
+            # Returns early when stop() is called.
+            self._wakeup.wait(max(wait_time, 0))
+
+            if self._stopped:
+                break
 
-        if self._stopped:
-            return
+            sent = time()
 
-        interval = self.heartbeat_interval
+            # The service times out anyway once heartbeat_timeout has
+            # passed since the last beat, don't wait for longer than that.
+            remaining = self.heartbeat_timeout - (sent - self.last_sent)
 
-        if interval > 5:
-            interval = (interval + random.randrange(-3, 1))
+            try:
+                with deadline(max(remaining, 1)):
+                    token = self._send_heartbeat(self.next_token)
+            except (requests.RequestException, DeadlineExceededError):
+                remaining = self.heartbeat_timeout - (time() - self.last_sent)
 
-        sleep(interval)
+                if remaining <= 0:
+                    raise
 
-        result = self.request('POST', path, payload=payload)
-        self.next_token = result['token']
+                # The service hasn't timed out yet, try again.
+                wait_time = min(HEARTBEAT_RETRY_DELAY, remaining)
+                continue
 
-        self._start_heartbeating()
+            acknowledged = time()
+            margin = self.heartbeat_timeout - (acknowledged - self.last_sent)
+            self.stats.record(acknowledged - sent, margin)
+            self.last_sent = sent
+            self.next_token = token
+            wait_time = self._get_wait_time()
 
     def start(self):
         """
@@ -85,3 +328,4 @@ class HeartBeater(BaseClient):
         Stop heartbeating the service.
         """
         self._stopped = True
+        self._wakeup.set()
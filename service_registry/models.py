@@ -0,0 +1,178 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'Service',
+    'Event',
+    'ConfigurationValue'
+]
+
+from constants import INTERNED_STRINGS_SIZE
+
+# Table of canonical string instances. Tags, metadata keys and event types
+# come from a small vocabulary, so keeping one copy of each lets thousands of
+# models share the same objects. The builtin intern() only accepts byte
+# strings and the decoder hands us unicode, hence the dictionary. Once it
+# holds INTERNED_STRINGS_SIZE strings, new ones are no longer added, so
+# unbounded values such as unique tags can't grow it forever.
+_STRINGS = {}
+
+
+def intern_string(value):
+    """
+    Return the canonical instance of a string value.
+    """
+    try:
+        if len(_STRINGS) >= INTERNED_STRINGS_SIZE:
+            return _STRINGS.get(value, value)
+
+        return _STRINGS.setdefault(value, value)
+    except TypeError:
+        return value
+
+
+class Model(object):
+    """
+    Base class of the models. Subclasses define a from_dict() class method
+    and a to_dict() method, which equality is based on.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+
+        return self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # Equal models have the same id.
+        return hash((self.__class__, self.id))
+
+    def __repr__(self):
+        return '<%s id=%s>' % (self.__class__.__name__, self.id)
+
+
+class Service(Model):
+    """
+    A service as returned by the services endpoints.
+
+    Metadata is kept as the decoded dictionary it came in and only copied,
+    with interned keys, when the C{metadata} attribute is first accessed.
+    Changes to that dictionary are kept.
+    """
+    __slots__ = ('id', 'heartbeat_timeout', 'last_seen', 'tags', '_metadata',
+                 '_raw_metadata')
+
+    def __init__(self, id, heartbeat_timeout=None, last_seen=None, tags=None,
+                 metadata=None):
+        self.id = id
+        self.heartbeat_timeout = heartbeat_timeout
+        self.last_seen = last_seen
+        self.tags = tuple([intern_string(tag) for tag in tags or ()])
+        self._metadata = None
+        self._raw_metadata = metadata
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(id=data['id'],
+                   heartbeat_timeout=data.get('heartbeat_timeout', None),
+                   last_seen=data.get('last_seen', None),
+                   tags=data.get('tags', None),
+                   metadata=data.get('metadata', None))
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = dict([(intern_string(key), value) for key, value
+                                   in (self._raw_metadata or {}).iteritems()])
+            self._raw_metadata = None
+
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = dict(metadata or {})
+        self._raw_metadata = None
+
+    def get_metadata(self, key, default=None):
+        """
+        Return a single metadata value without building the whole dictionary.
+        """
+        if self._metadata is not None:
+            return self._metadata.get(key, default)
+
+        return (self._raw_metadata or {}).get(key, default)
+
+    def to_dict(self):
+        return {'id': self.id, 'heartbeat_timeout': self.heartbeat_timeout,
+                'last_seen': self.last_seen, 'tags': list(self.tags),
+                'metadata': dict(self.metadata)}
+
+
+class Event(Model):
+    """
+    An entry from the events feed.
+    """
+    __slots__ = ('id', 'timestamp', 'type', 'payload')
+
+    def __init__(self, id=None, timestamp=None, type=None, payload=None):
+        self.id = id
+        self.timestamp = timestamp
+        self.type = intern_string(type)
+        self.payload = payload
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(id=data.get('id', None),
+                   timestamp=data.get('timestamp', None),
+                   type=data.get('type', None),
+                   payload=data.get('payload', None))
+
+    @property
+    def service(self):
+        """
+        The L{Service} carried by a service.* event, or None.
+        """
+        if not self.type or not self.type.startswith('service.'):
+            return None
+
+        if not self.payload or 'id' not in self.payload:
+            return None
+
+        return Service.from_dict(self.payload)
+
+    def to_dict(self):
+        return {'id': self.id, 'timestamp': self.timestamp, 'type': self.type,
+                'payload': self.payload}
+
+
+class ConfigurationValue(Model):
+    """
+    A single configuration key and its value.
+    """
+    __slots__ = ('id', 'value')
+
+    def __init__(self, id, value=None):
+        self.id = id
+        self.value = value
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(id=data['id'], value=data.get('value', None))
+
+    def to_dict(self):
+        return {'id': self.id, 'value': self.value}
@@ -0,0 +1,146 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'NegativeCache'
+]
+
+import threading
+
+from collections import deque
+from time import time
+
+import forksafe
+
+from constants import NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE
+
+SERVICES = 'services'
+CONFIGURATION = 'configuration'
+
+
+class NegativeCache(object):
+    def __init__(self, ttl=NEGATIVE_CACHE_TTL, maxsize=NEGATIVE_CACHE_SIZE):
+        """
+        Remembers for C{ttl} seconds which services and configuration
+        values don't exist, so looking them up again raises the same
+        not found error without a request.
+
+        Keys are (kind, id) tuples, kind being 'services' or
+        'configuration', with configuration ids stripped of their leading
+        slash. Once C{maxsize} misses are cached the oldest ones
+        are dropped.
+
+        @param ttl: Seconds a miss is remembered for.
+        @type ttl: C{float}
+        @param maxsize: Maximum number of misses remembered.
+        @type maxsize: C{int}
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        # Incremented by every invalidation, so a miss looked up before one
+        # isn't cached after it.
+        self.version = 0
+        self._entries = {}
+        self._order = deque()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def get(self, key):
+        """
+        Return the cached not found error for C{key}, None if there is
+        none.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key, None)
+
+            if entry is None:
+                return None
+
+            if entry[0] <= time():
+                del self._entries[key]
+                return None
+
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def add(self, key, error, version=None):
+        """
+        Cache a not found error, unless the cache has been invalidated
+        since C{version} was read.
+        """
+        self._lock.acquire()
+        try:
+            if version is not None and version != self.version:
+                return
+
+            expires = time() + self.ttl
+            self._entries[key] = (expires, error)
+            self._order.append((expires, key))
+
+            # Every miss expires after the same ttl, so the oldest entry is
+            # also the first to expire. The order also holds stale items
+            # for keys cached again or invalidated, which are skipped.
+            while len(self._entries) > self.maxsize or \
+                    len(self._order) > 2 * self.maxsize:
+                expires, key = self._order.popleft()
+                entry = self._entries.get(key, None)
+
+                if entry is not None and entry[0] == expires:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            self.version += 1
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.version += 1
+            self._entries.clear()
+            self._order.clear()
+        finally:
+            self._lock.release()
+
+    def handle_event(self, event):
+        """
+        Forget the misses of the service or configuration value an event
+        (a dictionary or L{Event}) is about.
+        """
+        if isinstance(event, dict):
+            event_type = event.get('type', None) or ''
+            payload = event.get('payload', None) or {}
+        else:
+            event_type = event.type or ''
+            payload = event.payload or {}
+
+        if event_type.startswith('service.'):
+            self.discard((SERVICES, payload.get('id', None)))
+        elif event_type.startswith('configuration_value.'):
+            configuration_id = payload.get('configuration_value_id', None)
+            self.discard((CONFIGURATION, (configuration_id or '').lstrip('/')))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
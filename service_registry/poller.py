@@ -0,0 +1,361 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+One poller of the events feed shared by every component of a process.
+
+    poller = client.events_poller
+    subscription = poller.subscribe(types=['service.join'])
+
+    for event in subscription:
+        print event.service.id
+"""
+
+__all__ = [
+    'EventsPoller',
+    'Subscription'
+]
+
+import Queue
+import threading
+
+import forksafe
+
+from constants import EVENTS_POLLER_MIN_INTERVAL
+from constants import EVENTS_POLLER_MAX_INTERVAL
+from constants import EVENTS_POLLER_QUEUE_SIZE
+
+# Put in the queue of a closed subscription to end its iteration.
+_CLOSED = object()
+
+
+class Subscription(object):
+    def __init__(self, poller, types=None, service_ids=None, predicate=None,
+                 maxsize=EVENTS_POLLER_QUEUE_SIZE, block=False):
+        """
+        Queue of the events a subscriber is interested in.
+
+        @param types: Only deliver events of these types.
+        @type types: C{list}
+        @param service_ids: Only deliver events about these services.
+        @type service_ids: C{list}
+        @param predicate: Only deliver events for which this returns True.
+        @type predicate: C{callable}
+        @param maxsize: Maximum number of undelivered events.
+        @type maxsize: C{int}
+        @param block: When the queue is full, drop the oldest event and
+        count it in C{dropped} if False, or make the poller wait for room
+        if True. A blocking subscription which isn't read holds back every
+        other subscriber and every caller of poll().
+        @type block: C{bool}
+        """
+        self.poller = poller
+        self.types = set(types) if types else None
+        self.service_ids = set(service_ids) if service_ids else None
+        self.predicate = predicate
+        self.block = block
+        self.dropped = 0
+        self.closed = False
+        self.queue = Queue.Queue(maxsize)
+
+    def matches(self, event):
+        if self.types and event.type not in self.types:
+            return False
+
+        if self.service_ids and \
+           (event.payload or {}).get('id', None) not in self.service_ids:
+            return False
+
+        if self.predicate and not self.predicate(event):
+            return False
+
+        return True
+
+    def put(self, event):
+        if self.closed:
+            return
+
+        if self.block:
+            while not self.closed:
+                try:
+                    self.queue.put(event, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Return the next event, waiting for up to C{timeout} seconds.
+
+        @raise Queue.Empty: No event arrived in time or the subscription is
+        closed.
+        """
+        if self.closed and self.queue.empty():
+            raise Queue.Empty()
+
+        event = self.queue.get(timeout=timeout)
+
+        if event is _CLOSED:
+            raise Queue.Empty()
+
+        return event
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except Queue.Empty:
+                return
+
+    def close(self):
+        """
+        Stop receiving events. An iteration over the subscription ends once
+        the events already queued have been read.
+        """
+        self.poller.unsubscribe(self)
+        self.closed = True
+
+        try:
+            self.queue.put_nowait(_CLOSED)
+        except Queue.Full:
+            pass
+
+
+class EventsPoller(object):
+    def __init__(self, client, min_interval=EVENTS_POLLER_MIN_INTERVAL,
+                 max_interval=EVENTS_POLLER_MAX_INTERVAL, backoff=2,
+                 marker=None):
+        """
+        Polls the events feed and hands every new event to the matching
+        subscriptions.
+
+        The interval between two polls drops to C{min_interval} as soon as
+        a poll returns events and is multiplied by C{backoff}, up to
+        C{max_interval}, after every poll which returns none.
+
+        @param client: Client used to read the events feed.
+        @type client: L{Client}
+        @param min_interval: Shortest interval between two polls in seconds.
+        @type min_interval: C{float}
+        @param max_interval: Longest interval between two polls in seconds.
+        @type max_interval: C{float}
+        @param backoff: Factor the interval grows by while idle.
+        @type backoff: C{float}
+        @param marker: Id of a recent event, for example one saved by an
+        earlier run. The head of the feed is looked for from there instead
+        of from the start of the feed, which is read in full otherwise.
+        @type marker: C{str}
+        """
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.marker = marker
+        self.subscriptions = []
+        self.listeners = []
+        self._synced = False
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        forksafe.register(self)
+
+    def subscribe(self, types=None, service_ids=None, predicate=None,
+                  maxsize=EVENTS_POLLER_QUEUE_SIZE, block=False):
+        """
+        Return a new L{Subscription} to the events published from now on.
+        See L{Subscription} for the arguments.
+        """
+        subscription = Subscription(self, types=types,
+                                    service_ids=service_ids,
+                                    predicate=predicate, maxsize=maxsize,
+                                    block=block)
+
+        self._lock.acquire()
+        try:
+            self.subscriptions = self.subscriptions + [subscription]
+        finally:
+            self._lock.release()
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._lock.acquire()
+        try:
+            self.subscriptions = [s for s in self.subscriptions
+                                  if s is not subscription]
+        finally:
+            self._lock.release()
+
+    def add_listener(self, callback):
+        """
+        Call C{callback(event)} from the polling thread for every new
+        event, before it is handed to the subscriptions. Listeners must not
+        block.
+        """
+        self._lock.acquire()
+        try:
+            self.listeners = self.listeners + [callback]
+        finally:
+            self._lock.release()
+
+    def remove_listener(self, callback):
+        self._lock.acquire()
+        try:
+            self.listeners = [c for c in self.listeners if c is not callback]
+        finally:
+            self._lock.release()
+
+    def sync(self, marker=None):
+        """
+        Find the head of the feed unless it has already been found, so the
+        subscriptions receive every event published from now on. The first
+        poll() does the same.
+
+        @param marker: Id of a recent event to look for the head from,
+        instead of the poller's C{marker}.
+        @type marker: C{str}
+        """
+        if self._synced:
+            return
+
+        self._poll_lock.acquire()
+        try:
+            if not self._synced:
+                if marker:
+                    self.marker = marker
+
+                self._find_head()
+        finally:
+            self._poll_lock.release()
+
+    def poll(self):
+        """
+        Read the new events, hand them to the subscriptions, adjust the
+        interval and return the number of events.
+
+        The first poll only finds the head of the feed, so subscriptions
+        receive the events published after it.
+        """
+        self._poll_lock.acquire()
+        try:
+            if not self._synced:
+                self._find_head()
+                return 0
+
+            count = self._publish()
+        finally:
+            self._poll_lock.release()
+
+        if count:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+
+        return count
+
+    def start(self):
+        """
+        Poll the events feed until stop() is called.
+        """
+        self._stopped.clear()
+
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # Keep going, a failed poll backs off like an idle one.
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def start_thread(self):
+        """
+        Run start() in a daemon thread, unless it is already running.
+        """
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.start)
+                self._thread.daemon = True
+                self._thread.start()
+
+            return self._thread
+        finally:
+            self._lock.release()
+
+    def wakeup(self):
+        """
+        Poll right away, for example when a change is expected.
+        """
+        self.interval = self.min_interval
+        self._wakeup.set()
+
+    def stop(self):
+        """
+        Stop polling.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _after_fork(self):
+        # Subscriptions are inherited, keep feeding them from a new thread
+        # if one was running in the parent.
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        if self._thread is not None and not self._stopped.is_set():
+            self._thread = None
+            self.start_thread()
+
+    def _find_head(self):
+        self.marker = self.client.events.get_head(self.marker)
+        self._synced = True
+
+    def _publish(self):
+        count = 0
+
+        for event in self.client.events.iterate(self.marker, as_models=True):
+            count += 1
+
+            for callback in self.listeners:
+                callback(event)
+
+            for subscription in self.subscriptions:
+                if subscription.matches(event):
+                    subscription.put(event)
+
+            if event.id:
+                self.marker = event.id
+
+        return count
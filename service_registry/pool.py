@@ -0,0 +1,204 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'ClientPool'
+]
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import forksafe
+
+from constants import DEFAULT_API_URL, DEFAULT_MAX_WORKERS, DEFAULT_TIMEOUT
+from base import create_session
+from client import Client
+from endpoints import EndpointSet
+from ratelimit import RateLimiter, ConcurrencyLimiter, PriorityLimiter
+
+
+class ClientPool(object):
+    """
+    Hands out clients for many accounts which all share one HTTP connection
+    pool, one worker pool and one set of endpoints. Every account keeps its
+    own auth token and, optionally, its own rate budget.
+
+        pool = ClientPool(rate=10)
+        client = pool.get('username', 'api_key')
+        client.services.list()
+    """
+    def __init__(self, base_url=DEFAULT_API_URL, region='us',
+                 coalesce_gets=True, max_workers=DEFAULT_MAX_WORKERS,
+                 max_connections=None, timeout=DEFAULT_TIMEOUT, rate=None,
+                 burst=None, max_registrations=None, max_requests=None):
+        """
+        @param base_url: The base Cloud Registry URL, or a list of them.
+        @type base_url: C{str} or C{list}
+        @param region: Default Rackspace region of the accounts.
+        @type region: C{str}
+        @param max_workers: Size of the shared worker pool.
+        @type max_workers: C{int}
+        @param max_connections: Size of the shared HTTP connection pool,
+        defaults to C{max_workers}.
+        @type max_connections: C{int}
+        @param rate: Default number of requests per second allowed for
+        every account, None for no limit.
+        @type rate: C{float}
+        @param burst: Default rate budget burst size.
+        @type burst: C{int}
+        @param max_registrations: Maximum number of services being created
+        at once across all the accounts, None for no limit.
+        @type max_registrations: C{int}
+        @param max_requests: Maximum number of requests in flight across
+        all the accounts, None for no limit. Heartbeats and service
+        creation get a free slot first, listings last.
+        @type max_requests: C{int}
+        """
+        self.base_url = base_url
+        self.region = region
+        self.coalesce_gets = coalesce_gets
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.rate = rate
+        self.burst = burst
+
+        self.max_connections = max_connections or max_workers
+        self.session = create_session(self.max_connections)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.endpoints = EndpointSet(base_url, session=self.session)
+        self.registration_limiter = None
+        self.priority_limiter = None
+
+        if max_registrations:
+            self.registration_limiter = ConcurrencyLimiter(max_registrations)
+
+        if max_requests:
+            self.priority_limiter = PriorityLimiter(max_requests)
+
+        self._clients = {}
+        self._lock = threading.Lock()
+
+        # Registered after the endpoint set and the limiter, and before any
+        # client, so they all see the rebuilt session and workers.
+        forksafe.register(self)
+
+    def get(self, username, api_key, region=None, rate=None, burst=None):
+        """
+        Return the client for an account, creating it on first use. The
+        same client (and auth token) is returned until the API key changes,
+        then the previous one is closed and replaced.
+
+        @param rate: Requests per second allowed for this account, defaults
+        to the pool's C{rate}. Passing C{rate} or C{burst} for an existing
+        client changes its rate budget.
+        @type rate: C{float}
+        @param burst: Rate budget burst size for this account.
+        @type burst: C{int}
+        @rtype: L{Client}
+        @raise ValueError: A rate or burst is given for an existing client
+        which was created without a rate budget.
+        """
+        forksafe.check()
+
+        region = region or self.region
+        key = (username, region)
+        replaced = None
+
+        self._lock.acquire()
+        try:
+            client = self._clients.get(key, None)
+
+            if client and client.api_key == api_key:
+                if rate or burst:
+                    self._set_rate(client, rate, burst)
+
+                return client
+
+            replaced = client
+            rate = rate or self.rate
+            rate_limiter = None
+
+            if rate:
+                rate_limiter = RateLimiter(rate, burst or self.burst)
+
+            client = Client(username, api_key, base_url=self.base_url,
+                            region=region, coalesce_gets=self.coalesce_gets,
+                            timeout=self.timeout, session=self.session,
+                            executor=self.executor, endpoints=self.endpoints,
+                            rate_limiter=rate_limiter,
+                            registration_limiter=self.registration_limiter,
+                            priority_limiter=self.priority_limiter)
+            self._clients[key] = client
+        finally:
+            self._lock.release()
+
+        # The transport is the pool's, this only stops the background
+        # threads of the previous client.
+        if replaced:
+            replaced.close()
+
+        return client
+
+    def _set_rate(self, client, rate, burst):
+        # Every sub-client holds on to the limiter, so it is updated in
+        # place rather than replaced.
+        if client.rate_limiter is None:
+            raise ValueError('The client of %s has no rate budget to change'
+                             % (client.username))
+
+        client.rate_limiter.set_rate(rate or client.rate_limiter.rate,
+                                     burst or self.burst)
+
+    def remove(self, username, region=None):
+        """
+        Forget the client of an account.
+        """
+        self._lock.acquire()
+        try:
+            return self._clients.pop((username, region or self.region), None)
+        finally:
+            self._lock.release()
+
+    def _after_fork(self):
+        self.session = create_session(self.max_connections)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.endpoints.session = self.session
+        self._lock = threading.Lock()
+
+        for client in self._clients.values():
+            client._set_transport(self.session, self.executor)
+
+    def __len__(self):
+        return len(self._clients)
+
+    def close(self):
+        """
+        Wait for all the submitted calls to finish and release the worker
+        threads and HTTP connections of all the clients.
+        """
+        self._lock.acquire()
+        try:
+            self._clients.clear()
+        finally:
+            self._lock.release()
+
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,267 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'RateLimiter',
+    'ConcurrencyLimiter',
+    'PriorityLimiter',
+    'CRITICAL',
+    'NORMAL',
+    'BULK'
+]
+
+import threading
+
+from time import sleep, time
+
+import forksafe
+
+from deadline import get_deadline
+from errors import DeadlineExceededError
+
+# Request classes of a PriorityLimiter, most urgent first.
+CRITICAL = 0
+NORMAL = 1
+BULK = 2
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        """
+        Token bucket allowing on average C{rate} requests per second and
+        bursts of up to C{burst} requests.
+
+        @param rate: Requests per second.
+        @type rate: C{float}
+        @param burst: Bucket size, defaults to one second worth of requests.
+        @type burst: C{int}
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = max(burst or int(rate), 1)
+        self._tokens = float(self.burst)
+        self._updated = time()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate and burst size, with the same defaults as when
+        creating the limiter. The tokens already in the bucket are kept, up
+        to the new burst size.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self._lock.acquire()
+        try:
+            now = time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+
+            self.rate = float(rate)
+            self.burst = max(burst or int(rate), 1)
+            self._tokens = min(self._tokens, self.burst)
+        finally:
+            self._lock.release()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available. Returns the number of seconds to
+        wait before the next one, 0 if a token has been taken.
+        """
+        self._lock.acquire()
+        try:
+            now = time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+        finally:
+            self._lock.release()
+
+    def acquire(self):
+        """
+        Block until a token is available. Inside a deadline() block
+        L{DeadlineExceededError} is raised right away if the wait would
+        outlast the deadline.
+        """
+        while True:
+            delay = self.try_acquire()
+
+            if not delay:
+                return
+
+            current_deadline = get_deadline()
+
+            if current_deadline and current_deadline.remaining() < delay:
+                raise DeadlineExceededError('Deadline exceeded waiting for '
+                                            'the rate limit')
+
+            sleep(delay)
+
+
+class ConcurrencyLimiter(object):
+    def __init__(self, limit):
+        """
+        Admission limit allowing at most C{limit} callers inside at once.
+
+            with limiter:
+                ...
+        """
+        if limit <= 0:
+            raise ValueError('limit must be positive')
+
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition(threading.Lock())
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Slots held by threads of the parent are free in the child.
+        self.active = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """
+        Block until a slot is free. Inside a deadline() block
+        L{DeadlineExceededError} is raised if none frees up in time.
+        """
+        current_deadline = get_deadline()
+
+        self._condition.acquire()
+        try:
+            while self.active >= self.limit:
+                if current_deadline:
+                    self._condition.wait(current_deadline.get_timeout())
+                else:
+                    self._condition.wait()
+
+            self.active += 1
+        finally:
+            self._condition.release()
+
+    def release(self):
+        self._condition.acquire()
+        try:
+            self.active -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class PriorityLimiter(object):
+    def __init__(self, limit, reserved=1, bulk_limit=None):
+        """
+        Admission limit with request classes: at most C{limit} requests are
+        in flight at once and a free slot always goes to the most urgent
+        waiting request first.
+
+        CRITICAL requests (heartbeats, service creation) may also use the
+        C{reserved} slots which NORMAL (single reads and writes) and BULK
+        (listings, exports) requests never get, so they only wait when all
+        the slots are taken by other critical requests.
+
+        @param limit: Maximum number of requests in flight.
+        @type limit: C{int}
+        @param reserved: Number of slots only critical requests may use.
+        @type reserved: C{int}
+        @param bulk_limit: Maximum number of bulk requests in flight,
+        defaults to half of the slots which are not reserved.
+        @type bulk_limit: C{int}
+        """
+        if limit <= reserved:
+            raise ValueError('limit must be greater than reserved')
+
+        self.limit = limit
+        self.reserved = reserved
+        self.bulk_limit = bulk_limit or max((limit - reserved) // 2, 1)
+        self.active = [0, 0, 0]
+        self.waiting = [0, 0, 0]
+        self._condition = threading.Condition(threading.Lock())
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self.active = [0, 0, 0]
+        self.waiting = [0, 0, 0]
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, priority=NORMAL):
+        """
+        Block until a slot is free for a request of class C{priority}.
+        Inside a deadline() block L{DeadlineExceededError} is raised if
+        none frees up in time.
+        """
+        current_deadline = get_deadline()
+
+        self._condition.acquire()
+        try:
+            self.waiting[priority] += 1
+
+            try:
+                while not self._can_enter(priority):
+                    if current_deadline:
+                        self._condition.wait(current_deadline.get_timeout())
+                    else:
+                        self._condition.wait()
+            finally:
+                self.waiting[priority] -= 1
+
+            self.active[priority] += 1
+        finally:
+            self._condition.release()
+
+    def release(self, priority=NORMAL):
+        self._condition.acquire()
+        try:
+            self.active[priority] -= 1
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def _can_enter(self, priority):
+        active = sum(self.active)
+
+        if priority == CRITICAL:
+            return active < self.limit
+
+        if active >= self.limit - self.reserved:
+            return False
+
+        # A more urgent waiting request takes the free slot.
+        if sum(self.waiting[:priority]):
+            return False
+
+        if priority == BULK:
+            return self.active[BULK] < self.bulk_limit
+
+        return True
@@ -0,0 +1,263 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'ServiceRing'
+]
+
+import struct
+import threading
+
+from bisect import bisect, bisect_left
+from hashlib import md5
+
+from models import Service
+
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return struct.unpack('>Q', md5(key).digest()[:8])[0]
+
+
+class ServiceRing(object):
+    def __init__(self, replicas=100, weight_key=None):
+        """
+        Consistent-hash ring over services, for sharding keys across the
+        members of a tag.
+
+        Every service is placed on the ring C{replicas} times (virtual
+        nodes), multiplied by its weight. Adding or removing a service only
+        inserts or deletes its own points, so only the keys which hashed to
+        it move.
+
+        @param replicas: Number of virtual nodes for a service of weight 1.
+        @type replicas: C{int}
+        @param weight_key: Metadata key holding the weight of a service.
+        Services without it, or with an invalid value, have weight 1.
+        @type weight_key: C{str}
+        """
+        self.replicas = replicas
+        self.weight_key = weight_key
+        self.services = {}
+        self._points = {}
+        self._hashes = []
+        self._ids = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_client(cls, client, tag, **kwargs):
+        """
+        Build a ring over all the services with the given tag.
+        """
+        ring = cls(**kwargs)
+        ring.refresh(client, tag)
+        return ring
+
+    def __len__(self):
+        return len(self.services)
+
+    def __contains__(self, service_id):
+        return service_id in self.services
+
+    def add(self, service):
+        """
+        Add a service (a dictionary or a L{Service}) or update its weight.
+        """
+        service = self._to_model(service)
+        count = self._get_point_count(service)
+
+        self._lock.acquire()
+        try:
+            if service.id in self.services and \
+               len(self._points[service.id]) == count:
+                self.services[service.id] = service
+                return
+
+            self._remove(service.id)
+            self.services[service.id] = service
+            self._add(service.id, count)
+        finally:
+            self._lock.release()
+
+    def remove(self, service_id):
+        self._lock.acquire()
+        try:
+            self._remove(service_id)
+        finally:
+            self._lock.release()
+
+    def update(self, services):
+        """
+        Make the ring hold exactly C{services}, only touching the ones which
+        joined, left or changed weight.
+
+        The points of all the services which joined are sorted into the
+        ring at once, so building a ring takes O(P log P) time for P points
+        rather than one insertion per point.
+        """
+        services = dict([(service.id, service) for service in
+                         [self._to_model(service) for service in services]])
+        counts = dict([(service_id, self._get_point_count(service))
+                       for service_id, service in services.iteritems()])
+
+        self._lock.acquire()
+        try:
+            self._remove_many([service_id for service_id in self.services
+                               if len(self._points[service_id]) !=
+                               counts.get(service_id, -1)])
+            self._add_many([(service_id, counts[service_id])
+                            for service_id in services
+                            if service_id not in self._points])
+            self.services.update(services)
+        finally:
+            self._lock.release()
+
+    def refresh(self, client, tag):
+        """
+        List all the services with the given tag and update the ring.
+        """
+        services = []
+        pages = client.services._iterate_pages(client.services.list_for_tag,
+                                               tag, as_models=True)
+
+        for page in pages:
+            services.extend(page['values'])
+
+        self.update(services)
+
+    def handle_change(self, change):
+        """
+        Apply a L{ServiceChange}, so the ring can be kept up to date with a
+        L{ServicesWatcher}:
+
+            ServicesWatcher(client, tag, on_added=ring.handle_change,
+                            on_removed=ring.handle_change,
+                            on_changed=ring.handle_change)
+        """
+        if change.type == 'removed':
+            self.remove(change.service_id)
+        else:
+            self.add(change.new)
+
+    def lookup(self, key):
+        """
+        Return the id of the service which owns C{key}, or None if the ring
+        is empty.
+        """
+        key_hash = hash_key(key)
+
+        self._lock.acquire()
+        try:
+            if not self._hashes:
+                return None
+
+            index = bisect(self._hashes, key_hash)
+
+            if index == len(self._hashes):
+                index = 0
+
+            return self._ids[index]
+        finally:
+            self._lock.release()
+
+    def lookup_service(self, key):
+        """
+        Like lookup() but return the L{Service}.
+        """
+        service_id = self.lookup(key)
+        return self.services.get(service_id, None) if service_id else None
+
+    def _to_model(self, service):
+        if isinstance(service, Service):
+            return service
+
+        return Service.from_dict(service)
+
+    def _get_point_count(self, service):
+        weight = 1.0
+
+        if self.weight_key:
+            try:
+                weight = float(service.get_metadata(self.weight_key, 1))
+            except (TypeError, ValueError):
+                weight = 1.0
+
+        return max(int(round(self.replicas * weight)), 0)
+
+    def _add(self, service_id, count):
+        points = [hash_key('%s-%d' % (service_id, index))
+                  for index in xrange(count)]
+
+        for point in points:
+            index = bisect(self._hashes, point)
+
+            # Points are ordered by (hash, id) however the ring was built.
+            while index > 0 and self._hashes[index - 1] == point and \
+                    self._ids[index - 1] > service_id:
+                index -= 1
+
+            self._hashes.insert(index, point)
+            self._ids.insert(index, service_id)
+
+        self._points[service_id] = points
+
+    def _remove(self, service_id):
+        self.services.pop(service_id, None)
+
+        for point in self._points.pop(service_id, []):
+            index = bisect_left(self._hashes, point)
+
+            # Skip over other services which hash to the same point.
+            while self._ids[index] != service_id:
+                index += 1
+
+            del self._hashes[index]
+            del self._ids[index]
+
+    def _add_many(self, counts):
+        """
+        Add the points of many services, given as (service id, count)
+        tuples, with a single sort.
+        """
+        if not counts:
+            return
+
+        pairs = zip(self._hashes, self._ids)
+
+        for service_id, count in counts:
+            points = [hash_key('%s-%d' % (service_id, index))
+                      for index in xrange(count)]
+            pairs.extend([(point, service_id) for point in points])
+            self._points[service_id] = points
+
+        pairs.sort()
+        self._hashes = [pair[0] for pair in pairs]
+        self._ids = [pair[1] for pair in pairs]
+
+    def _remove_many(self, service_ids):
+        if not service_ids:
+            return
+
+        service_ids = set(service_ids)
+
+        for service_id in service_ids:
+            self.services.pop(service_id, None)
+            self._points.pop(service_id, None)
+
+        pairs = [pair for pair in zip(self._hashes, self._ids)
+                 if pair[1] not in service_ids]
+        self._hashes = [pair[0] for pair in pairs]
+        self._ids = [pair[1] for pair in pairs]
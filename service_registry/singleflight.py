@@ -0,0 +1,116 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'SingleFlight'
+]
+
+import sys
+import threading
+
+from deadline import get_deadline
+from errors import DeadlineExceededError
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'exc_info', 'deadline')
+
+    def __init__(self, deadline):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.deadline = deadline
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls which share a key into a single call.
+
+    The first caller for a key runs the function, every caller which arrives
+    while it is still running waits for it and receives the same result
+    object or exception. Once the call finishes the key is forgotten, so
+    this is not a cache. Waiters give up when their own deadline expires.
+
+    The call runs under the deadline of the caller which made it. If that
+    deadline expires, it is not shared: the waiters with time left make the
+    call again instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call C{fn} with the given arguments unless a call for C{key} is
+        already in flight, in which case wait for that one instead.
+        """
+        current_deadline = get_deadline()
+
+        while True:
+            self._lock.acquire()
+            try:
+                call = self._calls.get(key, None)
+                leader = call is None
+
+                if leader:
+                    call = _Call(current_deadline)
+                    self._calls[key] = call
+            finally:
+                self._lock.release()
+
+            if leader:
+                break
+
+            if current_deadline:
+                call.done.wait(current_deadline.get_timeout())
+
+                if not call.done.is_set():
+                    raise DeadlineExceededError('Deadline exceeded')
+            else:
+                call.done.wait()
+
+            if call.exc_info:
+                if self._is_own_timeout(call, current_deadline):
+                    continue
+
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+
+            call.done.set()
+
+        return call.result
+
+    def _is_own_timeout(self, call, current_deadline):
+        """
+        Return True if C{call} failed because the deadline it ran under
+        expired and C{current_deadline} is a different one.
+        """
+        if not issubclass(call.exc_info[0], DeadlineExceededError):
+            return False
+
+        return call.deadline is not None and call.deadline is not \
+            current_deadline
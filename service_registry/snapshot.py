@@ -0,0 +1,497 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local snapshot of the services list and the configuration tree, so a new
+process can answer lookups before (or without) talking to the registry.
+
+File layout, all integers big-endian:
+
+    magic             8 bytes, 'SRSNAP01'
+    header            created (double), service count, configuration
+                      count (uint32 each)
+    services index    one (offset uint64, key length uint32, value length
+                      uint32) record per service, sorted by id
+    config index      the same for the configuration values
+    data              every record is the UTF-8 id followed by the JSON
+                      encoded value
+
+The file is memory-mapped and the indexes are binary searched in place, so
+opening it costs the same whatever the size of the catalog and only the
+values which are looked up are ever decoded.
+"""
+
+__all__ = [
+    'Snapshot',
+    'Catalog'
+]
+
+import os
+import mmap
+import struct
+import threading
+
+from time import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+import forksafe
+
+from models import Service, ConfigurationValue
+
+MAGIC = 'SRSNAP01'
+HEADER = struct.Struct('>dII')
+INDEX_ENTRY = struct.Struct('>QII')
+SERVICES, CONFIGURATION = range(2)
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        """
+        Open a snapshot file written by L{Snapshot.write}.
+
+        @raise ValueError: The file is not a valid snapshot.
+        """
+        self.path = path
+
+        fp = open(path, 'rb')
+
+        try:
+            size = os.fstat(fp.fileno()).st_size
+
+            if size < len(MAGIC) + HEADER.size:
+                raise ValueError('Not a snapshot file: %s' % (path))
+
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError('Not a snapshot file: %s' % (path))
+
+        self.created, service_count, configuration_count = \
+            HEADER.unpack_from(self._map, len(MAGIC))
+
+        services_start = len(MAGIC) + HEADER.size
+        configuration_start = services_start + \
+            service_count * INDEX_ENTRY.size
+        data_start = configuration_start + \
+            configuration_count * INDEX_ENTRY.size
+
+        if data_start > size:
+            self._map.close()
+            raise ValueError('Truncated snapshot file: %s' % (path))
+
+        self._sections = {SERVICES: (services_start, service_count),
+                          CONFIGURATION: (configuration_start,
+                                          configuration_count)}
+
+    @classmethod
+    def write(cls, path, services, configuration, created=None):
+        """
+        Atomically write a snapshot of the given service and configuration
+        value dictionaries to C{path}.
+        """
+        sections = [cls._encode_section(services),
+                    cls._encode_section(configuration)]
+        offset = len(MAGIC) + HEADER.size + \
+            INDEX_ENTRY.size * sum([len(section) for section in sections])
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+
+        try:
+            fp.write(MAGIC)
+            fp.write(HEADER.pack(created or time(), len(sections[0]),
+                                 len(sections[1])))
+
+            for section in sections:
+                for key, value in section:
+                    fp.write(INDEX_ENTRY.pack(offset, len(key), len(value)))
+                    offset += len(key) + len(value)
+
+            for section in sections:
+                for key, value in section:
+                    fp.write(key)
+                    fp.write(value)
+
+            fp.flush()
+            os.fsync(fp.fileno())
+        except:
+            fp.close()
+            os.remove(tmp_path)
+            raise
+
+        fp.close()
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def _encode_section(cls, values):
+        section = []
+
+        for value in values:
+            key = value['id']
+
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+
+            section.append((key, json.dumps(value, separators=(',', ':'))))
+
+        section.sort(key=lambda item: item[0])
+        return section
+
+    @property
+    def service_count(self):
+        return self._sections[SERVICES][1]
+
+    @property
+    def configuration_count(self):
+        return self._sections[CONFIGURATION][1]
+
+    def get_service(self, service_id):
+        """
+        Return the service dictionary with the given id, or None.
+        """
+        return self._get(SERVICES, service_id)
+
+    def get_configuration(self, configuration_id):
+        """
+        Return the configuration value dictionary with the given id, or None.
+        """
+        return self._get(CONFIGURATION, configuration_id)
+
+    def iter_services(self):
+        return self._iter(SERVICES)
+
+    def iter_configuration(self, prefix=None):
+        """
+        Iterate over the configuration values, or only over the ones whose
+        id starts with C{prefix}.
+        """
+        return self._iter(CONFIGURATION, prefix)
+
+    def close(self):
+        self._map.close()
+
+    def _get(self, section, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        index = self._bisect(section, key)
+        start, count = self._sections[section]
+
+        if index < count:
+            entry_key, value = self._read(start, index)
+
+            if entry_key == key:
+                return json.loads(value)
+
+        return None
+
+    def _iter(self, section, prefix=None):
+        start, count = self._sections[section]
+        index = 0
+
+        if prefix:
+            if isinstance(prefix, unicode):
+                prefix = prefix.encode('utf-8')
+
+            index = self._bisect(section, prefix)
+
+        while index < count:
+            key, value = self._read(start, index)
+
+            if prefix and not key.startswith(prefix):
+                break
+
+            yield json.loads(value)
+            index += 1
+
+    def _bisect(self, section, key):
+        start, count = self._sections[section]
+        low, high = 0, count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._read_key(start, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def _read_key(self, start, index):
+        offset, key_length, value_length = self._read_entry(start, index)
+        return self._map[offset:offset + key_length]
+
+    def _read(self, start, index):
+        offset, key_length, value_length = self._read_entry(start, index)
+        value_offset = offset + key_length
+        return (self._map[offset:value_offset],
+                self._map[value_offset:value_offset + value_length])
+
+    def _read_entry(self, start, index):
+        return INDEX_ENTRY.unpack_from(self._map,
+                                       start + index * INDEX_ENTRY.size)
+
+
+class Catalog(object):
+    def __init__(self, client, path, interval=None):
+        """
+        Services and configuration lookups served from a local snapshot
+        file, which is replaced with fresh data from the registry on
+        refresh().
+
+        @param client: Client used to refresh the snapshot.
+        @type client: L{Client}
+        @param path: Path of the snapshot file.
+        @type path: C{str}
+        @param interval: Number of seconds between the refreshes done by
+        start_thread().
+        @type interval: C{float}
+        """
+        self.client = client
+        self.path = path
+        self.interval = interval
+        self.snapshot = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Keep refreshing from a new thread if one was running in the
+        # parent.
+        self._lock = threading.Lock()
+
+        if self._thread is not None and not self._stopped.is_set():
+            self._thread = None
+            self.start_thread()
+
+    def load(self):
+        """
+        Open the existing snapshot file. Returns False if there is none or
+        it can't be read.
+        """
+        try:
+            snapshot = Snapshot(self.path)
+        except (IOError, OSError, ValueError, mmap.error) as e:
+            self.last_error = e
+            return False
+
+        self._swap(snapshot)
+        return True
+
+    def refresh(self):
+        """
+        List all the services and configuration values, write them to a new
+        snapshot file and start serving lookups from it.
+        """
+        services = self._list_all(self.client.services,
+                                  self.client.services.services_path)
+        configuration = self._list_all(
+            self.client.configuration,
+            self.client.configuration.configuration_path)
+
+        Snapshot.write(self.path, services, configuration)
+        self._swap(Snapshot(self.path))
+
+    def refresh_async(self):
+        """
+        Refresh the snapshot on the client's worker pool. Errors are stored
+        in C{last_error} and the current snapshot is kept.
+
+        @rtype: C{concurrent.futures.Future}
+        """
+        return self.client.executor.submit(self._refresh)
+
+    def start(self):
+        """
+        Refresh the snapshot every C{interval} seconds until stop() is
+        called. Errors are stored in C{last_error} and the current snapshot
+        is kept until the next attempt.
+        """
+        while not self._stopped.wait(self.interval):
+            try:
+                self._refresh()
+            except Exception:
+                pass
+
+    def start_thread(self):
+        """
+        Run start() in a daemon thread, unless it is already running.
+        """
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.start)
+                self._thread.daemon = True
+                self._thread.start()
+
+            return self._thread
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """
+        Stop the periodic refreshes.
+        """
+        self._stopped.set()
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.last_error = e
+            raise
+
+        self.last_error = None
+
+    @property
+    def created(self):
+        """
+        Time the current snapshot was taken at, or None if there is none.
+        """
+        snapshot = self.snapshot
+        return snapshot.created if snapshot else None
+
+    def get_service(self, service_id, as_models=False):
+        snapshot = self.snapshot
+        value = snapshot.get_service(service_id) if snapshot else None
+        return self._convert(value, Service, as_models)
+
+    def get_configuration(self, configuration_id, as_models=False):
+        snapshot = self.snapshot
+        value = snapshot.get_configuration(configuration_id) \
+            if snapshot else None
+        return self._convert(value, ConfigurationValue, as_models)
+
+    def list_services(self, tag=None, as_models=False):
+        """
+        Return all the services in the snapshot, or only the ones with the
+        given tag.
+        """
+        snapshot = self.snapshot
+
+        if not snapshot:
+            return []
+
+        return [self._convert(value, Service, as_models)
+                for value in snapshot.iter_services()
+                if tag is None or tag in value.get('tags', [])]
+
+    def list_configuration(self, namespace=None, as_models=False):
+        """
+        Return all the configuration values in the snapshot, or only the
+        ones under the given namespace.
+        """
+        snapshot = self.snapshot
+
+        if not snapshot:
+            return []
+
+        if namespace:
+            namespace = self.client.configuration._normalize_namespace(
+                namespace)
+
+        return [self._convert(value, ConfigurationValue, as_models)
+                for value in snapshot.iter_configuration(namespace)]
+
+    def list_services_page(self, tag=None, marker=None, limit=None):
+        """
+        Return the services in the snapshot starting at C{marker}, as a
+        services listing response of the registry would, or None if there
+        is no snapshot.
+        """
+        snapshot = self.snapshot
+
+        if not snapshot:
+            return None
+
+        values = [value for value in snapshot.iter_services()
+                  if tag is None or tag in value.get('tags', [])]
+        return self._page(values, marker, limit)
+
+    def list_configuration_page(self, namespace=None, marker=None,
+                                limit=None):
+        """
+        Return the configuration values in the snapshot starting at
+        C{marker}, as a configuration listing response of the registry
+        would, or None if there is no snapshot.
+        """
+        snapshot = self.snapshot
+
+        if not snapshot:
+            return None
+
+        if namespace:
+            namespace = self.client.configuration._normalize_namespace(
+                namespace)
+
+        values = list(snapshot.iter_configuration(namespace))
+        return self._page(values, marker, limit)
+
+    def _page(self, values, marker, limit):
+        if marker:
+            values = [value for value in values if value['id'] >= marker]
+
+        next_marker = None
+
+        if limit and len(values) > limit:
+            next_marker = values[limit]['id']
+            values = values[:limit]
+
+        return {'values': values,
+                'metadata': {'count': len(values), 'limit': limit,
+                             'marker': marker, 'next_marker': next_marker,
+                             'next_href': None}}
+
+    def _list_all(self, sub_client, path):
+        # Straight from the registry: the listing methods would fall back
+        # to this catalog when it is unavailable.
+        values = []
+        options = {}
+
+        while True:
+            result = sub_client._list(path, dict(options), None)
+            values.extend(result['values'])
+
+            marker = result['metadata'].get('next_marker', None)
+
+            if not marker:
+                return values
+
+            options['marker'] = marker
+
+    def _swap(self, snapshot):
+        # The previous snapshot is not closed here since other threads may
+        # still be reading from it, its mapping goes away with the object.
+        self._lock.acquire()
+        try:
+            self.snapshot = snapshot
+        finally:
+            self._lock.release()
+
+    def _convert(self, value, model_class, as_models):
+        if value is None or not as_models:
+            return value
+
+        return model_class.from_dict(value)
@@ -0,0 +1,335 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'ListingParser',
+    'StreamingListing'
+]
+
+import re
+import codecs
+
+try:
+    import simplejson as json
+except:
+    import json
+
+(START, KEY, COLON, VALUE, FIRST_ELEMENT, ELEMENT, AFTER_ELEMENT,
+ AFTER_VALUE, END) = range(9)
+
+NOT_WHITESPACE = re.compile(r'[^ \t\n\r]')
+
+# What the scanner looks for to find where a value ends: the quotes and
+# brackets of objects and arrays, the quote or escape which ends a string
+# and the delimiter after a number or literal.
+STRUCTURE = re.compile(r'["\[\]{}]')
+STRING_END = re.compile(r'["\\]')
+SCALAR_END = re.compile(r'[ \t\n\r,:\]}]')
+
+SCALAR_START = '-0123456789tfn'
+CLOSING = {'{': '}', '[': ']'}
+
+# Returned by _decode() when the buffer doesn't hold a complete value yet.
+_INCOMPLETE = object()
+
+
+class ListingParser(object):
+    """
+    Incremental parser for listing responses of the form
+    {"values": [...], "metadata": {...}}.
+
+    Text is passed to feed() as it arrives and every complete element of the
+    "values" array is returned as soon as it has been read, so at most one
+    element is held in memory. All the other top-level keys end up in
+    C{fields}.
+
+    Every value is scanned once to find where it ends, even when it spans
+    many chunks, and only then decoded, so an invalid one raises ValueError
+    as soon as it is complete.
+    """
+    def __init__(self, values_key='values'):
+        self.values_key = values_key
+        self.fields = {}
+        self._decoder = json.JSONDecoder()
+        self._buffer = u''
+        self._pos = 0
+        self._state = START
+        self._key = None
+        self._reset_scan()
+
+    def feed(self, text):
+        """
+        Parse more text and return the list of newly completed elements.
+        """
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return self._parse(eof=False)
+
+    def close(self):
+        """
+        Signal the end of the input and return the last elements.
+        """
+        values = self._parse(eof=True)
+
+        if self._state != END:
+            raise ValueError('Incomplete listing response')
+
+        return values
+
+    def _parse(self, eof):
+        values = []
+
+        while True:
+            match = NOT_WHITESPACE.search(self._buffer, self._pos)
+
+            if not match:
+                self._pos = len(self._buffer)
+                break
+
+            self._pos = match.start()
+            char = self._buffer[self._pos]
+            state = self._state
+
+            if state == START:
+                self._expect(char, '{', KEY)
+            elif state == KEY:
+                if char == '}':
+                    self._consume(1, END)
+                    continue
+
+                if char != '"':
+                    self._error('Expected a key')
+
+                key = self._decode(eof)
+
+                if key is _INCOMPLETE:
+                    break
+
+                self._key = key
+                self._state = COLON
+            elif state == COLON:
+                self._expect(char, ':', VALUE)
+            elif state == VALUE:
+                if self._key == self.values_key and char == '[':
+                    self._consume(1, FIRST_ELEMENT)
+                    continue
+
+                value = self._decode(eof)
+
+                if value is _INCOMPLETE:
+                    break
+
+                self.fields[self._key] = value
+                self._state = AFTER_VALUE
+            elif state in (FIRST_ELEMENT, ELEMENT):
+                if char == ']' and state == FIRST_ELEMENT:
+                    self._consume(1, AFTER_VALUE)
+                    continue
+
+                value = self._decode(eof)
+
+                if value is _INCOMPLETE:
+                    break
+
+                values.append(value)
+                self._state = AFTER_ELEMENT
+            elif state == AFTER_ELEMENT:
+                if char == ']':
+                    self._consume(1, AFTER_VALUE)
+                else:
+                    self._expect(char, ',', ELEMENT)
+            elif state == AFTER_VALUE:
+                if char == '}':
+                    self._consume(1, END)
+                else:
+                    self._expect(char, ',', KEY)
+            else:
+                self._error('Extra data')
+
+        return values
+
+    def _decode(self, eof):
+        end = self._scan(eof)
+
+        if end is None:
+            if eof:
+                self._error('Incomplete value')
+
+            return _INCOMPLETE
+
+        try:
+            value, decoded_end = self._decoder.raw_decode(self._buffer,
+                                                          self._pos)
+        except ValueError:
+            decoded_end = None
+
+        if decoded_end != end:
+            self._error('Invalid value')
+
+        self._pos = end
+        return value
+
+    def _scan(self, eof):
+        """
+        Return the offset in the buffer where the value starting at the
+        current position ends, or None if it hasn't been fully received
+        yet. The scan resumes where the previous call stopped.
+        """
+        buffer = self._buffer
+        index = self._pos + self._scanned
+
+        if not self._scanned:
+            char = buffer[index]
+
+            if char == '"':
+                self._in_string = True
+            elif char in CLOSING:
+                self._closing.append(CLOSING[char])
+            elif char in SCALAR_START:
+                self._in_scalar = True
+            else:
+                self._error('Unexpected character')
+
+            index += 1
+
+        if self._in_scalar:
+            # A number which runs up to the end of the buffer might
+            # continue in the next chunk.
+            match = SCALAR_END.search(buffer, index)
+
+            if match:
+                return self._end_scan(match.start())
+
+            if eof:
+                return self._end_scan(len(buffer))
+
+            self._scanned = len(buffer) - self._pos
+            return None
+
+        while True:
+            if self._in_string:
+                match = STRING_END.search(buffer, index)
+
+                if not match:
+                    break
+
+                index = match.end()
+
+                if match.group() == '\\':
+                    # Skip the escaped character, which may not have been
+                    # received yet.
+                    index += 1
+                    continue
+
+                self._in_string = False
+
+                if not self._closing:
+                    return self._end_scan(index)
+            else:
+                match = STRUCTURE.search(buffer, index)
+
+                if not match:
+                    break
+
+                char = match.group()
+                index = match.end()
+
+                if char == '"':
+                    self._in_string = True
+                elif char in CLOSING:
+                    self._closing.append(CLOSING[char])
+                elif char != self._closing.pop():
+                    self._error('Unbalanced %s' % (char))
+                elif not self._closing:
+                    return self._end_scan(index)
+
+        self._scanned = index - self._pos
+        return None
+
+    def _end_scan(self, end):
+        self._reset_scan()
+        return end
+
+    def _reset_scan(self):
+        # Number of characters of the current value scanned so far, and
+        # where the scan is at: brackets still open, inside a string or in
+        # a number or literal.
+        self._scanned = 0
+        self._closing = []
+        self._in_string = False
+        self._in_scalar = False
+
+    def _expect(self, char, expected, state):
+        if char != expected:
+            self._error('Expected %s' % (expected))
+
+        self._consume(1, state)
+
+    def _consume(self, length, state):
+        self._pos += length
+        self._state = state
+
+    def _error(self, message):
+        raise ValueError('%s: %s' % (message,
+                                     self._buffer[self._pos:self._pos + 20]))
+
+
+class StreamingListing(object):
+    def __init__(self, chunks, model_class=None, close=None,
+                 encoding='utf-8'):
+        """
+        Iterable over the values of a listing response which is parsed as
+        its chunks arrive. C{metadata} is available once the iteration is
+        over (or as soon as it has been read, if the server sent it first).
+
+        @param chunks: Iterable over the raw response body.
+        @type chunks: C{iterable}
+        @param model_class: If given, every value is turned into an instance
+        of this class.
+        @type model_class: C{type}
+        @param close: Called once the body has been read or the iteration is
+        abandoned.
+        @type close: C{callable}
+        """
+        self.chunks = chunks
+        self.model_class = model_class
+        self.parser = ListingParser()
+        self._close = close
+        self._encoding = encoding
+
+    @property
+    def metadata(self):
+        return self.parser.fields.get('metadata', None)
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder(self._encoding)()
+
+        try:
+            for chunk in self.chunks:
+                for value in self.parser.feed(decoder.decode(chunk)):
+                    yield self._convert(value)
+
+            self.parser.feed(decoder.decode('', final=True))
+
+            for value in self.parser.close():
+                yield self._convert(value)
+        finally:
+            if self._close:
+                self._close()
+
+    def _convert(self, value):
+        if self.model_class:
+            return self.model_class.from_dict(value)
+
+        return value
@@ -36,6 +36,11 @@ HTTP_GET_PATHS = {
     '/services/dfw1-db1':
     {'fixture_path': 'services-dfw1-db1-get.json'},
     '/services?tag=db': {'fixture_path': 'services-tag-db-get.json'},
+    '/services/my-service-1':
+    {'fixture_path': 'services-not-found-get.json', 'status_code': 404},
+    '/configuration/missing':
+    {'fixture_path': 'configuration-not-found-get.json',
+     'status_code': 404},
 }
 
 HTTP_POST_PATHS = {
@@ -80,6 +85,8 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
                              headers=headers,
                              body=body)
 
+        return self._end(status_code=404)
+
     def do_GET(self):
         return self._setup_response(HTTP_GET_PATHS, 200)
 
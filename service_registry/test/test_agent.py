@@ -0,0 +1,177 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mock
+import socket
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from service_registry.agent import HeartbeatAgent, AgentClient
+from service_registry.agent import get_socket_path
+from service_registry.client import Client
+from service_registry.errors import AgentError, ValidationError
+from service_registry.test.utils import patch_authenticate
+
+
+class HeartbeatAgentTests(unittest.TestCase):
+    def setUp(self):
+        patch_authenticate(self)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, 'agent.sock')
+        self.client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        self.agent = HeartbeatAgent(self.client, socket_path=self.socket_path)
+
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        while not os.path.exists(self.socket_path):
+            time.sleep(0.01)
+
+        self.agent_client = AgentClient(self.socket_path)
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_register_and_deregister(self):
+        with mock.patch.object(self.client.services, 'remove') as remove:
+            self.assertTrue(self.agent_client.register('dfw1-db1', 30))
+
+            services = self.agent_client.list()
+            self.assertEqual(len(services), 1)
+            self.assertEqual(services[0]['id'], 'dfw1-db1')
+            self.assertTrue(services[0]['registered'])
+
+            heartbeater = self.agent.registrations['dfw1-db1'].heartbeater
+            self.assertTrue(self.agent_client.deregister('dfw1-db1'))
+            self.assertTrue(heartbeater._stopped)
+            remove.assert_called_once_with('dfw1-db1')
+
+        self.assertEqual(self.agent_client.list(), [])
+
+    def test_register_is_idempotent(self):
+        with mock.patch.object(self.client.services, 'create',
+                               wraps=self.client.services.create) as create:
+            self.agent_client.register('dfw1-db1', 30)
+            self.agent_client.register('dfw1-db1', 30)
+
+            self.assertEqual(create.call_count, 1)
+
+        self.assertRaises(AgentError, self.agent_client.register,
+                          'dfw1-db1', 10)
+
+    def test_payload_update(self):
+        registration = self.agent.register('dfw1-db1', 30)
+        error = ValidationError(type='validationError', code=400,
+                                message='invalid', txnId=None, details='')
+        lock_held = []
+
+        def update(service_id, payload):
+            lock_held.append(not self.agent._lock.acquire(False))
+
+            if not lock_held[-1]:
+                self.agent._lock.release()
+
+            if payload.get('metadata', None) == {'version': 'bad'}:
+                raise error
+
+        with mock.patch.object(self.client.services, 'update',
+                               side_effect=update):
+            self.assertRaises(ValidationError, self.agent.register,
+                              'dfw1-db1', 30, {'metadata': {'version': 'bad'}})
+            self.assertEqual(registration.payload, None)
+
+            self.agent.register('dfw1-db1', 30, {'metadata': {'version': '2'}})
+            self.assertEqual(registration.payload,
+                             {'metadata': {'version': '2'}})
+
+        self.assertEqual(lock_held, [False, False])
+
+    def test_invalid_registration_is_dropped(self):
+        error = ValidationError(type='validationError', code=400,
+                                message='invalid', txnId=None, details='')
+
+        with mock.patch.object(self.client.services, 'create',
+                               side_effect=error):
+            self.assertRaises(AgentError, self.agent_client.register,
+                              'dfw1-db1', 30)
+
+        self.assertEqual(self.agent.registrations, {})
+
+    def test_invalid_commands(self):
+        self.assertRaises(AgentError, self.agent_client._call,
+                          {'op': 'unknown'})
+        self.assertRaises(AgentError, self.agent_client._call,
+                          {'op': 'register'})
+        self.assertRaises(AgentError, self.agent_client.deregister,
+                          'missing')
+
+    def test_refuses_to_replace_a_running_agent(self):
+        other = HeartbeatAgent(self.client, socket_path=self.socket_path)
+
+        self.assertRaises(AgentError, other.serve_forever)
+        self.assertEqual(self.agent_client.list(), [])
+
+    def test_stale_socket_is_replaced(self):
+        path = os.path.join(self.tmp_dir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+
+        agent = HeartbeatAgent(self.client, socket_path=path)
+        agent._remove_stale_socket()
+        self.assertFalse(os.path.exists(path))
+
+        open(path, 'w').close()
+        self.assertRaises(AgentError, agent._remove_stale_socket)
+        self.assertTrue(os.path.exists(path))
+
+    def test_default_socket_directory_is_private(self):
+        socket_dir = os.path.join(self.tmp_dir, 'agent-%(uid)d')
+
+        with mock.patch('service_registry.agent.AGENT_SOCKET_DIR',
+                        socket_dir):
+            path = get_socket_path()
+            self.assertEqual(os.path.dirname(path),
+                             socket_dir % {'uid': os.getuid()})
+
+            agent = HeartbeatAgent(self.client)
+            thread = threading.Thread(target=agent.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+            while not os.path.exists(path):
+                time.sleep(0.01)
+
+            try:
+                self.assertEqual(os.stat(os.path.dirname(path)).st_mode &
+                                 0777, 0700)
+                self.assertEqual(AgentClient().list(), [])
+
+                os.chmod(os.path.dirname(path), 0777)
+                self.assertRaises(AgentError, AgentClient().list)
+            finally:
+                agent.shutdown()
+                thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,11 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
+import requests
+import threading
+import time
 import unittest
 
+from StringIO import StringIO
+from concurrent.futures import Future
+
+from service_registry import models
+from service_registry.auth import Authenticator
 from service_registry.client import Client
-from service_registry.heartbeater import HeartBeater
+from service_registry.deadline import get_deadline
+from service_registry.errors import APIError, ValidationError
+from service_registry.errors import DeadlineExceededError
+from service_registry.heartbeater import HeartBeater, get_phase
+from service_registry.models import Service, Event, ConfigurationValue
+from service_registry.ratelimit import ConcurrencyLimiter, PriorityLimiter
+from service_registry.ratelimit import CRITICAL, NORMAL, BULK
+from service_registry.test.utils import event
 
 TOKENS = ['6bc8d050-f86a-11e1-a89e-ca2ffe480b20']
 
@@ -63,6 +79,140 @@ class FarscapeClientTests(unittest.TestCase):
         self.assertEqual(result[1].heartbeat_timeout, 30)
         self.assertEqual(result[1].next_token, TOKENS[0])
 
+    def _get_heartbeater(self, heartbeat_timeout=30, **kwargs):
+        return HeartBeater('http://127.0.0.1:8881/', 'user', 'api_key', 'us',
+                           'dfw1-db1', heartbeat_timeout, **kwargs)
+
+    @authenticate
+    def test_send_heartbeat(self):
+        heartbeater = self._get_heartbeater()
+        real_send = heartbeater._send
+        sent = []
+
+        def send(path, request_kwargs, priority):
+            sent.append((path, json.loads(request_kwargs['data'])))
+            self.assertEqual(priority, CRITICAL)
+            return real_send(path, request_kwargs, priority)
+
+        with mock.patch.object(heartbeater, '_send', side_effect=send):
+            self.assertEqual(heartbeater._send_heartbeat('someToken'),
+                             TOKENS[0])
+            kwargs = heartbeater._prepared_kwargs
+            self.assertEqual(heartbeater._send_heartbeat('other"Token'),
+                             TOKENS[0])
+
+        self.assertTrue(heartbeater._prepared_kwargs is kwargs)
+        self.assertEqual(sent, [('tenant_id/services/dfw1-db1/heartbeat',
+                                 {'token': 'someToken'}),
+                                ('tenant_id/services/dfw1-db1/heartbeat',
+                                 {'token': 'other"Token'})])
+
+    def test_send_heartbeat_re_authenticates(self):
+        heartbeater = self._get_heartbeater()
+        old_headers = {'X-Auth-Token': 'old', 'X-Tenant-Id': 'tenant_id'}
+        new_headers = {'X-Auth-Token': 'new', 'X-Tenant-Id': 'tenant_id'}
+        unauthorized = mock.Mock(status_code=401)
+        ok = mock.Mock(status_code=200, content='{"token": "next"}')
+
+        with mock.patch.object(heartbeater, '_authenticate',
+                               side_effect=[old_headers, new_headers]):
+            with mock.patch.object(heartbeater, '_send',
+                                   side_effect=[unauthorized, ok]) as send:
+                self.assertEqual(heartbeater._send_heartbeat('token'),
+                                 'next')
+
+        self.assertEqual(send.call_args[0][1]['headers']['X-Auth-Token'],
+                         'new')
+
+        heartbeater._authenticate = mock.Mock(return_value=new_headers)
+        heartbeater._send = mock.Mock(return_value=unauthorized)
+        self.assertRaises(APIError, heartbeater._send_heartbeat, 'token')
+
+    def test_heartbeat_stats(self):
+        stats = self._get_heartbeater().stats
+
+        for rtt in range(1, 101):
+            stats.record(rtt / 100.0, 30 - rtt / 10.0)
+
+        stats.record(0.5, 1)
+        stats.record(0.5, -1)
+
+        self.assertEqual(len(stats.rtts), 100)
+        self.assertEqual(stats.rtt_percentile(99), 0.99)
+        self.assertEqual(stats.rtt_percentile(50), 0.5)
+        self.assertEqual(stats.beats, 102)
+        self.assertEqual(stats.near_misses, 2)
+        self.assertEqual(stats.last_margin, -1)
+        self.assertEqual(stats.margin_histogram[0], 1)
+        self.assertEqual(stats.margin_histogram[0.05], 1)
+        self.assertEqual(stats.margin_histogram[1.0], 100)
+        self.assertEqual(sum(stats.margin_histogram.values()), 102)
+
+    def test_adaptive_interval(self):
+        heartbeater = self._get_heartbeater(adaptive=True)
+
+        self.assertEqual(heartbeater._calculate_adaptive_interval(), 24.0)
+
+        heartbeater.stats.record(0.1, 29)
+        self.assertEqual(heartbeater._calculate_adaptive_interval(), 27.0)
+
+        heartbeater.stats.record(2, 27)
+        self.assertEqual(heartbeater._calculate_adaptive_interval(), 24.0)
+
+        heartbeater.stats.record(60, 0)
+        self.assertEqual(heartbeater._calculate_adaptive_interval(), 3.0)
+
+    @authenticate
+    def test_adaptive_heartbeating(self):
+        heartbeater = self._get_heartbeater(heartbeat_timeout=1,
+                                            adaptive=True)
+
+        def send_heartbeat(token):
+            if heartbeater.stats.beats == 2:
+                heartbeater.stop()
+
+            return TOKENS[0]
+
+        with mock.patch.object(heartbeater, '_send_heartbeat',
+                               side_effect=send_heartbeat):
+            heartbeater.start()
+
+        self.assertEqual(heartbeater.stats.beats, 3)
+        self.assertEqual(heartbeater.stats.near_misses, 0)
+        self.assertTrue(heartbeater.stats.last_margin > 0)
+
+    def test_heartbeating_retries_until_the_timeout(self):
+        heartbeater = self._get_heartbeater(phase_spread=0)
+        heartbeater.last_sent = time.time()
+        heartbeater._wakeup.wait = mock.Mock()
+        heartbeater._get_wait_time = mock.Mock(return_value=24)
+        errors = [requests.Timeout(), DeadlineExceededError('expired')]
+
+        def send_heartbeat(token):
+            if errors:
+                raise errors.pop(0)
+
+            heartbeater.stop()
+            return 'next'
+
+        with mock.patch.object(heartbeater, '_send_heartbeat',
+                               side_effect=send_heartbeat) as send:
+            heartbeater.start()
+
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(heartbeater.next_token, 'next')
+        self.assertEqual([call[0][0] for call in
+                          heartbeater._wakeup.wait.call_args_list],
+                         [24, 1, 1])
+
+        # Once the service has timed out, the error is raised.
+        heartbeater._stopped = False
+        heartbeater.last_sent = time.time() - 30
+
+        with mock.patch.object(heartbeater, '_send_heartbeat',
+                               side_effect=requests.ConnectionError()):
+            self.assertRaises(requests.ConnectionError, heartbeater.start)
+
     @authenticate
     def test_heartbeat_service(self):
         result = self.client.services.heartbeat('dfw1-db1', 'someToken')
@@ -77,6 +227,119 @@ class FarscapeClientTests(unittest.TestCase):
         self.assertEqual(result['tags'], ['db', 'mysql'])
         self.assertEqual(result['metadata'], EXPECTED_METADATA)
 
+    @authenticate
+    def test_update_many_services(self):
+        services = self.client.services
+        services.update('web-1', {'metadata': {'version': '1'}})
+        current = {'web-2': services.get('dfw1-db1')}
+        current['web-2']['metadata'] = {'version': '2'}
+
+        with mock.patch.object(services, 'update',
+                               wraps=services.update) as update:
+            report = services.update_many(
+                {'web-1': {'metadata': {'version': '1'}},
+                 'web-2': {'metadata': {'version': '2'}},
+                 'web-3': {'metadata': {'version': '2'}},
+                 'web-4': {'metadata': {'version': '2'}}},
+                max_concurrency=2, current=current)
+
+        self.assertEqual(sorted(report['updated']), ['web-3', 'web-4'])
+        self.assertEqual(report['unchanged'], ['web-1', 'web-2'])
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(update.call_count, 2)
+
+        report = services.update_many({'web-3': {'metadata':
+                                                 {'version': '2'}},
+                                       'web-4': {'tags': ['new']}})
+        self.assertEqual(report['updated'], ['web-4'])
+        self.assertEqual(report['unchanged'], ['web-3'])
+
+    @authenticate
+    def test_update_many_forgets_payloads_of_expired_services(self):
+        services = self.client.services
+        services.update('web-1', {'metadata': {'version': '1'}})
+        services.update('web-2', {'metadata': {'version': '1'}})
+
+        services.handle_event(event('1', 'web-1', type='service.timeout'))
+        services.handle_event(Event.from_dict(event('2', 'web-2')))
+
+        with mock.patch.object(services, 'update') as update:
+            report = services.update_many(
+                {'web-1': {'metadata': {'version': '1'}},
+                 'web-2': {'metadata': {'version': '1'}}})
+
+        self.assertEqual(report['updated'], ['web-1'])
+        self.assertEqual(report['unchanged'], ['web-2'])
+        update.assert_called_once_with('web-1',
+                                       {'metadata': {'version': '1'}})
+
+    @authenticate
+    def test_known_payloads_are_bounded(self):
+        services = self.client.services
+
+        with mock.patch('service_registry.client.KNOWN_PAYLOADS_SIZE', 2):
+            for service_id in ['web-1', 'web-2', 'web-1', 'web-3']:
+                services.update(service_id, {'tags': [service_id]})
+
+        self.assertEqual(services._known_payloads.keys(), ['web-1', 'web-3'])
+
+    @authenticate
+    def test_update_many_is_not_limited_by_the_executor(self):
+        services = self.client.services
+        lock = threading.Lock()
+        all_started = threading.Event()
+        active = []
+
+        def update(service_id, payload):
+            lock.acquire()
+            try:
+                active.append(service_id)
+
+                if len(active) == 20:
+                    all_started.set()
+            finally:
+                lock.release()
+
+            all_started.wait(5)
+
+        payloads = dict([('web-%d' % (index), {'tags': ['a']})
+                         for index in range(20)])
+
+        with mock.patch.object(services, 'update', side_effect=update):
+            report = services.update_many(payloads, max_concurrency=20)
+
+        self.assertTrue(all_started.is_set())
+        self.assertEqual(len(report['updated']), 20)
+
+    @authenticate
+    def test_update_many_from_workers(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        max_workers=2)
+        self.addCleanup(client.close)
+
+        def update_many(client, tag):
+            return client.services.update_many(
+                {'web-1': {'tags': [tag]}, 'web-2': {'tags': [tag]}})
+
+        # Every worker is busy waiting for updates of its own.
+        futures = [client.submit(update_many, str(index))
+                   for index in range(4)]
+
+        for future in futures:
+            self.assertEqual(future.result(timeout=5)['errors'], {})
+
+    @authenticate
+    def test_update_many_services_reports_errors(self):
+        services = self.client.services
+        error = ValidationError(type='validationError', code=400,
+                                message='invalid', txnId=None, details='')
+
+        with mock.patch.object(services, 'update', side_effect=error):
+            report = services.update_many({'web-1': {'tags': ['a']}})
+
+        self.assertEqual(report['updated'], [])
+        self.assertEqual(report['errors'], {'web-1': error})
+
     @authenticate
     def test_list_services(self):
         result = self.client.services.list()
@@ -133,6 +396,697 @@ class FarscapeClientTests(unittest.TestCase):
         self.assertEqual(result['id'], 'configId')
         self.assertEqual(result['value'], 'test value 123456')
 
+    @authenticate
+    def test_list_services_as_models(self):
+        result = self.client.services.list(as_models=True)
+        service = result['values'][1]
+
+        self.assertTrue(isinstance(service, Service))
+        self.assertEqual(service.id, 'dfw1-db1')
+        self.assertEqual(service.heartbeat_timeout, 30)
+        self.assertEqual(service.tags, ('db', 'mysql'))
+        self.assertEqual(service.metadata, EXPECTED_METADATA)
+        self.assertEqual(service.get_metadata('port'), '3306')
+        self.assertEqual(service.get_metadata('missing', 'x'), 'x')
+        self.assertTrue('metadata' in result)
+
+    @authenticate
+    def test_services_as_models_share_interned_strings(self):
+        first = self.client.services.list_for_tag('db', as_models=True)
+        second = self.client.services.list_for_tag('db', as_models=True)
+
+        self.assertTrue(first['values'][0].tags[0] is
+                        second['values'][0].tags[0])
+
+        def key(service, name):
+            return [key for key in service.metadata if key == name][0]
+
+        self.assertTrue(key(first['values'][0], 'port') is
+                        key(second['values'][0], 'port'))
+
+    @authenticate
+    def test_service_metadata_is_decoded_once(self):
+        service = self.client.services.list(as_models=True)['values'][1]
+        self.assertEqual(service.get_metadata('port'), '3306')
+        self.assertTrue(service._metadata is None)
+
+        metadata = service.metadata
+        metadata['port'] = '3307'
+
+        self.assertTrue(service.metadata is metadata)
+        self.assertEqual(service.get_metadata('port'), '3307')
+        self.assertEqual(service.to_dict()['metadata']['port'], '3307')
+
+    def test_interned_strings_are_bounded(self):
+        known = models.intern_string(u'db')
+        size = len(models._STRINGS)
+
+        with mock.patch('service_registry.models.INTERNED_STRINGS_SIZE',
+                        size):
+            tag = u'unique-tag-%d' % (size)
+
+            self.assertTrue(models.intern_string(tag) is tag)
+            self.assertTrue(models.intern_string(u'db') is known)
+            self.assertEqual(len(models._STRINGS), size)
+
+    def test_models_are_hashable(self):
+        first = Service('web-1', tags=['a'], metadata={'port': '80'})
+        second = Service('web-1', tags=['a'], metadata={'port': '80'})
+
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual(len(set([first, second, Service('web-2')])), 2)
+
+    @authenticate
+    def test_list_events_as_models(self):
+        result = self.client.events.list(as_models=True)
+        event = result['values'][0]
+
+        self.assertTrue(isinstance(event, Event))
+        self.assertEqual(event.type, 'service.join')
+        self.assertEqual(event.timestamp, 1346967146370)
+        self.assertEqual(event.service.id, 'dfw1-api')
+        self.assertEqual(result['values'][2].service, None)
+
+    @authenticate
+    def test_list_services_streaming(self):
+        result = self.client.services.list(stream=True)
+
+        self.assertEqual(result.metadata, None)
+
+        values = list(result)
+
+        self.assertEqual([value['id'] for value in values],
+                         ['dfw1-api', 'dfw1-db1'])
+        self.assertEqual(values[1]['metadata'], EXPECTED_METADATA)
+        self.assertEqual(result.metadata['count'], 2)
+
+    @authenticate
+    def test_list_events_streaming_as_models(self):
+        events = list(self.client.events.list(stream=True, as_models=True))
+
+        self.assertEqual(len(events), 3)
+        self.assertTrue(isinstance(events[0], Event))
+        self.assertEqual(events[2].type, 'configuration_value.update')
+
+    @authenticate
+    def test_list_configuration_as_models(self):
+        result = self.client.configuration.list(as_models=True)
+
+        self.assertEqual(result['values'],
+                         [ConfigurationValue('configId',
+                                             'test value 123456')])
+
+    def _run_concurrently(self, fn, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn()))
+                   for _ in range(count)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    @authenticate
+    def test_concurrent_identical_gets_are_coalesced(self):
+        real_request = self.client.session.request
+        urls = []
+
+        def slow_request(**kwargs):
+            urls.append(kwargs['url'])
+            time.sleep(0.2)
+            return real_request(**kwargs)
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=slow_request):
+            results = self._run_concurrently(
+                lambda: self.client.services.list_for_tag('db'))
+
+        self.assertEqual(len(urls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all([result is results[0] for result in results]))
+        self.assertEqual(results[0]['values'][0]['id'], 'dfw1-db1')
+
+    @authenticate
+    def test_coalesced_gets_share_errors(self):
+        errors = []
+
+        def failing_request(**kwargs):
+            time.sleep(0.2)
+            raise requests.ConnectionError('connection refused')
+
+        def get():
+            try:
+                self.client.configuration.get('configId')
+            except requests.ConnectionError as e:
+                errors.append(e)
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=failing_request) as request:
+            self._run_concurrently(get)
+
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(len(errors), 5)
+
+    @authenticate
+    def test_coalesced_gets_do_not_share_deadlines(self):
+        real_request = self.client.session.request
+        leader_started = threading.Event()
+        errors = []
+
+        def request(**kwargs):
+            if not leader_started.is_set():
+                leader_started.set()
+                time.sleep(0.2)
+                raise requests.Timeout('timed out')
+
+            return real_request(**kwargs)
+
+        def get_with_deadline():
+            try:
+                with self.client.deadline(0.1):
+                    self.client.services.get('dfw1-db1')
+            except DeadlineExceededError as e:
+                errors.append(e)
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=request) as send:
+            leader = threading.Thread(target=get_with_deadline)
+            leader.start()
+            leader_started.wait(5)
+
+            # Joins the leader's call and then has to make its own.
+            service = self.client.services.get('dfw1-db1')
+            leader.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(service['id'], 'dfw1-db1')
+        self.assertEqual(send.call_count, 2)
+
+    @authenticate
+    def test_gets_are_not_coalesced_when_disabled(self):
+        self.client.services.coalesce_gets = False
+        real_request = self.client.session.request
+
+        def slow_request(**kwargs):
+            time.sleep(0.1)
+            return real_request(**kwargs)
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=slow_request) as request:
+            self._run_concurrently(lambda: self.client.services.list(),
+                                   count=3)
+
+        self.assertEqual(request.call_count, 3)
+
+    @authenticate
+    def test_submit(self):
+        future = self.client.submit(lambda c, service_id:
+                                    c.services.get(service_id), 'dfw1-db1')
+
+        self.assertTrue(isinstance(future, Future))
+        self.assertEqual(future.result(timeout=5)['id'], 'dfw1-db1')
+
+    @authenticate
+    def test_map(self):
+        results = self.client.map(lambda c, path: getattr(c, path).list(),
+                                  ['services', 'configuration'], timeout=5)
+        results = list(results)
+
+        self.assertEqual(results[0]['values'][0]['id'], 'dfw1-api')
+        self.assertEqual(results[1]['values'][0]['id'], 'configId')
+
+    @authenticate
+    def test_async_methods(self):
+        future = self.client.configuration.get_async('configId')
+
+        self.assertTrue(isinstance(future, Future))
+        self.assertEqual(future.result(timeout=5)['value'],
+                         'test value 123456')
+        self.assertRaises(AttributeError, getattr, self.client.services,
+                          'missing_async')
+
+    @authenticate
+    def test_sub_clients_share_transport(self):
+        _, heartbeater = self.client.services.create('dfw1-db1', 30)
+
+        for client in [self.client.events, self.client.configuration,
+                       self.client.account, heartbeater]:
+            self.assertTrue(client.session is self.client.session)
+            self.assertTrue(client.executor is self.client.executor)
+            self.assertTrue(client.authenticator is
+                            self.client.authenticator)
+            self.assertTrue(client.endpoints is self.client.endpoints)
+
+    def test_authenticator_caches_token(self):
+        authenticator = Authenticator('user', 'api_key', 'us')
+        headers = {'X-Auth-Token': 'auth_token', 'X-Tenant-Id': 'tenant_id'}
+
+        def authenticate():
+            authenticator.auth_token_expires = time.time() + 3600
+            return headers
+
+        with mock.patch.object(authenticator, '_authenticate',
+                               side_effect=authenticate) as _authenticate:
+            self.assertEqual(authenticator.get_headers(), headers)
+            self.assertEqual(authenticator.get_headers(), headers)
+            self.assertEqual(_authenticate.call_count, 1)
+
+            authenticator.get_headers(force=True)
+            self.assertEqual(_authenticate.call_count, 2)
+
+            authenticator.auth_token_expires = time.time()
+            authenticator.get_headers()
+            self.assertEqual(_authenticate.call_count, 3)
+
+    def test_rejected_headers_are_renewed_once(self):
+        authenticator = Authenticator('user', 'api_key', 'us')
+        tokens = []
+
+        def authenticate():
+            tokens.append('token-%d' % (len(tokens)))
+            authenticator.auth_token_expires = time.time() + 3600
+            return {'X-Auth-Token': tokens[-1], 'X-Tenant-Id': 'tenant_id'}
+
+        with mock.patch.object(authenticator, '_authenticate',
+                               side_effect=authenticate):
+            rejected = authenticator.get_headers()
+            renewed = [authenticator.get_headers(rejected=dict(rejected))
+                       for _ in range(10)]
+
+        self.assertEqual(tokens, ['token-0', 'token-1'])
+        self.assertEqual(set([h['X-Auth-Token'] for h in renewed]),
+                         set(['token-1']))
+
+    def test_request_renews_rejected_headers(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        self.addCleanup(client.close)
+        services = client.services
+        old_headers = {'X-Auth-Token': 'old', 'X-Tenant-Id': 'tenant_id'}
+        new_headers = {'X-Auth-Token': 'new', 'X-Tenant-Id': 'tenant_id'}
+        unauthorized = mock.Mock(status_code=401)
+
+        with mock.patch.object(services, '_authenticate',
+                               side_effect=[old_headers, new_headers]) as auth:
+            with mock.patch.object(services, '_send',
+                                   return_value=unauthorized):
+                self.assertRaises(APIError, services.get, 'dfw1-db1')
+
+        self.assertEqual(auth.call_args_list,
+                         [mock.call(force=False, rejected=None),
+                          mock.call(force=False, rejected=old_headers)])
+
+    def _get_multi_endpoint_client(self):
+        client = Client('user', 'api_key',
+                        ['http://127.0.0.1:1/', 'http://127.0.0.1:8881/'])
+        # Keep the background probe from reordering the endpoints.
+        client.endpoints._last_probe = time.time()
+        return client
+
+    @authenticate
+    def test_failover_on_connection_error(self):
+        client = self._get_multi_endpoint_client()
+        result = client.services.get('dfw1-db1')
+        endpoints = client.endpoints.endpoints
+
+        self.assertEqual(result['id'], 'dfw1-db1')
+        self.assertEqual(endpoints[0].failures, 1)
+        self.assertFalse(endpoints[0].is_healthy())
+        self.assertEqual(client.endpoints.ordered()[0].url,
+                         'http://127.0.0.1:8881/')
+
+    @authenticate
+    def test_failover_on_server_error(self):
+        client = self._get_multi_endpoint_client()
+        client.endpoints.endpoints.reverse()
+        real_request = client.session.request
+        unavailable = mock.Mock(status_code=503)
+
+        def request(**kwargs):
+            if kwargs['url'].startswith('http://127.0.0.1:8881/'):
+                return unavailable
+
+            return real_request(**kwargs)
+
+        with mock.patch.object(client.session, 'request',
+                               side_effect=request) as session_request:
+            self.assertRaises(requests.ConnectionError,
+                              client.services.get, 'dfw1-db1')
+            self.assertEqual(session_request.call_count, 2)
+
+    @authenticate
+    def test_single_endpoint_server_error_is_not_retried(self):
+        unavailable = mock.Mock(status_code=503)
+        unavailable.json.return_value = {'type': 'serviceUnavailable',
+                                         'code': 503, 'message': '',
+                                         'details': ''}
+
+        with mock.patch.object(self.client.session, 'request',
+                               return_value=unavailable) as session_request:
+            self.assertRaises(ValidationError, self.client.services.get,
+                              'dfw1-db1')
+            self.assertEqual(session_request.call_count, 1)
+
+    @authenticate
+    def test_post_fails_over_if_not_connected(self):
+        client = self._get_multi_endpoint_client()
+        result, heartbeater = client.services.create('dfw1-db1', 30)
+
+        self.assertEqual(client.endpoints.endpoints[0].failures, 1)
+        self.assertEqual(heartbeater.next_token, result['token'])
+
+    @authenticate
+    def test_post_is_not_resent_after_server_error(self):
+        client = self._get_multi_endpoint_client()
+        client.endpoints.endpoints.reverse()
+        unavailable = mock.Mock(status_code=503, headers={})
+        unavailable.json.return_value = {'type': 'serviceUnavailable',
+                                         'code': 503, 'message': '',
+                                         'details': ''}
+
+        with mock.patch.object(client.session, 'request',
+                               return_value=unavailable) as session_request:
+            self.assertRaises(ValidationError, client.services.create,
+                              'dfw1-db1', 30)
+            self.assertEqual(session_request.call_count, 1)
+
+        self.assertEqual(client.endpoints.endpoints[0].failures, 1)
+
+    @authenticate
+    def test_post_is_not_resent_after_timeout(self):
+        client = self._get_multi_endpoint_client()
+        client.endpoints.endpoints.reverse()
+
+        with mock.patch.object(client.session, 'request',
+                               side_effect=requests.Timeout()) as request:
+            self.assertRaises(requests.Timeout, client.services.create,
+                              'dfw1-db1', 30)
+            self.assertEqual(request.call_count, 1)
+
+    def test_probe_orders_endpoints_by_rtt(self):
+        client = self._get_multi_endpoint_client()
+        client.endpoints.probe()
+        endpoints = client.endpoints.ordered()
+
+        self.assertEqual(endpoints[0].url, 'http://127.0.0.1:8881/')
+        self.assertTrue(endpoints[0].rtt is not None)
+        self.assertEqual(endpoints[1].rtt, None)
+
+    @authenticate
+    def test_export_configuration(self):
+        fp = StringIO()
+        count = self.client.configuration.export('api', fp)
+        lines = fp.getvalue().splitlines()
+
+        self.assertEqual(count, 2)
+        self.assertEqual(json.loads(lines[0]),
+                         {'id': '/api/key-1', 'value': 'test value 123456'})
+        self.assertEqual(json.loads(lines[1]),
+                         {'id': '/api/key-2', 'value': 'test value 23456'})
+
+    @authenticate
+    def test_sync_configuration(self):
+        configuration = self.client.configuration
+        desired = {'api': {'key-1': 'test value 123456',
+                           'key-3': 'new value'},
+                   '/api/key-2': 'changed value'}
+
+        with mock.patch.object(configuration, 'set') as set_value:
+            with mock.patch.object(configuration, 'remove') as remove:
+                report = configuration.sync(desired, namespace='api')
+
+        self.assertEqual(report['created'], ['/api/key-3'])
+        self.assertEqual(report['updated'], ['/api/key-2'])
+        self.assertEqual(report['unchanged'], ['/api/key-1'])
+        self.assertEqual(report['removed'], [])
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(sorted(set_value.call_args_list),
+                         [mock.call('/api/key-2', 'changed value'),
+                          mock.call('/api/key-3', 'new value')])
+        self.assertFalse(remove.called)
+
+    @authenticate
+    def test_sync_configuration_from_workers(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        max_workers=1)
+        self.addCleanup(client.close)
+        configuration = client.configuration
+
+        def sync(client):
+            return client.configuration.sync({'api': {'key-3': 'a',
+                                                      'key-4': 'b'}},
+                                             namespace='api')
+
+        with mock.patch.object(configuration, 'set') as set_value:
+            with mock.patch.object(configuration, 'remove'):
+                # The only worker waits for the calls of the sync.
+                report = client.submit(sync).result(timeout=5)
+
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(set_value.call_count, 2)
+
+    @authenticate
+    def test_sync_configuration_removes_and_reports_errors(self):
+        configuration = self.client.configuration
+        error = ValidationError(type='validationError', code=400,
+                                message='invalid', txnId=None, details='')
+
+        with mock.patch.object(configuration, 'set', side_effect=error):
+            with mock.patch.object(configuration, 'remove') as remove:
+                report = configuration.sync({'other': 'value'},
+                                            namespace='/')
+
+        self.assertEqual(report['created'], ['/other'])
+        self.assertEqual(report['removed'], ['/configId'])
+        self.assertEqual(report['errors'], {'/other': error})
+        remove.assert_called_once_with('configId')
+
+    @authenticate
+    def test_sync_configuration_removal_requires_a_namespace(self):
+        configuration = self.client.configuration
+
+        with mock.patch.object(configuration, 'set') as set_value:
+            with mock.patch.object(configuration, 'remove') as remove:
+                self.assertRaises(ValueError, configuration.sync, {})
+                report = configuration.sync({'configId': 'value'},
+                                            remove=False)
+
+        self.assertEqual(report['updated'], ['/configId'])
+        self.assertEqual(report['removed'], [])
+        set_value.assert_called_once_with('/configId', 'value')
+        self.assertFalse(remove.called)
+
+    @authenticate
+    def test_sync_configuration_dry_run(self):
+        configuration = self.client.configuration
+
+        with mock.patch.object(configuration, 'remove') as remove:
+            report = configuration.sync({}, namespace='/', dry_run=True)
+
+        self.assertEqual(report['removed'], ['/configId'])
+        self.assertFalse(remove.called)
+        self.assertRaises(ValueError, configuration.sync,
+                          {'/other/key': 'value'}, namespace='api')
+
+    @authenticate
+    def test_requests_use_client_timeout(self):
+        real_request = self.client.session.request
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=real_request) as request:
+            self.client.services.get('dfw1-db1')
+
+        self.assertEqual(request.call_args[1]['timeout'], 30)
+
+    @authenticate
+    def test_per_request_timeout(self):
+        real_request = self.client.session.request
+        services = self.client.services
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=real_request) as request:
+            services.request('GET', '/services/dfw1-db1', timeout=5)
+            self.assertEqual(request.call_args[1]['timeout'], 5)
+
+            services.request('DELETE', '/services/dfw1-db1', timeout=7)
+            self.assertEqual(request.call_args[1]['timeout'], 7)
+
+            with self.client.deadline(2):
+                services.request('GET', '/services/dfw1-db1', timeout=5)
+                self.assertTrue(0 < request.call_args[1]['timeout'] <= 2)
+
+            services.request('GET', '/services/dfw1-db1')
+            self.assertEqual(request.call_args[1]['timeout'], 30)
+
+    @authenticate
+    def test_per_call_timeout(self):
+        real_request = self.client.session.request
+        client = self.client
+
+        with mock.patch.object(client.session, 'request',
+                               side_effect=real_request) as request:
+            client.services.get('dfw1-db1', timeout=5)
+            self.assertEqual(request.call_args[1]['timeout'], 5)
+
+            client.services.list(timeout=6)
+            self.assertEqual(request.call_args[1]['timeout'], 6)
+
+            list(client.services.list(stream=True, timeout=7))
+            self.assertEqual(request.call_args[1]['timeout'], 7)
+
+            client.configuration.get('configId', timeout=8)
+            self.assertEqual(request.call_args[1]['timeout'], 8)
+
+            client.events.list(timeout=9)
+            self.assertEqual(request.call_args[1]['timeout'], 9)
+
+    @authenticate
+    def test_deadline_limits_request_timeout(self):
+        real_request = self.client.session.request
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=real_request) as request:
+            with self.client.deadline(2):
+                self.client.services.get('dfw1-db1')
+
+                with self.client.deadline(60):
+                    self.client.services.get('dfw1-db1')
+
+        for call in request.call_args_list:
+            self.assertTrue(0 < call[1]['timeout'] <= 2)
+
+    @authenticate
+    def test_expired_deadline(self):
+        with mock.patch.object(self.client.session, 'request') as request:
+            with self.client.deadline(0):
+                self.assertRaises(DeadlineExceededError,
+                                  self.client.services.list)
+
+        self.assertFalse(request.called)
+        self.assertEqual(get_deadline(), None)
+
+    def test_deadline_is_propagated_to_workers(self):
+        with self.client.deadline(5) as current:
+            future = self.client.submit(lambda c: get_deadline())
+
+        with self.client.deadline(0):
+            async_future = self.client.services.get_async('dfw1-db1')
+
+        self.assertTrue(future.result(timeout=5) is current)
+        self.assertRaises(DeadlineExceededError, async_future.result, 5)
+
+    @mock.patch('service_registry.client.sleep')
+    def test_register_retries_until_deadline(self, sleep):
+        error = ValidationError(type='serviceWithThisIdExists', code=409,
+                                message='exists', txnId=None, details='')
+        services = self.client.services
+
+        with mock.patch.object(services, 'create', side_effect=error):
+            self.assertEqual(services.register('dfw1-db1', 30), error)
+            self.assertEqual(sleep.call_count, 60)
+
+            with self.client.deadline(5):
+                self.assertRaises(DeadlineExceededError, services.register,
+                                  'dfw1-db1', 30, retry_delay=10)
+
+        with mock.patch.object(services, 'create',
+                               side_effect=[error, 'created']):
+            self.assertEqual(services.register('dfw1-db1', 30), 'created')
+
+    @mock.patch('service_registry.client.sleep')
+    def test_register_spreads_first_attempt(self, sleep):
+        services = self.client.services
+
+        with mock.patch.object(services, 'create', return_value='created'):
+            services.register('dfw1-db1', 30, spread=10)
+            services.register('dfw1-db1', 30, spread=10)
+            services.register('dfw1-db2', 30, spread=10)
+
+            with self.client.deadline(1):
+                services.register('dfw1-db1', 30, spread=10)
+
+        delays = [args[0] for args, kwargs in sleep.call_args_list]
+        self.assertEqual(delays[0], delays[1])
+        self.assertNotEqual(delays[0], delays[2])
+        self.assertTrue(0 <= delays[0] < 10)
+        self.assertTrue(delays[3] <= 0.5)
+
+    def test_get_phase(self):
+        phases = [get_phase('service-%d' % (index), 10)
+                  for index in range(1000)]
+
+        self.assertEqual(phases[0], get_phase('service-0', 10))
+        self.assertTrue(min(phases) >= 0 and max(phases) < 10)
+        self.assertTrue(len([p for p in phases if p < 5]) > 400)
+        self.assertTrue(len([p for p in phases if p >= 5]) > 400)
+
+    def test_first_heartbeat_is_phase_spread(self):
+        waits = []
+
+        for service_id, phase_spread in [('a', 0.5), ('b', 0.5), ('a', 0)]:
+            heartbeater = HeartBeater('http://127.0.0.1:8881/', 'user',
+                                      'api_key', 'us', service_id, 30,
+                                      phase_spread=phase_spread)
+            heartbeater._wakeup.wait = mock.Mock(
+                side_effect=lambda timeout: heartbeater.stop())
+            heartbeater._get_wait_time = mock.Mock(return_value=24)
+            heartbeater.start()
+            waits.append(heartbeater._wakeup.wait.call_args[0][0])
+
+        self.assertEqual(waits[0], 24 - get_phase('a', 12))
+        self.assertEqual(waits[1], 24 - get_phase('b', 12))
+        self.assertNotEqual(waits[0], waits[1])
+        self.assertEqual(waits[2], 24)
+
+    @authenticate
+    def test_create_goes_through_registration_limiter(self):
+        limiter = ConcurrencyLimiter(1)
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        registration_limiter=limiter)
+        active = []
+
+        def request(*args, **kwargs):
+            active.append(limiter.active)
+            raise ValidationError(type='serviceWithThisIdExists', code=409,
+                                  message='exists', txnId=None, details='')
+
+        with mock.patch.object(client.services, 'request',
+                               side_effect=request):
+            self.assertRaises(ValidationError, client.services.create,
+                              'dfw1-db1', 30)
+
+        self.assertEqual(active, [1])
+        self.assertEqual(limiter.active, 0)
+
+    @authenticate
+    def test_requests_use_priority_lanes(self):
+        limiter = PriorityLimiter(4)
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        priority_limiter=limiter)
+        self.addCleanup(client.close)
+        lanes = []
+
+        def acquire(priority):
+            lanes.append(priority)
+            return acquire.original(priority)
+
+        acquire.original = limiter.acquire
+
+        with mock.patch.object(limiter, 'acquire', side_effect=acquire):
+            client.services.get('dfw1-db1')
+            client.services.list()
+            client.services.create('dfw1-db1', 30)
+
+        self.assertEqual(lanes, [NORMAL, BULK, CRITICAL])
+        self.assertEqual(limiter.active, [0, 0, 0])
+
+    def test_invalid_region(self):
+        self.assertRaises(ValueError, Client, 'user', 'api_key',
+                          region='invalid')
+
     @mock.patch('service_registry.client.BaseClient.request')
     def _marker_assertion(self, path, request):
         client = getattr(self.client, path.strip('/'))
@@ -0,0 +1,137 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import unittest
+
+from StringIO import StringIO
+
+from service_registry.client import Client
+from service_registry.columnar import ServiceColumns, read_columnar
+from service_registry.models import Service
+from service_registry.test.utils import patch_authenticate
+
+SERVICES = [{'id': 'web-1', 'heartbeat_timeout': 30, 'last_seen': None,
+             'tags': ['web', 'www'], 'metadata': {'region': 'dfw'}},
+            {'id': 'web-2', 'heartbeat_timeout': 30,
+             'last_seen': 1346967146370, 'tags': [],
+             'metadata': {'region': 'ord', 'version': u'1.\xe9'}},
+            {'id': 'db-1', 'heartbeat_timeout': 15, 'tags': ['db'],
+             'metadata': {'region': 'dfw', 'version': '5.5'}}]
+
+
+class ServiceColumnsTests(unittest.TestCase):
+    def _get_columns(self):
+        columns = ServiceColumns()
+        columns.append(SERVICES[0])
+        columns.append(Service.from_dict(SERVICES[1]))
+        columns.append(SERVICES[2])
+        return columns
+
+    def test_columns(self):
+        columns = self._get_columns()
+
+        self.assertEqual(columns.rows, 3)
+        self.assertEqual(columns.names, ['id', 'heartbeat_timeout',
+                                         'last_seen', 'tags',
+                                         'metadata.region',
+                                         'metadata.version'])
+        self.assertEqual(columns.column('id'), ['web-1', 'web-2', 'db-1'])
+        self.assertEqual(columns.column('heartbeat_timeout'), [30, 30, 15])
+        self.assertEqual(columns.column('last_seen'),
+                         [None, 1346967146370, None])
+        self.assertEqual(columns.column('tags'), ['web,www', '', 'db'])
+        self.assertEqual(columns.column('metadata.version'),
+                         [None, u'1.\xe9', '5.5'])
+        self.assertEqual(columns.value_counts('metadata.region'),
+                         {'dfw': 2, 'ord': 1})
+        self.assertEqual(columns.value_counts('metadata.version'),
+                         {None: 1, u'1.\xe9': 1, '5.5': 1})
+        self.assertRaises(ValueError, columns.value_counts, 'last_seen')
+
+    def test_binary_round_trip(self):
+        columns = self._get_columns()
+        fp = StringIO()
+        columns.write(fp)
+        fp.seek(0)
+
+        result = read_columnar(fp)
+
+        self.assertEqual(result.rows, 3)
+        self.assertEqual(result.names, columns.names)
+
+        for name in columns.names:
+            self.assertEqual(result.column(name), columns.column(name))
+
+        self.assertEqual(result.value_counts('metadata.region'),
+                         {'dfw': 2, 'ord': 1})
+        self.assertRaises(ValueError, read_columnar, StringIO('garbage!'))
+
+    def test_csv(self):
+        fp = StringIO()
+        self._get_columns().write_csv(csv.writer(fp))
+        fp.seek(0)
+        rows = list(csv.reader(fp))
+
+        self.assertEqual(rows[0][:4], ['id', 'heartbeat_timeout',
+                                       'last_seen', 'tags'])
+        self.assertEqual(rows[1], ['web-1', '30', '', 'web,www', 'dfw', ''])
+        self.assertEqual(rows[2][2], '1346967146370')
+        self.assertEqual(rows[2][5], '1.\xc3\xa9')
+
+
+class ExportColumnarTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        patch_authenticate(self)
+        self.services = self.client.services.list()['values']
+
+    def test_export_columns(self):
+        columns = self.client.services.export_columnar()
+
+        self.assertEqual(columns.column('id'),
+                         [service['id'] for service in self.services])
+
+        fp = StringIO()
+        count = self.client.services.export_columnar(fp)
+        fp.seek(0)
+
+        self.assertEqual(count, len(self.services))
+        self.assertEqual(read_columnar(fp).column('id'), columns.column('id'))
+
+    def test_export_csv(self):
+        fp = StringIO()
+        count = self.client.services.export_columnar(fp, format='csv')
+        fp.seek(0)
+        rows = list(csv.reader(fp))
+
+        self.assertEqual(count, len(self.services))
+        self.assertEqual(len(rows), count + 1)
+
+        fp = StringIO()
+        self.client.services.export_columnar(fp, format='csv',
+                                             metadata_keys=['region'])
+        fp.seek(0)
+        rows = list(csv.reader(fp))
+
+        self.assertEqual(rows[0], ['id', 'heartbeat_timeout', 'last_seen',
+                                   'tags', 'metadata.region'])
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [service['id'] for service in self.services])
+        self.assertRaises(ValueError, self.client.services.export_columnar,
+                          fp, format='xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mock
+import signal
+import threading
+import time
+import unittest
+
+from service_registry import drain
+from service_registry import forksafe
+from service_registry.client import Client
+from service_registry.errors import DeadlineExceededError
+from service_registry.test.utils import patch_authenticate
+
+
+class DrainTests(unittest.TestCase):
+    def setUp(self):
+        patch_authenticate(self)
+        self.addCleanup(drain.drain, remove=False)
+
+        self.client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+
+    def test_create_and_remove_are_tracked(self):
+        _, heartbeater = self.client.services.create('dfw1-db1', 30)
+
+        self.assertEqual(drain.get_active(), [heartbeater])
+
+        self.client.services.remove('dfw1-db1')
+
+        self.assertEqual(drain.get_active(), [])
+
+    def test_drain_stops_heartbeaters_and_removes_services(self):
+        _, heartbeater = self.client.services.create('dfw1-db1', 30)
+        thread = threading.Thread(target=heartbeater.start)
+        thread.start()
+
+        start = time.time()
+        results = drain.drain()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(results, {'dfw1-db1': None})
+        self.assertEqual(drain.get_active(), [])
+
+    def test_drain_gives_up_after_timeout(self):
+        _, heartbeater = self.client.services.create('dfw1-db1', 30)
+
+        def slow_request(*args, **kwargs):
+            time.sleep(1)
+
+        with mock.patch.object(heartbeater, 'request',
+                               side_effect=slow_request):
+            results = drain.drain(timeout=0.1)
+
+        self.assertTrue(isinstance(results['dfw1-db1'],
+                                   DeadlineExceededError))
+
+    def test_signal_handler_calls_previous_handler(self):
+        previous = mock.Mock()
+        handler = drain._get_signal_handler(previous, 1)
+
+        with mock.patch('service_registry.drain.drain') as drain_mock:
+            handler(signal.SIGTERM, None)
+
+        drain_mock.assert_called_once_with(timeout=1)
+        previous.assert_called_once_with(signal.SIGTERM, None)
+
+    def test_signal_during_track_does_not_deadlock(self):
+        _, heartbeater = self.client.services.create('dfw1-db1', 30)
+        previous = mock.Mock()
+        handler = drain._get_signal_handler(previous, 1)
+
+        # The signal is handled on the thread which is inside track().
+        drain._active.lock.acquire()
+        try:
+            with mock.patch.object(heartbeater, 'request'):
+                handler(signal.SIGTERM, None)
+        finally:
+            drain._active.lock.release()
+
+        self.assertEqual(drain.get_active(), [])
+        self.assertTrue(previous.called)
+
+    def test_services_are_not_inherited_over_fork(self):
+        self.client.services.create('dfw1-db1', 30)
+        self.addCleanup(setattr, forksafe, '_pid', os.getpid())
+
+        forksafe._pid = -1
+
+        self.assertEqual(drain.get_active(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mock
+import shutil
+import tempfile
+import unittest
+
+from service_registry.client import Client
+from service_registry.eventlog import EventLog
+from service_registry.models import Event
+from service_registry.test.utils import patch_authenticate
+
+
+def event(index, type='service.join'):
+    return {'id': 'event-%04d' % (index), 'timestamp': 1000 + index * 10,
+            'type': type,
+            'payload': {'id': 'service-%d' % (index % 5), 'tags': [],
+                        'metadata': {}}}
+
+
+EVENTS = [event(index, 'service.join' if index % 2 else 'service.remove')
+          for index in range(200)]
+
+
+class EventLogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'events')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.directory))
+
+    def _get_log(self, **kwargs):
+        log = EventLog(self.directory, segment_size=4096, index_interval=8,
+                       **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def test_append_and_query(self):
+        log = self._get_log()
+        log.append(EVENTS[:100])
+        log.append([Event.from_dict(value) for value in EVENTS[100:]])
+
+        self.assertTrue(len(log.segments) > 1)
+        self.assertEqual(log.marker, 'event-0199')
+
+        events = list(log.query())
+        self.assertEqual(len(events), 200)
+        self.assertTrue(isinstance(events[0], Event))
+        self.assertEqual([e.to_dict() for e in events], EVENTS)
+
+        events = list(log.query(start=1505, end=1600, as_models=False))
+        self.assertEqual(events, EVENTS[51:61])
+
+        events = list(log.query(start=1500, end=1600, types=['service.join'],
+                                service_id='service-1', as_models=False))
+        self.assertEqual(events, [EVENTS[51]])
+
+        self.assertEqual(list(log.query(start=5000)), [])
+
+    def test_query_seeks_using_the_index(self):
+        log = self._get_log()
+        log.append(EVENTS)
+        segment = log.segments[-1]
+
+        with mock.patch('service_registry.eventlog.json.loads',
+                        side_effect=__import__('json').loads) as loads:
+            list(log.query(start=segment.last_timestamp))
+
+        self.assertTrue(loads.call_count <= 9)
+
+    def test_reopen(self):
+        log = self._get_log()
+        log.append(EVENTS[:150])
+        log.close()
+
+        # Simulate a crash in the middle of a write.
+        path = log.segments[-1].path
+        fp = open(path, 'ab')
+        fp.write('{"id": "event-')
+        fp.close()
+
+        log = self._get_log()
+        self.assertEqual(log.marker, 'event-0149')
+        log.append(EVENTS[150:])
+
+        self.assertEqual(list(log.query(as_models=False)), EVENTS)
+        self.assertEqual(list(log.query(start=1500, end=1510,
+                                        as_models=False)), EVENTS[50:52])
+
+    def test_compaction(self):
+        log = self._get_log(max_bytes=10000)
+        log.append(EVENTS)
+        log.append(EVENTS)
+
+        self.assertTrue(log.size <= 10000 + 4096)
+        self.assertEqual(log.marker, 'event-0199')
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     '%020d.log' % (0))))
+
+        log.max_bytes = None
+        log.max_age = 60
+        log.compact()
+        self.assertEqual(len(log.segments), 1)
+
+    def test_query_while_appending_and_compacting(self):
+        log = self._get_log(max_bytes=10000)
+        log.append(EVENTS[:100])
+        first_number = log.segments[0].number
+
+        events = log.query(as_models=False)
+        self.assertEqual(events.next(), EVENTS[0])
+
+        # Deletes the first segments, including the one being read.
+        log.append(EVENTS[100:])
+        self.assertNotEqual(log.segments[0].number, first_number)
+
+        # The rest of the open segment is still read, the deleted ones are
+        # skipped and nothing appended after the query started shows up.
+        events = list(events)
+        self.assertTrue(events)
+        self.assertEqual(events, [e for e in EVENTS[1:100] if e in events])
+
+    def test_poll(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        patch_authenticate(self)
+
+        log = self._get_log(client=client)
+        count = log.poll()
+        page = client.events.list()
+        events = page['values']
+
+        self.assertEqual(count, len(events))
+        self.assertEqual(log.marker, events[0]['id'])
+        self.assertEqual(list(log.query(as_models=False)), events)
+
+        # The marker event is returned again by the feed but not logged
+        # twice.
+        client.events.list = mock.Mock(return_value=page)
+        self.assertEqual(log.poll(), len(events) - 1)
+        client.events.list.assert_called_once_with(marker=events[0]['id'],
+                                                   as_models=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import unittest
+import threading
+
+from service_registry import forksafe
+from service_registry.client import Client
+from service_registry.pool import ClientPool
+from service_registry.ratelimit import ConcurrencyLimiter
+from service_registry.test.utils import patch_authenticate
+
+
+class ForkSafetyTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('username', 'api_key',
+                             base_url='http://127.0.0.1:8881/')
+        self.addCleanup(self.client.close)
+
+        patch_authenticate(self)
+        self.addCleanup(setattr, forksafe, '_pid', os.getpid())
+
+    def _fork(self):
+        # Make the next check() believe it runs in a new process.
+        forksafe._pid = -1
+
+    def test_nothing_is_reset_in_the_same_process(self):
+        session = self.client.session
+        lock = self.client.services._inflight._lock
+
+        self.client.services.get('dfw1-db1')
+
+        self.assertTrue(self.client.session is session)
+        self.assertTrue(self.client.services._inflight._lock is lock)
+
+    def test_check_resets_client_state(self):
+        session = self.client.session
+        executor = self.client.executor
+        auth_lock = self.client.authenticator._lock
+        inflight = self.client.services._inflight
+        self.client.authenticator.auth_headers = {'X-Auth-Token': 'token'}
+        self.addCleanup(executor.shutdown)
+
+        self._fork()
+        forksafe.check()
+
+        self.assertFalse(self.client.session is session)
+        self.assertFalse(self.client.executor is executor)
+        self.assertFalse(self.client.authenticator._lock is auth_lock)
+        self.assertFalse(self.client.services._inflight is inflight)
+        self.assertEqual(self.client.authenticator.auth_headers,
+                         {'X-Auth-Token': 'token'})
+
+        for sub_client in (self.client.services, self.client.events,
+                           self.client.configuration, self.client.account):
+            self.assertTrue(sub_client.session is self.client.session)
+            self.assertTrue(sub_client.executor is self.client.executor)
+
+        self.assertTrue(self.client.endpoints.session is self.client.session)
+        self.assertEqual(self.client.services.get('dfw1-db1')['id'],
+                         'dfw1-db1')
+
+    def test_request_checks_for_fork(self):
+        session = self.client.session
+        self.addCleanup(self.client.executor.shutdown)
+
+        self._fork()
+        self.client.services.get('dfw1-db1')
+
+        self.assertFalse(self.client.session is session)
+        self.assertEqual(forksafe._pid, os.getpid())
+
+    def test_passed_in_resources_are_left_to_their_owner(self):
+        pool = ClientPool('http://127.0.0.1:8881/', max_registrations=2)
+        self.addCleanup(pool.close)
+        client = pool.get('user1', 'key1')
+        session = pool.session
+        executor = pool.executor
+        self.addCleanup(executor.shutdown)
+        pool.registration_limiter.acquire()
+
+        self._fork()
+        pool.get('user2', 'key2')
+
+        self.assertFalse(pool.session is session)
+        self.assertFalse(pool.executor is executor)
+        self.assertTrue(client.session is pool.session)
+        self.assertTrue(client.services.session is pool.session)
+        self.assertTrue(client.executor is pool.executor)
+        self.assertTrue(pool.endpoints.session is pool.session)
+        self.assertEqual(pool.registration_limiter.active, 0)
+
+    def test_dead_objects_are_skipped(self):
+        limiter = ConcurrencyLimiter(1)
+        ref = forksafe._refs[-1]
+        self.assertTrue(ref() is limiter)
+
+        del limiter
+        self.assertTrue(ref() is None)
+        self._fork()
+        forksafe.check()
+
+    def test_other_threads_wait_for_the_reset(self):
+        events = []
+        checker = threading.Thread(
+            target=lambda: (forksafe.check(), events.append('checked')))
+
+        class Resettable(object):
+            def __init__(self, name):
+                self.name = name
+                forksafe.register(self)
+
+            def _after_fork(self):
+                if self.name == 'first':
+                    checker.start()
+                    # check() blocks until every object has been reset.
+                    checker.join(0.1)
+                else:
+                    # Called again from _after_fork(), check() returns.
+                    forksafe.check()
+
+                events.append((self.name, forksafe._pid))
+
+        objects = [Resettable('first'), Resettable('second')]
+        self._fork()
+        forksafe.check()
+        checker.join(5)
+
+        self.assertEqual(events, [('first', -1), ('second', -1), 'checked'])
+        self.assertEqual(forksafe._pid, os.getpid())
+        self.assertEqual(len(objects), 2)
+
+    def test_real_fork_with_lock_held_by_parent_thread(self):
+        # A lock held in the parent at fork time stays held in the child
+        # unless it's replaced.
+        lock = self.client.services._inflight._lock
+        lock.acquire()
+
+        try:
+            pid = os.fork()
+
+            if pid == 0:
+                status = 1
+
+                try:
+                    signal.alarm(5)
+                    result = self.client.services.get('dfw1-db1')
+
+                    if result['id'] == 'dfw1-db1':
+                        status = 0
+                finally:
+                    os._exit(status)
+        finally:
+            lock.release()
+
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
@@ -0,0 +1,149 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+
+from service_registry.client import Client
+from service_registry.errors import ValidationError
+from service_registry.models import Event
+from service_registry.negativecache import NegativeCache
+from service_registry.test.utils import patch_authenticate
+
+
+class NegativeCacheTests(unittest.TestCase):
+    def test_misses_expire(self):
+        cache = NegativeCache(ttl=10)
+        error = ValueError('missing')
+
+        with mock.patch('service_registry.negativecache.time') as time:
+            time.return_value = 100
+            cache.add(('services', 'a'), error)
+            self.assertTrue(cache.get(('services', 'a')) is error)
+            self.assertEqual(cache.get(('services', 'b')), None)
+
+            time.return_value = 110
+            self.assertEqual(cache.get(('services', 'a')), None)
+            self.assertEqual(len(cache), 0)
+
+    def test_oldest_misses_are_dropped(self):
+        cache = NegativeCache(maxsize=3)
+
+        for index in range(5):
+            cache.add(('services', index), ValueError())
+
+        cache.add(('services', 4), ValueError())
+
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(('services', index)) is not None
+                          for index in range(5)],
+                         [False, False, True, True, True])
+        self.assertTrue(len(cache._order) <= 6)
+
+    def test_invalidation_wins_over_lookups_in_flight(self):
+        cache = NegativeCache()
+        version = cache.version
+        cache.discard(('services', 'a'))
+
+        cache.add(('services', 'a'), ValueError(), version)
+        self.assertEqual(cache.get(('services', 'a')), None)
+
+    def test_events_invalidate_misses(self):
+        cache = NegativeCache()
+        cache.add(('services', 'dfw1-db1'), ValueError())
+        cache.add(('configuration', 'configId'), ValueError())
+        cache.add(('services', 'other'), ValueError())
+
+        cache.handle_event(Event(type='service.join',
+                                 payload={'id': 'dfw1-db1'}))
+        cache.handle_event({'type': 'configuration_value.update',
+                            'payload': {'configuration_value_id':
+                                        '/configId'}})
+
+        self.assertEqual(cache.get(('services', 'dfw1-db1')), None)
+        self.assertEqual(cache.get(('configuration', 'configId')), None)
+        self.assertNotEqual(cache.get(('services', 'other')), None)
+
+
+class ClientNegativeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('username', 'api_key',
+                             base_url='http://127.0.0.1:8881/',
+                             negative_cache_ttl=60)
+        self.addCleanup(self.client.close)
+
+        patch_authenticate(self)
+
+    def _count_requests(self, sub_client):
+        patcher = mock.patch.object(sub_client, '_send',
+                                    wraps=sub_client._send)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_service_misses_are_cached(self):
+        send = self._count_requests(self.client.services)
+
+        for _ in range(3):
+            try:
+                self.client.services.get('my-service-1')
+            except ValidationError as e:
+                self.assertEqual(e.code, 404)
+            else:
+                self.fail('Expected a not found error')
+
+        self.assertEqual(send.call_count, 1)
+
+        # Found services are not cached.
+        self.client.services.get('dfw1-db1')
+        self.client.services.get('dfw1-db1')
+        self.assertEqual(send.call_count, 3)
+
+    def test_create_invalidates_service_misses(self):
+        self.client.negative_cache.add(('services', 'dfw1-db1'),
+                                       ValueError())
+        self.assertRaises(ValueError, self.client.services.get, 'dfw1-db1')
+
+        self.client.services.create('dfw1-db1', 30)
+        self.assertEqual(self.client.services.get('dfw1-db1')['id'],
+                         'dfw1-db1')
+
+    def test_set_invalidates_configuration_misses(self):
+        send = self._count_requests(self.client.configuration)
+
+        self.assertRaises(ValidationError, self.client.configuration.get,
+                          'missing')
+        self.assertRaises(ValidationError, self.client.configuration.get,
+                          '/missing')
+        self.assertEqual(send.call_count, 1)
+
+        # The mock server doesn't accept configuration writes.
+        with mock.patch.object(self.client.configuration, 'request'):
+            self.client.configuration.set('/missing', 'value')
+
+        self.assertRaises(ValidationError, self.client.configuration.get,
+                          'missing')
+        self.assertEqual(send.call_count, 2)
+
+    def test_events_poller_invalidates_misses(self):
+        self.client.negative_cache.add(('services', 'dfw1-db1'),
+                                       ValueError())
+
+        with mock.patch('service_registry.poller.EventsPoller.start_thread'):
+            poller = self.client.events_poller
+
+        poller._synced = True
+        poller.poll()
+
+        self.assertEqual(self.client.negative_cache.get(('services',
+                                                         'dfw1-db1')), None)
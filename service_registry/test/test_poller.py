@@ -0,0 +1,148 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import Queue
+import unittest
+
+from service_registry.client import Client
+from service_registry.poller import EventsPoller
+from service_registry.test.utils import event, events_page, set_events
+
+
+class EventsPollerTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        self.addCleanup(self.client.close)
+        self.poller = EventsPoller(self.client, min_interval=1,
+                                   max_interval=8)
+
+    def test_fan_out_with_filters(self):
+        set_events(self.client, [event('1', 'a')],
+                   [event('1', 'a'), event('2', 'a'),
+                    event('3', 'b', 'service.remove'), event('4', 'c')])
+        everything = self.poller.subscribe()
+        joins = self.poller.subscribe(types=['service.join'])
+        service_b = self.poller.subscribe(service_ids=['b'])
+        service_c = self.poller.subscribe(
+            predicate=lambda event: event.payload['id'] == 'c')
+
+        self.assertEqual(self.poller.poll(), 0)
+        self.assertEqual(self.poller.marker, '1')
+        self.assertEqual(self.poller.poll(), 3)
+        self.assertEqual(self.client.events.list.call_args[1]['marker'],
+                         '1')
+        self.assertEqual(self.poller.marker, '4')
+
+        def ids(subscription):
+            subscription.close()
+            return [e.id for e in subscription]
+
+        self.assertEqual(ids(everything), ['2', '3', '4'])
+        self.assertEqual(ids(joins), ['2', '4'])
+        self.assertEqual(ids(service_b), ['3'])
+        self.assertEqual(ids(service_c), ['4'])
+        self.assertEqual(self.poller.subscriptions, [])
+
+    def test_interval_adapts_to_event_rate(self):
+        set_events(self.client, [], [], [], [], [], [event('1', 'a')], [])
+        self.poller.poll()
+
+        intervals = []
+
+        for index in range(6):
+            self.poller.poll()
+            intervals.append(self.poller.interval)
+
+        self.assertEqual(intervals, [2, 4, 8, 8, 1, 2])
+
+    def test_bounded_queue_drops_oldest(self):
+        set_events(self.client, [], [event(str(i), 'a') for i in range(5)])
+        subscription = self.poller.subscribe(maxsize=2, block=False)
+        self.poller.poll()
+        self.poller.poll()
+
+        self.assertEqual(subscription.dropped, 3)
+        self.assertEqual(subscription.get(0).id, '3')
+        self.assertEqual(subscription.get(0).id, '4')
+        self.assertRaises(Queue.Empty, subscription.get, 0)
+
+    def test_subscriptions_do_not_block_the_poller(self):
+        set_events(self.client, [], [event(str(i), 'a') for i in range(3)])
+        subscription = self.poller.subscribe(maxsize=1)
+        self.poller.poll()
+
+        self.assertEqual(self.poller.poll(), 3)
+        self.assertEqual(subscription.dropped, 2)
+
+    def test_head_is_found_from_a_known_marker(self):
+        poller = EventsPoller(self.client, marker='5')
+        set_events(self.client, [event('5', 'a'), event('6', 'a')])
+
+        # The poll lock is only taken until the head has been found.
+        poller._poll_lock = mock.Mock(wraps=poller._poll_lock)
+        poller.sync()
+        poller.sync()
+
+        self.assertEqual(poller.marker, '6')
+        self.assertEqual(poller._poll_lock.acquire.call_count, 1)
+        self.client.events.list.assert_called_once_with(marker='5')
+
+        other = EventsPoller(self.client)
+        set_events(self.client, [event('7', 'a')])
+        other.sync(marker='6')
+
+        self.assertEqual(other.marker, '7')
+        self.client.events.list.assert_called_once_with(marker='6')
+
+    def test_client_events_poller_starts_from_events_marker(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        events_marker='5')
+        self.addCleanup(client.close)
+
+        with mock.patch('service_registry.poller.EventsPoller.start_thread'):
+            self.assertEqual(client.events_poller.marker, '5')
+
+    def test_start_and_stop(self):
+        subscription = self.poller.subscribe()
+
+        def list_events(**kwargs):
+            page = list_events.pages.pop(0) if list_events.pages else []
+
+            if not list_events.pages and not page:
+                self.poller.stop()
+
+            return events_page(page,
+                               as_models=kwargs.get('as_models', False))
+
+        list_events.pages = [[], [event('1', 'a')]]
+        self.client.events.list = mock.Mock(side_effect=list_events)
+        self.poller.min_interval = 0
+        self.poller.interval = 0
+
+        thread = self.poller.start_thread()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(subscription.get(0).id, '1')
+
+    def test_client_events_poller_is_shared(self):
+        with mock.patch('service_registry.poller.EventsPoller.start_thread'):
+            poller = self.client.events_poller
+            self.assertTrue(self.client.events_poller is poller)
+            self.assertEqual(poller.start_thread.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
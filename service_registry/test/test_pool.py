@@ -0,0 +1,262 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import threading
+import unittest
+
+from service_registry import drain
+from service_registry.deadline import deadline
+from service_registry.errors import DeadlineExceededError
+from service_registry.pool import ClientPool
+from service_registry.ratelimit import RateLimiter, ConcurrencyLimiter
+from service_registry.ratelimit import PriorityLimiter
+from service_registry.ratelimit import CRITICAL, NORMAL, BULK
+from service_registry.test.utils import patch_authenticate
+
+
+class ClientPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = ClientPool('http://127.0.0.1:8881/', rate=100)
+        self.addCleanup(self.pool.close)
+
+        patch_authenticate(self)
+
+    def test_clients_share_transport(self):
+        first = self.pool.get('user1', 'key1')
+        second = self.pool.get('user2', 'key2', rate=5)
+
+        self.assertTrue(first.session is second.session)
+        self.assertTrue(first.executor is second.executor)
+        self.assertTrue(first.endpoints is second.endpoints)
+        self.assertTrue(first.services.session is self.pool.session)
+
+        self.assertFalse(first.authenticator is second.authenticator)
+        self.assertTrue(first.services.authenticator is first.authenticator)
+        self.assertEqual(first.rate_limiter.rate, 100)
+        self.assertEqual(second.rate_limiter.rate, 5)
+        self.assertTrue(first.services.rate_limiter is first.rate_limiter)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_get_returns_the_same_client(self):
+        client = self.pool.get('user1', 'key1')
+
+        self.assertTrue(self.pool.get('user1', 'key1') is client)
+        self.assertFalse(self.pool.get('user1', 'key1', region='uk') is
+                         client)
+
+        new_client = self.pool.get('user1', 'other key')
+        self.assertFalse(new_client is client)
+        self.assertTrue(self.pool.get('user1', 'other key') is new_client)
+
+        self.assertTrue(self.pool.remove('user1') is new_client)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_replaced_client_is_closed(self):
+        client = self.pool.get('user1', 'key1')
+
+        with mock.patch.object(client, 'close') as close:
+            self.pool.get('user1', 'key1')
+            self.assertEqual(close.call_count, 0)
+
+            self.pool.get('user1', 'other key')
+            close.assert_called_once_with()
+
+        self.assertEqual(self.pool.get('user1', 'other key').submit(
+            lambda client: 1).result(), 1)
+
+    def test_get_changes_the_rate_budget(self):
+        client = self.pool.get('user1', 'key1', rate=5)
+        rate_limiter = client.rate_limiter
+
+        self.assertTrue(self.pool.get('user1', 'key1', rate=20) is client)
+        self.assertTrue(client.rate_limiter is rate_limiter)
+        self.assertEqual(rate_limiter.rate, 20)
+        self.assertEqual(rate_limiter.burst, 20)
+
+        self.pool.get('user1', 'key1', burst=2)
+        self.assertEqual((rate_limiter.rate, rate_limiter.burst), (20, 2))
+
+        unlimited = ClientPool('http://127.0.0.1:8881/')
+        self.addCleanup(unlimited.close)
+        unlimited.get('user1', 'key1')
+        self.assertRaises(ValueError, unlimited.get, 'user1', 'key1',
+                          rate=5)
+
+    def test_closing_a_client_keeps_the_pool_usable(self):
+        client = self.pool.get('user1', 'key1')
+        client.close()
+
+        other = self.pool.get('user2', 'key2')
+        self.assertEqual(other.submit(lambda client: 1).result(), 1)
+
+    def test_requests_go_through_the_rate_limiter(self):
+        client = self.pool.get('user1', 'key1')
+        client.rate_limiter.acquire = mock.Mock()
+        client.services.list()
+
+        self.assertEqual(client.rate_limiter.acquire.call_count, 1)
+
+    def test_heartbeats_are_not_rate_limited(self):
+        client = self.pool.get('user1', 'key1')
+        data, heartbeater = client.services.create('dfw1-db1', 30)
+        drain.untrack(heartbeater.service_id)
+
+        self.assertTrue(client.services.rate_limiter is not None)
+        self.assertEqual(heartbeater.rate_limiter, None)
+        self.assertTrue(heartbeater.session is self.pool.session)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_burst(self):
+        limiter = RateLimiter(1, burst=3)
+
+        for index in range(3):
+            self.assertEqual(limiter.try_acquire(), 0)
+
+        delay = limiter.try_acquire()
+        self.assertTrue(0 < delay <= 1)
+
+    def test_acquire_waits(self):
+        limiter = RateLimiter(100, burst=1)
+        limiter.acquire()
+        limiter.acquire()
+
+        self.assertRaises(ValueError, RateLimiter, 0)
+
+    def test_set_rate(self):
+        limiter = RateLimiter(1, burst=3)
+        limiter.set_rate(100)
+
+        self.assertEqual((limiter.rate, limiter.burst), (100, 100))
+        self.assertEqual(limiter.try_acquire(), 0)
+
+        limiter.set_rate(0.1, burst=1)
+        self.assertTrue(limiter._tokens <= 1)
+        self.assertRaises(ValueError, limiter.set_rate, 0)
+
+    def test_acquire_honors_deadline(self):
+        limiter = RateLimiter(0.1, burst=1)
+        limiter.acquire()
+
+        with deadline(1):
+            self.assertRaises(DeadlineExceededError, limiter.acquire)
+
+
+class ConcurrencyLimiterTests(unittest.TestCase):
+    def test_limit(self):
+        limiter = ConcurrencyLimiter(2)
+        limiter.acquire()
+
+        with limiter:
+            self.assertEqual(limiter.active, 2)
+
+            with deadline(0.1):
+                self.assertRaises(DeadlineExceededError, limiter.acquire)
+
+        self.assertEqual(limiter.active, 1)
+        self.assertRaises(ValueError, ConcurrencyLimiter, 0)
+
+    def test_release_wakes_up_waiters(self):
+        limiter = ConcurrencyLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        limiter.release()
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_pool_shares_the_registration_limiter(self):
+        pool = ClientPool('http://127.0.0.1:8881/', max_registrations=5)
+        self.addCleanup(pool.close)
+
+        first = pool.get('user1', 'key1').services.registration_limiter
+        second = pool.get('user2', 'key2').services.registration_limiter
+        self.assertTrue(first is second)
+        self.assertEqual(first.limit, 5)
+
+
+class PriorityLimiterTests(unittest.TestCase):
+    def test_reserved_slots_are_for_critical_requests(self):
+        limiter = PriorityLimiter(3, reserved=1, bulk_limit=1)
+        limiter.acquire(BULK)
+
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceededError, limiter.acquire, BULK)
+
+        limiter.acquire(NORMAL)
+
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceededError, limiter.acquire, NORMAL)
+
+        limiter.acquire(CRITICAL)
+        self.assertEqual(limiter.active, [1, 1, 1])
+
+        limiter.release(BULK)
+        limiter.release(NORMAL)
+        limiter.release(CRITICAL)
+        self.assertEqual(limiter.active, [0, 0, 0])
+        self.assertRaises(ValueError, PriorityLimiter, 1, reserved=1)
+
+    def test_free_slots_go_to_the_most_urgent_waiter(self):
+        limiter = PriorityLimiter(2, reserved=1)
+        limiter.acquire(CRITICAL)
+        limiter.acquire(CRITICAL)
+        order = []
+
+        def acquire(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+            limiter.release(priority)
+
+        threads = []
+
+        for priority in (BULK, NORMAL, CRITICAL):
+            thread = threading.Thread(target=acquire, args=(priority,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while sum(limiter.waiting) < 3:
+            threading.Event().wait(0.01)
+
+        limiter.release(CRITICAL)
+        limiter.release(CRITICAL)
+
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, [CRITICAL, NORMAL, BULK])
+
+    def test_pool_shares_the_priority_limiter(self):
+        pool = ClientPool('http://127.0.0.1:8881/', max_requests=5)
+        self.addCleanup(pool.close)
+
+        client = pool.get('user1', 'key1')
+        self.assertTrue(client.services.priority_limiter is
+                        pool.priority_limiter)
+        self.assertTrue(pool.get('user2', 'key2').events.priority_limiter is
+                        pool.priority_limiter)
+
+
+if __name__ == '__main__':
+    unittest.main()
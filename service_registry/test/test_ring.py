@@ -0,0 +1,159 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from service_registry.client import Client
+from service_registry.ring import ServiceRing
+from service_registry.test.utils import patch_authenticate
+from service_registry.watcher import ServiceChange
+
+
+def service(service_id, weight=None):
+    metadata = {}
+
+    if weight is not None:
+        metadata['weight'] = weight
+
+    return {'id': service_id, 'heartbeat_timeout': 30, 'tags': [],
+            'metadata': metadata}
+
+
+KEYS = ['key-%d' % (index) for index in range(2000)]
+
+
+class ServiceRingTests(unittest.TestCase):
+    def _assign(self, ring):
+        return dict([(key, ring.lookup(key)) for key in KEYS])
+
+    def test_empty_ring(self):
+        ring = ServiceRing()
+        self.assertEqual(ring.lookup('foo'), None)
+        self.assertEqual(ring.lookup_service('foo'), None)
+
+    def test_lookup_is_stable(self):
+        ring = ServiceRing()
+        ring.update([service('a'), service('b'), service('c')])
+        other = ServiceRing()
+        other.update([service('c'), service('a'), service('b')])
+
+        self.assertEqual(self._assign(ring), self._assign(other))
+        self.assertEqual(set(self._assign(ring).values()),
+                         set(['a', 'b', 'c']))
+        self.assertEqual(ring.lookup_service(KEYS[0]).id, ring.lookup(KEYS[0]))
+
+    def test_adding_a_service_only_moves_its_keys(self):
+        ring = ServiceRing()
+        ring.update([service('a'), service('b'), service('c')])
+        before = self._assign(ring)
+
+        ring.add(service('d'))
+        after = self._assign(ring)
+
+        for key in KEYS:
+            if after[key] != 'd':
+                self.assertEqual(before[key], after[key])
+
+        ring.remove('d')
+        self.assertEqual(self._assign(ring), before)
+        self.assertEqual(len(ring._hashes), 300)
+
+    def test_weights(self):
+        ring = ServiceRing(weight_key='weight')
+        ring.update([service('a', weight='3'), service('b'),
+                     service('c', weight='bogus'), service('d', weight=0)])
+
+        self.assertEqual(len(ring._points['a']), 300)
+        self.assertEqual(len(ring._points['b']), 100)
+        self.assertEqual(len(ring._points['c']), 100)
+        self.assertEqual(len(ring._points['d']), 0)
+
+        counts = {}
+
+        for service_id in self._assign(ring).values():
+            counts[service_id] = counts.get(service_id, 0) + 1
+
+        self.assertTrue(counts['a'] > counts['b'])
+        self.assertFalse('d' in counts)
+
+        ring.add(service('a', weight=1))
+        self.assertEqual(len(ring._points['a']), 100)
+        self.assertEqual(len(ring._hashes), 300)
+
+    def test_bulk_and_incremental_builds_match(self):
+        services = [service(service_id) for service_id in 'abcdef']
+        ring = ServiceRing(replicas=50)
+        ring.update(services)
+        other = ServiceRing(replicas=50)
+
+        for value in reversed(services):
+            other.add(value)
+
+        self.assertEqual(ring._hashes, other._hashes)
+        self.assertEqual(ring._ids, other._ids)
+
+        ring.update(services[2:] + [service('g')])
+
+        other.remove('a')
+        other.remove('b')
+        other.add(service('g'))
+        self.assertEqual(ring._hashes, other._hashes)
+        self.assertEqual(ring._ids, other._ids)
+
+    def test_large_cold_build(self):
+        ring = ServiceRing(replicas=20)
+        ring.update([service('service-%d' % (index))
+                     for index in range(5000)])
+
+        self.assertEqual(len(ring), 5000)
+        self.assertEqual(len(ring._hashes), 100000)
+        self.assertEqual(ring._hashes, sorted(ring._hashes))
+
+        ring.update([service('service-%d' % (index))
+                     for index in range(1000, 6000)])
+
+        self.assertFalse('service-0' in ring)
+        self.assertTrue('service-5999' in ring)
+        self.assertEqual(len(ring._hashes), 100000)
+        self.assertEqual(ring._hashes, sorted(ring._hashes))
+
+    def test_update_removes_missing_services(self):
+        ring = ServiceRing()
+        ring.update([service('a'), service('b')])
+        ring.update([service('b')])
+
+        self.assertFalse('a' in ring)
+        self.assertEqual(len(ring), 1)
+        self.assertEqual(set(self._assign(ring).values()), set(['b']))
+
+    def test_handle_change(self):
+        ring = ServiceRing()
+        ring.handle_change(ServiceChange('added', 'a',
+                                         new=ring._to_model(service('a'))))
+        self.assertTrue('a' in ring)
+
+        ring.handle_change(ServiceChange('removed', 'a'))
+        self.assertFalse('a' in ring)
+
+    def test_from_client(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        patch_authenticate(self)
+
+        ring = ServiceRing.from_client(client, 'db')
+        self.assertTrue(len(ring) > 0)
+        self.assertTrue(ring.lookup('foo') in ring)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import mock
+import requests
+
+from service_registry.client import Client
+from service_registry.errors import ValidationError
+from service_registry.models import Service
+from service_registry.snapshot import Snapshot, Catalog
+from service_registry.test.utils import patch_authenticate
+
+SERVICES = [{'id': 'web-%d' % (index), 'heartbeat_timeout': 30,
+             'tags': ['web'] if index % 2 else ['db'],
+             'metadata': {'index': index}}
+            for index in range(50)]
+CONFIGURATION = [{'id': '/api/key', 'value': 'a'},
+                 {'id': '/api/nested/key', 'value': 'b'},
+                 {'id': '/other', 'value': 'c'},
+                 {'id': u'/caf\xe9', 'value': 'd'}]
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_write_and_read(self):
+        Snapshot.write(self.path, SERVICES, CONFIGURATION, created=1234)
+        snapshot = Snapshot(self.path)
+
+        self.assertEqual(snapshot.created, 1234)
+        self.assertEqual(snapshot.service_count, 50)
+        self.assertEqual(snapshot.configuration_count, 4)
+
+        for service in SERVICES:
+            self.assertEqual(snapshot.get_service(service['id']), service)
+
+        self.assertEqual(snapshot.get_service('web-'), None)
+        self.assertEqual(snapshot.get_service('zzz'), None)
+        self.assertEqual(snapshot.get_configuration(u'/caf\xe9')['value'],
+                         'd')
+        self.assertEqual(len(list(snapshot.iter_services())), 50)
+        self.assertEqual([value['id'] for value in
+                          snapshot.iter_configuration('/api/')],
+                         ['/api/key', '/api/nested/key'])
+        snapshot.close()
+
+    def test_empty_snapshot(self):
+        Snapshot.write(self.path, [], [])
+        snapshot = Snapshot(self.path)
+
+        self.assertEqual(snapshot.get_service('foo'), None)
+        self.assertEqual(list(snapshot.iter_configuration()), [])
+
+    def test_invalid_file(self):
+        fp = open(self.path, 'wb')
+        fp.write('{"values": []}' * 4)
+        fp.close()
+
+        self.assertRaises(ValueError, Snapshot, self.path)
+        self.assertRaises(IOError, Snapshot, self.path + '-missing')
+
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        patch_authenticate(self)
+
+    def test_lookups_are_served_from_the_existing_snapshot(self):
+        Snapshot.write(self.path, SERVICES, CONFIGURATION)
+
+        # Nothing listens on this port, so the refresh fails and the old
+        # snapshot is kept.
+        client = Client('user', 'api_key', 'http://127.0.0.1:1/',
+                        snapshot_path=self.path, timeout=1)
+        client.close()
+
+        catalog = client.catalog
+        self.assertTrue(catalog.last_error is not None)
+        self.assertEqual(catalog.get_service('web-1')['tags'], ['web'])
+        self.assertTrue(isinstance(catalog.get_service('web-1',
+                                                       as_models=True),
+                                   Service))
+        self.assertEqual(len(catalog.list_services(tag='web')), 25)
+        self.assertEqual(len(catalog.list_configuration('api')), 2)
+        self.assertEqual(catalog.get_configuration('/missing'), None)
+
+    def test_refresh(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:8881/',
+                        snapshot_path=self.path)
+        client.close()
+
+        catalog = client.catalog
+        self.assertEqual(catalog.last_error, None)
+        self.assertTrue(catalog.created is not None)
+
+        services = client.services.list()['values']
+        self.assertEqual(len(catalog.list_services()), len(services))
+        self.assertEqual(catalog.get_service(services[0]['id']),
+                         services[0])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_lookups_fall_back_to_the_snapshot(self):
+        Snapshot.write(self.path, SERVICES, CONFIGURATION)
+
+        client = Client('user', 'api_key', 'http://127.0.0.1:1/',
+                        snapshot_path=self.path, timeout=1)
+        client.close()
+
+        self.assertEqual(client.services.get('web-1'), SERVICES[1])
+        self.assertEqual(client.configuration.get('/api/key')['value'], 'a')
+
+        result = client.services.list(limit=10, as_models=True)
+        self.assertEqual(len(result['values']), 10)
+        self.assertTrue(isinstance(result['values'][0], Service))
+        self.assertEqual(result['metadata']['next_marker'], 'web-18')
+
+        result = client.services.list(
+            marker=result['metadata']['next_marker'])
+        self.assertEqual(len(result['values']), 40)
+        self.assertEqual(result['metadata']['next_marker'], None)
+
+        result = client.services.list_for_tag('web')
+        self.assertEqual(len(result['values']), 25)
+
+        result = client.configuration.list_for_namespace('api')
+        self.assertEqual([value['id'] for value in result['values']],
+                         ['/api/key', '/api/nested/key'])
+
+        # Not in the snapshot either, so the original error is raised.
+        self.assertRaises(requests.ConnectionError, client.services.get,
+                          'missing')
+
+    def test_server_errors_fall_back_to_the_snapshot(self):
+        Snapshot.write(self.path, SERVICES, CONFIGURATION)
+
+        client = Client('user', 'api_key', 'http://127.0.0.1:1/',
+                        snapshot_path=self.path, timeout=1)
+        client.close()
+
+        def fail(code):
+            error = ValidationError(type='serviceUnavailable', code=code,
+                                    message='', txnId=None, details='')
+            return mock.patch.object(client.services, 'request',
+                                     side_effect=error)
+
+        with fail(503):
+            self.assertEqual(client.services.get('web-1'), SERVICES[1])
+
+        with fail(404):
+            self.assertRaises(ValidationError, client.services.get, 'web-1')
+
+    def test_refresh_is_not_served_from_the_snapshot(self):
+        Snapshot.write(self.path, SERVICES, CONFIGURATION, created=1)
+
+        client = Client('user', 'api_key', 'http://127.0.0.1:1/',
+                        snapshot_path=self.path, timeout=1)
+        client.close()
+
+        self.assertRaises(requests.ConnectionError, client.catalog.refresh)
+        self.assertEqual(client.catalog.created, 1)
+
+    def test_refreshes_periodically(self):
+        catalog = Catalog(None, self.path, interval=0.01)
+        error = IOError()
+        refresh = mock.Mock(side_effect=[error, None, None])
+
+        with mock.patch.object(catalog, 'refresh', refresh):
+            catalog.start_thread()
+
+            for _ in range(500):
+                if refresh.call_count >= 2:
+                    break
+
+                time.sleep(0.01)
+
+            catalog.stop()
+            catalog._thread.join(1)
+
+        self.assertTrue(refresh.call_count >= 2)
+        self.assertFalse(catalog._thread.is_alive())
+
+    def test_no_snapshot(self):
+        client = Client('user', 'api_key', 'http://127.0.0.1:1/',
+                        snapshot_path=self.path, timeout=1)
+        client.close()
+
+        self.assertEqual(client.catalog.created, None)
+        self.assertEqual(client.catalog.get_service('web-1'), None)
+        self.assertEqual(client.catalog.list_services(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import unittest
+
+from service_registry.models import Service
+from service_registry.streaming import ListingParser, StreamingListing
+
+DOCUMENT = {'values': [{'id': 'dfw1-api', 'heartbeat_timeout': 30,
+                        'last_seen': 1362900438, 'tags': [],
+                        'metadata': {}},
+                       {'id': 'dfw1-db1', 'heartbeat_timeout': 3.5,
+                        'last_seen': None, 'tags': ['db', u'\xe9'],
+                        'metadata': {'port': '3306', 'up': True}}],
+            'metadata': {'count': 2, 'limit': 100, 'marker': None,
+                         'next_href': None}}
+
+
+class ListingParserTests(unittest.TestCase):
+    def _parse(self, text, chunk_size):
+        parser = ListingParser()
+        values = []
+
+        for index in range(0, len(text), chunk_size):
+            values.extend(parser.feed(text[index:index + chunk_size]))
+
+        values.extend(parser.close())
+        return parser, values
+
+    def test_parse_in_chunks_of_every_size(self):
+        text = json.dumps(DOCUMENT, indent=2)
+
+        for chunk_size in range(1, 40):
+            parser, values = self._parse(text, chunk_size)
+
+            self.assertEqual(values, DOCUMENT['values'])
+            self.assertEqual(parser.fields['metadata'],
+                             DOCUMENT['metadata'])
+
+    def test_values_are_returned_as_soon_as_they_are_complete(self):
+        parser = ListingParser()
+
+        self.assertEqual(parser.feed('{"values": [{"id": "a"}, {"id"'),
+                         [{'id': 'a'}])
+        self.assertEqual(parser.feed(': "b"}], "metadata": {}}'),
+                         [{'id': 'b'}])
+        self.assertEqual(parser.close(), [])
+
+    def test_numbers_split_across_chunks(self):
+        parser, values = self._parse('{"values": [1234, 5], "count": 678}',
+                                     3)
+
+        self.assertEqual(values, [1234, 5])
+        self.assertEqual(parser.fields['count'], 678)
+
+    def test_empty_values(self):
+        parser, values = self._parse('{"metadata": {"count": 0}, '
+                                     '"values": []}', 4)
+
+        self.assertEqual(values, [])
+        self.assertEqual(parser.fields['metadata'], {'count': 0})
+
+    def test_strings_with_brackets_and_escapes(self):
+        document = {'values': [{'id': u'a"]}\\', 'tags': ['[{', '\\"']}],
+                    'metadata': {'next_marker': u'}\u2028'}}
+        text = json.dumps(document)
+
+        for chunk_size in range(1, 10):
+            parser, values = self._parse(text, chunk_size)
+
+            self.assertEqual(values, document['values'])
+            self.assertEqual(parser.fields, {'metadata':
+                                             document['metadata']})
+
+    def test_invalid_documents(self):
+        for text in ['[1, 2]', '{"values": [1,]}', '{"values": [1}',
+                     '{"values": [1]} x', '{"values": [1]',
+                     '{"values": [{"a": 1]}]}', '{"values": [tru]}',
+                     '{"values": [{"a" 1}]}', '{"values": [{"a": 1}']:
+            self.assertRaises(ValueError, self._parse, text, 2)
+
+    def test_invalid_values_fail_without_waiting_for_the_end(self):
+        parser = ListingParser()
+
+        self.assertEqual(parser.feed('{"values": [{"id": "a"}, '),
+                         [{'id': 'a'}])
+        self.assertRaises(ValueError, parser.feed, '{"id" "b"}, {"id"')
+
+        parser = ListingParser()
+        self.assertRaises(ValueError, parser.feed, '{"values": [x')
+
+    def test_values_are_decoded_once(self):
+        element = {'id': 'a', 'metadata': dict([('key%d' % (index), index)
+                                                for index in range(200)])}
+        text = json.dumps({'values': [element]})
+        parser = ListingParser()
+
+        with mock.patch.object(parser._decoder, 'raw_decode',
+                               wraps=parser._decoder.raw_decode) as decode:
+            values = []
+
+            for index in range(0, len(text), 3):
+                values.extend(parser.feed(text[index:index + 3]))
+
+            values.extend(parser.close())
+
+        # Once for the "values" key and once for the element.
+        self.assertEqual(values, [element])
+        self.assertEqual(decode.call_count, 2)
+
+
+class StreamingListingTests(unittest.TestCase):
+    def test_iterate_models_and_close(self):
+        text = json.dumps(DOCUMENT).encode('utf-8')
+        chunks = [text[index:index + 7] for index in range(0, len(text), 7)]
+        closed = []
+        listing = StreamingListing(iter(chunks), model_class=Service,
+                                   close=lambda: closed.append(True))
+        services = list(listing)
+
+        self.assertEqual([service.id for service in services],
+                         ['dfw1-api', 'dfw1-db1'])
+        self.assertEqual(services[1].tags, ('db', u'\xe9'))
+        self.assertEqual(listing.metadata['count'], 2)
+        self.assertEqual(closed, [True])
+
+if __name__ == '__main__':
+    unittest.main()
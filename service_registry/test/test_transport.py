@@ -0,0 +1,181 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+import signal
+import tempfile
+import unittest
+import requests
+
+from time import time
+
+from service_registry import forksafe
+from service_registry.client import Client
+from service_registry.errors import ReplayError
+from service_registry.test.utils import patch_authenticate
+from service_registry.transport import RecordingTransport, ReplayTransport
+from service_registry.transport import ReplayAuthenticator
+
+REPLAY_URL = 'http://replay.invalid/v1.0/'
+
+
+class TransportTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cassette')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _get_replay_client(self, **kwargs):
+        replay = ReplayTransport(self.path, **kwargs)
+        client = Client('username', 'api_key', base_url=REPLAY_URL,
+                        session=replay, authenticator=ReplayAuthenticator())
+        self.addCleanup(client.close)
+        return client
+
+    def _write_cassette(self, interactions):
+        fp = open(self.path, 'wb')
+
+        for interaction in interactions:
+            fp.write(json.dumps(interaction) + '\n')
+
+        fp.close()
+
+    def _get_interaction(self, path, body, elapsed=0, **kwargs):
+        interaction = {'method': 'GET', 'path': path, 'params': None,
+                       'data': None, 'status': 200,
+                       'headers': {'content-type': 'application/json'},
+                       'body': json.dumps(body), 'started': 0,
+                       'elapsed': elapsed}
+        interaction.update(kwargs)
+        return interaction
+
+    def test_record_and_replay(self):
+        recorder = RecordingTransport(self.path)
+        client = Client('username', 'api_key',
+                        base_url='http://127.0.0.1:8881/', session=recorder)
+
+        patch_authenticate(self)
+        service = client.services.get('dfw1-db1')
+        services = client.services.list()
+        created, _ = client.services.create('dfw1-db1', 30)
+
+        client.close()
+        recorder.close()
+
+        fp = open(self.path, 'rb')
+        interactions = [json.loads(line) for line in fp]
+        fp.close()
+
+        self.assertEqual([(interaction['method'], interaction['path'])
+                          for interaction in interactions],
+                         [('GET', 'services/dfw1-db1'),
+                          ('GET', 'services'),
+                          ('POST', 'services')])
+        self.assertEqual(json.loads(interactions[2]['data'])['id'],
+                         'dfw1-db1')
+        self.assertTrue(interactions[0]['elapsed'] >= 0)
+
+        # Different endpoint and tenant, no network.
+        replay_client = self._get_replay_client()
+        self.assertEqual(replay_client.services.get('dfw1-db1'), service)
+        self.assertEqual(replay_client.services.list(), services)
+        self.assertEqual(replay_client.services.create('dfw1-db1', 30)[0],
+                         created)
+
+        self.assertRaises(ReplayError, replay_client.services.create,
+                          'dfw1-db1', 60)
+        self.assertRaises(ReplayError, replay_client.services.get, 'other')
+
+    def test_forked_children_record_to_their_own_cassette(self):
+        recorder = RecordingTransport(self.path)
+        client = Client('username', 'api_key',
+                        base_url='http://127.0.0.1:8881/', session=recorder)
+        self.addCleanup(client.close)
+        self.addCleanup(recorder.close)
+        self.addCleanup(setattr, forksafe, '_pid', os.getpid())
+        patch_authenticate(self)
+
+        client.services.get('dfw1-db1')
+        pid = os.fork()
+
+        if pid == 0:
+            status = 1
+
+            try:
+                signal.alarm(5)
+                client.services.list()
+                recorder.close()
+                status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+        client.services.get('dfw1-db1')
+        recorder.close()
+
+        def read_paths(path):
+            fp = open(path, 'rb')
+
+            try:
+                return [json.loads(line)['path'] for line in fp]
+            finally:
+                fp.close()
+
+        self.assertEqual(read_paths(self.path),
+                         ['services/dfw1-db1', 'services/dfw1-db1'])
+        self.assertEqual(read_paths('%s.%d' % (self.path, pid)),
+                         ['services'])
+
+    def test_identical_requests_are_answered_in_order(self):
+        self._write_cassette([self._get_interaction('services/a', {'n': 1}),
+                              self._get_interaction('services/a', {'n': 2})])
+        client = self._get_replay_client()
+
+        self.assertEqual([client.services.get('a')['n'] for _ in range(3)],
+                         [1, 2, 2])
+
+        client.session.rewind()
+        self.assertEqual(client.services.get('a')['n'], 1)
+
+    def test_replay_latency(self):
+        self._write_cassette([self._get_interaction('services/a', {'n': 1},
+                                                    elapsed=0.2)])
+
+        client = self._get_replay_client()
+        start = time()
+        client.services.get('a')
+        self.assertTrue(time() - start < 0.1)
+
+        client = self._get_replay_client(latency=True, speed=2)
+        start = time()
+        client.services.get('a')
+        self.assertTrue(time() - start >= 0.1)
+
+        replay = ReplayTransport(self.path, latency=True)
+        self.assertRaises(requests.Timeout, replay.request, method='get',
+                          url=REPLAY_URL + 'replay/services/a',
+                          headers={'X-Tenant-Id': 'replay'}, timeout=0.05)
+
+    def test_replay_recorded_errors(self):
+        self._write_cassette([
+            self._get_interaction('services/a', None, error='connection'),
+            self._get_interaction('services/b', None, error='timeout')])
+        client = self._get_replay_client()
+
+        self.assertRaises(requests.ConnectionError, client.services.get, 'a')
+        self.assertRaises(requests.Timeout, client.services.get, 'b')
@@ -0,0 +1,141 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from service_registry.client import Client
+from service_registry.poller import EventsPoller
+from service_registry.test.utils import event, join, set_events
+from service_registry.test.utils import patch_authenticate
+from service_registry.watcher import ServicesWatcher
+
+
+class ServicesWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('user', 'api_key', 'http://127.0.0.1:8881/')
+        patch_authenticate(self)
+
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.poller = EventsPoller(self.client)
+        self.watcher = ServicesWatcher(self.client, poller=self.poller,
+                                       on_added=self.added.append,
+                                       on_removed=self.removed.append,
+                                       on_changed=self.changed.append)
+
+    def _poll(self, watcher=None):
+        self.poller.poll()
+        return (watcher or self.watcher).poll()
+
+    def test_sync_takes_snapshot_and_events_head(self):
+        set_events(self.client, ([join('e1', 'dfw1-api')], 'e2'),
+                   [join('e2', 'dfw1-db1')])
+        self.watcher.sync()
+
+        self.assertEqual(sorted(self.watcher.services.keys()),
+                         ['dfw1-api', 'dfw1-db1'])
+        self.assertEqual(self.watcher.marker, 'e2')
+        self.assertEqual(self.added, [])
+
+    def test_poll_applies_join_and_remove(self):
+        set_events(self.client, [join('e1', 'dfw1-api')],
+                   [join('e1', 'dfw1-api'), join('e2', 'dfw1-web1', ['web']),
+                    event('e3', 'dfw1-api', 'service.timeout')])
+        self.watcher.sync()
+        changes = self._poll()
+
+        self.assertEqual([change.type for change in changes],
+                         ['added', 'removed'])
+        self.assertEqual(self.added[0].service_id, 'dfw1-web1')
+        self.assertEqual(self.added[0].new.tags, ('web',))
+        self.assertEqual(self.removed[0].service_id, 'dfw1-api')
+        self.assertEqual(self.removed[0].reason, 'service.timeout')
+        self.assertEqual(sorted(self.watcher.services.keys()),
+                         ['dfw1-db1', 'dfw1-web1'])
+        self.assertEqual(self.watcher.marker, 'e3')
+        self.assertEqual(self.client.events.list.call_args[1]['marker'],
+                         'e1')
+
+    def test_poll_reports_metadata_changes(self):
+        metadata = {'region': 'dfw', 'port': '3307',
+                    'ip': '127.0.0.1', 'version': '5.6'}
+        set_events(self.client, [],
+                   [join('e1', 'dfw1-db1', ['db', 'mysql'], metadata)])
+        self.watcher.sync()
+        self._poll()
+
+        self.assertEqual(len(self.changed), 1)
+        change = self.changed[0]
+        self.assertEqual(change.metadata_diff,
+                         {'port': ('3306', '3307'),
+                          'version': ('5.5.24-0ubuntu0.12.04.1 (Ubuntu)',
+                                      '5.6')})
+        self.assertEqual(change.new.heartbeat_timeout, 30)
+
+    def test_rejoin_without_changes_is_ignored(self):
+        set_events(self.client, [],
+                   [join('e1', 'dfw1-api'),
+                    event('e2', 'missing', 'service.remove')])
+        self.watcher.sync()
+
+        self.assertEqual(self._poll(), [])
+
+    def test_tag_filter(self):
+        watcher = ServicesWatcher(self.client, tag='db', poller=self.poller)
+        set_events(self.client, [],
+                   [join('e1', 'dfw1-api'), join('e2', 'dfw1-db1', ['mysql'])])
+        watcher.sync()
+
+        self.assertEqual(watcher.services.keys(), ['dfw1-db1'])
+
+        changes = self._poll(watcher)
+
+        self.assertEqual([change.type for change in changes], ['removed'])
+        self.assertEqual(watcher.services, {})
+
+    def test_watchers_share_the_poller(self):
+        set_events(self.client, [join('e1', 'dfw1-api')],
+                   [join('e2', 'dfw1-web1')])
+        other = ServicesWatcher(self.client, poller=self.poller)
+        self.watcher.sync()
+        other.sync()
+
+        # The head of the feed is only looked up once.
+        self.assertEqual(self.client.events.list.call_count, 1)
+
+        self.poller.poll()
+
+        self.assertEqual(self.watcher.poll()[0].service_id, 'dfw1-web1')
+        self.assertEqual(other.poll()[0].service_id, 'dfw1-web1')
+
+        other.close()
+        self.assertEqual(len(self.poller.subscriptions), 1)
+
+    def test_dropped_events_trigger_a_new_snapshot(self):
+        set_events(self.client, [], [join('e1', 'dfw1-web1')])
+        self.watcher.sync()
+        del self.watcher.services['dfw1-api']
+        self.watcher._subscription.dropped += 1
+
+        changes = self._poll()
+
+        self.assertEqual([(change.type, change.service_id)
+                          for change in changes],
+                         [('added', 'dfw1-api'), ('added', 'dfw1-web1')])
+        self.assertEqual(sorted(self.watcher.services.keys()),
+                         ['dfw1-api', 'dfw1-db1', 'dfw1-web1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+import threading
+
+from service_registry.client import Client
+from service_registry.errors import APIError
+
+
+class WriteBehindBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.client = Client('username', 'api_key',
+                             base_url='http://127.0.0.1:8881/')
+        self.addCleanup(self.client.close)
+
+        self.writes = []
+        self.written = threading.Event()
+        configuration = self.client.configuration
+
+        def set(configuration_id, value):
+            self.writes.append(('set', configuration_id, value))
+            self.written.set()
+            return True
+
+        def remove(configuration_id):
+            self.writes.append(('remove', configuration_id))
+            self.written.set()
+            return True
+
+        for name, fn in (('set', set), ('remove', remove)):
+            patcher = mock.patch.object(configuration, name)
+            patcher.start().side_effect = fn
+            self.addCleanup(patcher.stop)
+
+    def test_writes_are_coalesced(self):
+        buffer = self.client.configuration.write_behind(window=60)
+
+        for value in range(100):
+            buffer.set('/flags/rollout', value)
+
+        buffer.set('/flags/other', 'a')
+        buffer.remove('/flags/old')
+        buffer.set('/flags/old', 'b')
+        buffer.remove('/flags/old')
+
+        self.assertEqual(buffer.pending, 3)
+        self.assertEqual(buffer.coalesced, 101)
+        self.assertEqual(self.writes, [])
+
+        self.assertEqual(buffer.flush(), {})
+        self.assertEqual(sorted(self.writes),
+                         [('remove', '/flags/old'),
+                          ('set', '/flags/other', 'a'),
+                          ('set', '/flags/rollout', 99)])
+        self.assertEqual(buffer.pending, 0)
+        buffer.close()
+
+    def test_writes_are_flushed_after_the_window(self):
+        buffer = self.client.configuration.write_behind(window=0.05)
+        self.addCleanup(buffer.close)
+
+        buffer.set('/flags/rollout', 10)
+        buffer.set('/flags/rollout', 20)
+
+        self.assertTrue(self.written.wait(5))
+        self.assertEqual(self.writes, [('set', '/flags/rollout', 20)])
+
+    def test_close_flushes_and_rejects_new_writes(self):
+        buffer = self.client.configuration.write_behind(window=60)
+        buffer.set('/flags/rollout', 10)
+
+        buffer.close()
+
+        self.assertEqual(self.writes, [('set', '/flags/rollout', 10)])
+        self.assertFalse(buffer._thread.is_alive())
+        self.assertRaises(ValueError, buffer.set, '/flags/rollout', 20)
+
+    def test_flush_from_workers(self):
+        client = Client('username', 'api_key',
+                        base_url='http://127.0.0.1:8881/', max_workers=1)
+        self.addCleanup(client.close)
+        buffer = client.configuration.write_behind(window=60)
+        self.addCleanup(buffer.close)
+
+        buffer.set('/flags/rollout', 10)
+        buffer.set('/flags/other', 'a')
+
+        with mock.patch.object(client.configuration, 'set') as set_value:
+            # The only worker waits for the writes of the flush.
+            future = client.submit(lambda client: buffer.flush())
+            errors = future.result(timeout=5)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(set_value.call_count, 2)
+
+    def test_errors_are_reported(self):
+        error = APIError('API returned 401')
+        self.client.configuration.set.side_effect = error
+        errors = []
+
+        buffer = self.client.configuration.write_behind(
+            window=60, on_error=lambda *args: errors.append(args))
+        buffer.set('/flags/rollout', 10)
+
+        self.assertEqual(buffer.close(), {'/flags/rollout': error})
+        self.assertEqual(errors, [('/flags/rollout', error)])
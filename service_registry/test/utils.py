@@ -19,8 +19,11 @@ import time
 import socket
 import errno
 import atexit
+import mock
 from os.path import join as pjoin
 
+from service_registry.models import Event
+
 
 # From https://github.com/Kami/python-yubico-client/blob/master/tests/utils.py
 
@@ -79,3 +82,54 @@ class MockAPIServerRunner(ProcessRunner):
             waitForStartUp(self.process,
                            ('127.0.0.1', self.port), 10)
         atexit.register(self.tearDown)
+
+
+def patch_authenticate(test_case):
+    """
+    Make the clients skip authentication until C{test_case} is over and
+    return the mock.
+    """
+    patcher = mock.patch('service_registry.client.BaseClient._authenticate')
+    _authenticate = patcher.start()
+    _authenticate.return_value = {'X-Auth-Token': 'auth_token',
+                                  'X-Tenant-Id': 'tenant_id'}
+    test_case.addCleanup(patcher.stop)
+    return _authenticate
+
+
+def event(event_id, service_id, type='service.join', tags=None,
+          metadata=None):
+    return {'id': event_id, 'timestamp': 1346967146370, 'type': type,
+            'payload': {'id': service_id, 'tags': tags or [],
+                        'metadata': metadata or {}}}
+
+
+def join(event_id, service_id, tags=None, metadata=None):
+    return event(event_id, service_id, tags=tags, metadata=metadata)
+
+
+def events_page(events, next_marker=None, as_models=True):
+    if as_models:
+        events = [Event.from_dict(value) for value in events]
+
+    return {'values': events,
+            'metadata': {'count': len(events), 'limit': 100,
+                         'marker': None, 'next_marker': next_marker}}
+
+
+def set_events(client, *pages):
+    """
+    Make every call to client.events.list() return the next page. A page
+    is a list of events or an (events, next_marker) tuple.
+    """
+    pages = list(pages)
+
+    def list_events(marker=None, limit=None, as_models=False, stream=False):
+        page = pages.pop(0)
+
+        if isinstance(page, tuple):
+            return events_page(page[0], page[1], as_models=as_models)
+
+        return events_page(page, as_models=as_models)
+
+    client.events.list = mock.Mock(side_effect=list_events)
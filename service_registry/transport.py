@@ -0,0 +1,297 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Transports recording the traffic of a client to a cassette file and
+replaying it without a network.
+
+A transport is anything with the request() and close() methods of a
+C{requests.Session} and is passed to a client as its session:
+
+    recorder = RecordingTransport('registry.cassette')
+    client = Client('username', 'api_key', session=recorder)
+    ...
+    recorder.close()
+
+    replay = ReplayTransport('registry.cassette', latency=True)
+    client = Client('username', 'api_key', session=replay,
+                    authenticator=ReplayAuthenticator())
+
+A cassette has one JSON object per line for every request: the method,
+the path below the tenant, the query parameters and body, and either the
+response (status, headers, body) or the connection error, with the time
+the request was sent (relative to the start of the recording) and its
+latency.
+"""
+
+__all__ = [
+    'RecordingTransport',
+    'ReplayTransport',
+    'ReplayAuthenticator'
+]
+
+import os
+import threading
+import requests
+
+from time import sleep, time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import forksafe
+
+from auth import Authenticator
+from errors import ReplayError
+
+CONNECTION_ERROR = 'connection'
+TIMEOUT_ERROR = 'timeout'
+
+
+class _ReplayedResponse(Response):
+    def close(self):
+        pass
+
+
+class RecordingTransport(object):
+    def __init__(self, path, session=None):
+        """
+        Send requests with C{session} and append every request and its
+        response to the cassette at C{path}. A forked child process records
+        to a cassette of its own, C{path} followed by a dot and its pid.
+
+        @param path: Path of the cassette, truncated when opened.
+        @type path: C{str}
+        @param session: HTTP session actually sending the requests.
+        @type session: C{requests.Session}
+        """
+        self.path = path
+        self.session = session or requests.Session()
+        self._owns_session = session is None
+        self.started = time()
+        self._fp = open(path, 'wb')
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, **kwargs):
+        interaction = {'method': method.upper(),
+                       'path': _get_path(url, headers),
+                       'params': params or None, 'data': data}
+        start = time()
+
+        try:
+            r = self.session.request(method=method, url=url, params=params,
+                                     data=data, headers=headers,
+                                     timeout=timeout, **kwargs)
+        except requests.Timeout:
+            interaction['error'] = TIMEOUT_ERROR
+            self._write(interaction, start)
+            raise
+        except requests.ConnectionError:
+            interaction['error'] = CONNECTION_ERROR
+            self._write(interaction, start)
+            raise
+
+        # Reading the whole body also records streamed responses, they are
+        # then iterated from memory.
+        interaction['status'] = r.status_code
+        interaction['headers'] = dict(r.headers)
+        interaction['body'] = r.content
+        self._write(interaction, start)
+        return r
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if not self._fp.closed:
+                self._fp.close()
+        finally:
+            self._lock.release()
+
+        self.session.close()
+
+    def _after_fork(self):
+        # Record to a cassette of our own, writes from both processes to
+        # the parent's would interleave.
+        self._lock = threading.Lock()
+        self._fp = open('%s.%d' % (self.path, os.getpid()), 'wb')
+
+        if self._owns_session:
+            self.session = requests.Session()
+
+    def _write(self, interaction, start):
+        interaction['started'] = start - self.started
+        interaction['elapsed'] = time() - start
+        line = json.dumps(interaction, separators=(',', ':')) + '\n'
+
+        self._lock.acquire()
+        try:
+            if not self._fp.closed:
+                self._fp.write(line)
+                self._fp.flush()
+        finally:
+            self._lock.release()
+
+
+class ReplayTransport(object):
+    def __init__(self, path, latency=False, speed=1.0, match_data=True):
+        """
+        Answer requests with the responses recorded in the cassette at
+        C{path}, without any network.
+
+        Requests are matched on method, path, query parameters and body.
+        Identical requests get the recorded responses in the order they
+        were recorded, and the last one again once they run out.
+
+        @param path: Path of the cassette.
+        @type path: C{str}
+        @param latency: Wait for the recorded latency of every request
+        before answering. A request whose timeout is shorter than that
+        raises C{requests.Timeout} once the timeout has passed.
+        @type latency: C{bool}
+        @param speed: Divides the recorded latencies.
+        @type speed: C{float}
+        @param match_data: Also match requests on their body.
+        @type match_data: C{bool}
+        @raise ReplayError: A request doesn't match any recorded one.
+        """
+        self.path = path
+        self.latency = latency
+        self.speed = speed
+        self.match_data = match_data
+        self.interactions = {}
+        self._lock = threading.Lock()
+
+        fp = open(path, 'rb')
+
+        try:
+            for line in fp:
+                if not line.strip():
+                    continue
+
+                interaction = json.loads(line)
+                key = self._get_key(interaction['method'],
+                                    interaction['path'],
+                                    interaction['params'],
+                                    interaction['data'])
+                self.interactions.setdefault(key, []).append(interaction)
+        finally:
+            fp.close()
+
+        self._positions = dict([(key, 0) for key in self.interactions])
+        forksafe.register(self)
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, **kwargs):
+        key = self._get_key(method, _get_path(url, headers), params, data)
+
+        self._lock.acquire()
+        try:
+            interactions = self.interactions.get(key, None)
+
+            if not interactions:
+                raise ReplayError('No recorded response for %s %s' %
+                                  (method.upper(), url))
+
+            position = self._positions[key]
+            interaction = interactions[min(position, len(interactions) - 1)]
+            self._positions[key] = position + 1
+        finally:
+            self._lock.release()
+
+        if self.latency:
+            delay = interaction['elapsed'] / self.speed
+
+            if timeout is not None and delay > timeout:
+                sleep(timeout)
+                raise requests.Timeout('Replayed request timed out')
+
+            sleep(delay)
+
+        error = interaction.get('error', None)
+
+        if error == TIMEOUT_ERROR:
+            raise requests.Timeout('Recorded request timed out')
+        elif error:
+            raise requests.ConnectionError('Recorded connection error')
+
+        r = _ReplayedResponse()
+        r.url = url
+        r.status_code = interaction['status']
+        r.headers = CaseInsensitiveDict(interaction['headers'])
+        r.encoding = 'utf-8'
+        r._content = interaction['body'].encode('utf-8')
+        r._content_consumed = True
+        return r
+
+    def rewind(self):
+        """
+        Serve every recorded response again from the start.
+        """
+        self._lock.acquire()
+        try:
+            self._positions = dict([(key, 0) for key in self.interactions])
+        finally:
+            self._lock.release()
+
+    def close(self):
+        pass
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _get_key(self, method, path, params, data):
+        params = tuple(sorted((params or {}).items()))
+
+        if not self.match_data:
+            data = None
+
+        return (method.upper(), path, params, data)
+
+
+class ReplayAuthenticator(Authenticator):
+    """
+    Authenticator which never contacts the identity service, for clients
+    using a L{ReplayTransport}. Recorded requests are matched below the
+    tenant, so any tenant id will do.
+    """
+    def __init__(self, tenant_id='replay', region='us'):
+        super(ReplayAuthenticator, self).__init__('replay', 'replay', region)
+        self.tenant_id = tenant_id
+
+    def _authenticate(self):
+        self.auth_token_expires = time() + 365 * 24 * 60 * 60
+        return {'X-Auth-Token': 'replay', 'X-Tenant-Id': self.tenant_id}
+
+
+def _get_path(url, headers):
+    """
+    Return the part of a request URL below the tenant id, or '' for a
+    request which isn't authenticated (an endpoint probe).
+    """
+    tenant_id = (headers or {}).get('X-Tenant-Id', None)
+
+    if tenant_id:
+        separator = '/%s/' % (tenant_id)
+
+        if separator in url:
+            return url.split(separator, 1)[1]
+
+    return ''
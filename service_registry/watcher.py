@@ -0,0 +1,314 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__all__ = [
+    'ServicesWatcher',
+    'ServiceChange'
+]
+
+import Queue
+import threading
+
+SERVICE_JOIN = 'service.join'
+SERVICE_TIMEOUT = 'service.timeout'
+SERVICE_REMOVE = 'service.remove'
+SERVICE_EVENTS = (SERVICE_JOIN, SERVICE_TIMEOUT, SERVICE_REMOVE)
+
+
+class ServiceChange(object):
+    """
+    A single change to the watched services.
+
+    C{type} is one of 'added', 'removed' or 'changed'. For removals
+    C{new} is None, for additions C{old} is None. C{metadata_diff} maps
+    every metadata key which differs to an (old value, new value) tuple,
+    with None standing in for a missing key.
+    """
+    __slots__ = ('type', 'service_id', 'old', 'new', 'reason',
+                 'metadata_diff')
+
+    def __init__(self, type, service_id, old=None, new=None, reason=None,
+                 metadata_diff=None):
+        self.type = type
+        self.service_id = service_id
+        self.old = old
+        self.new = new
+        self.reason = reason
+        self.metadata_diff = metadata_diff or {}
+
+    def __repr__(self):
+        return '<ServiceChange type=%s, service_id=%s, reason=%s>' % (
+            self.type, self.service_id, self.reason)
+
+
+class ServicesWatcher(object):
+    def __init__(self, client, tag=None, interval=5, on_added=None,
+                 on_removed=None, on_changed=None, poller=None):
+        """
+        Keeps an up to date view of the services by taking one snapshot and
+        then applying the service.join, service.timeout and service.remove
+        events delivered by an L{EventsPoller}.
+
+        @param client: Client used to list services.
+        @type client: L{Client}
+        @param tag: Only watch the services with this tag.
+        @type tag: C{str}
+        @param interval: Longest time in seconds start() waits for an event
+        before checking whether it has been stopped.
+        @type interval: C{float}
+        @param on_added: Called with the L{ServiceChange} of every service
+        which joins.
+        @type on_added: C{callable}
+        @param on_removed: Called with the L{ServiceChange} of every service
+        which times out or is removed.
+        @type on_removed: C{callable}
+        @param on_changed: Called with the L{ServiceChange} of every service
+        which re-joins with different tags or metadata.
+        @type on_changed: C{callable}
+        @param poller: Poller the events are read from. Defaults to the
+        C{events_poller} shared by everything using C{client}.
+        @type poller: L{EventsPoller}
+        """
+        self.client = client
+        self.tag = tag
+        self.interval = interval
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.on_changed = on_changed
+        self.poller = poller
+        self.services = {}
+        self.marker = None
+        self._subscription = None
+        self._dropped = 0
+        self._synced = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def sync(self):
+        """
+        Take a new snapshot of the services. No callbacks are called.
+        """
+        if self.poller is None:
+            self.poller = self.client.events_poller
+
+        # Subscribe and find the head of the events feed before listing the
+        # services so nothing which happens during the listing is missed.
+        # Events which are already reflected in the snapshot are applied
+        # again, which is harmless.
+        if self._subscription is None:
+            self._subscription = self.poller.subscribe(types=SERVICE_EVENTS,
+                                                       block=False)
+
+        self.poller.sync()
+        marker = self.poller.marker
+        dropped = self._subscription.dropped
+
+        if self.tag:
+            pages = self.client.services._iterate_pages(
+                self.client.services.list_for_tag, self.tag, as_models=True)
+        else:
+            pages = self.client.services._iterate_pages(
+                self.client.services.list, as_models=True)
+
+        services = {}
+
+        for page in pages:
+            for service in page['values']:
+                services[service.id] = service
+
+        self._lock.acquire()
+        try:
+            self.services = services
+            self.marker = marker
+            self._dropped = dropped
+            self._synced = True
+        finally:
+            self._lock.release()
+
+    def poll(self, timeout=0):
+        """
+        Apply the events delivered by the poller since the last call, call
+        the callbacks and return the list of L{ServiceChange}.
+
+        If the poller had to drop events because they weren't read in time,
+        a new snapshot is taken and compared with the current one instead.
+
+        @param timeout: Seconds to wait for an event if none has been
+        delivered yet.
+        @type timeout: C{float}
+        """
+        if not self._synced:
+            self.sync()
+
+        changes = []
+
+        if self._subscription.dropped != self._dropped:
+            changes.extend(self._resync())
+
+        events = self._get_events(timeout)
+
+        self._lock.acquire()
+        try:
+            for event in events:
+                change = self._apply(event)
+
+                if change:
+                    changes.append(change)
+
+                if event.id:
+                    self.marker = event.id
+        finally:
+            self._lock.release()
+
+        for change in changes:
+            self._notify(change)
+
+        return changes
+
+    def start(self):
+        """
+        Apply the events as they are delivered until stop() is called.
+        """
+        self._stopped.clear()
+
+        if not self._synced:
+            self.sync()
+
+        self.poller.start_thread()
+
+        while not self._stopped.is_set():
+            self.poll(timeout=self.interval)
+
+    def stop(self):
+        """
+        Stop applying events.
+        """
+        self._stopped.set()
+
+    def close(self):
+        """
+        Stop applying events and unsubscribe from the poller.
+        """
+        self.stop()
+
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+            self._synced = False
+
+    def _get_events(self, timeout):
+        events = []
+
+        while True:
+            try:
+                events.append(self._subscription.get(timeout=timeout))
+            except Queue.Empty:
+                return events
+
+            timeout = 0
+
+    def _resync(self):
+        old = self.services
+        self.sync()
+        changes = []
+
+        for service_id in sorted(set(old.keys()) | set(self.services.keys())):
+            previous = old.get(service_id, None)
+            service = self.services.get(service_id, None)
+
+            if not previous:
+                changes.append(ServiceChange('added', service_id,
+                                             new=service))
+            elif not service:
+                changes.append(ServiceChange('removed', service_id,
+                                             old=previous))
+            else:
+                metadata_diff = self._diff_metadata(previous.metadata,
+                                                    service.metadata)
+
+                if metadata_diff or previous.tags != service.tags:
+                    changes.append(ServiceChange(
+                        'changed', service_id, old=previous, new=service,
+                        metadata_diff=metadata_diff))
+
+        return changes
+
+    def _apply(self, event):
+        if event.type not in SERVICE_EVENTS:
+            return None
+
+        service = event.service
+
+        if not service:
+            return None
+
+        old = self.services.get(service.id, None)
+
+        if event.type != SERVICE_JOIN:
+            if not old:
+                return None
+
+            del self.services[service.id]
+            return ServiceChange('removed', service.id, old=old,
+                                 reason=event.type)
+
+        if old:
+            # Join events don't carry these.
+            if service.heartbeat_timeout is None:
+                service.heartbeat_timeout = old.heartbeat_timeout
+
+            if service.last_seen is None:
+                service.last_seen = old.last_seen
+
+        if self.tag and self.tag not in service.tags:
+            if not old:
+                return None
+
+            del self.services[service.id]
+            return ServiceChange('removed', service.id, old=old,
+                                 reason=event.type)
+
+        self.services[service.id] = service
+
+        if not old:
+            return ServiceChange('added', service.id, new=service,
+                                 reason=event.type)
+
+        metadata_diff = self._diff_metadata(old.metadata, service.metadata)
+
+        if not metadata_diff and old.tags == service.tags:
+            return None
+
+        return ServiceChange('changed', service.id, old=old, new=service,
+                             reason=event.type, metadata_diff=metadata_diff)
+
+    def _diff_metadata(self, old, new):
+        diff = {}
+
+        for key in set(old.keys()) | set(new.keys()):
+            old_value = old.get(key, None)
+            new_value = new.get(key, None)
+
+            if old_value != new_value:
+                diff[key] = (old_value, new_value)
+
+        return diff
+
+    def _notify(self, change):
+        callback = {'added': self.on_added,
+                    'removed': self.on_removed,
+                    'changed': self.on_changed}[change.type]
+
+        if callback:
+            callback(change)
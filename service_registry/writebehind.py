@@ -0,0 +1,222 @@
+# Copyright 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write-behind buffering of configuration updates.
+
+    buffer = client.configuration.write_behind(window=0.5)
+
+    for percentage in range(100):
+        buffer.set('/flags/rollout', percentage)   # returns right away
+
+    buffer.close()                                 # one PUT was sent
+"""
+
+__all__ = [
+    'WriteBehindBuffer'
+]
+
+import logging
+import threading
+
+from time import time
+
+import forksafe
+
+from constants import CONFIGURATION_WRITE_WINDOW, DEFAULT_MAX_WORKERS
+
+SET = 'set'
+REMOVE = 'remove'
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    def __init__(self, client, window=CONFIGURATION_WRITE_WINDOW,
+                 max_concurrency=DEFAULT_MAX_WORKERS, on_error=None):
+        """
+        Buffers set() and remove() calls per configuration id and writes
+        only the last one for every id, at most C{window} seconds after the
+        first buffered call, from a background thread.
+
+        Writes for an id are sent in the order they were made: a batch is
+        only written once the previous one is done.
+
+        @param client: Client the values are written with.
+        @type client: L{ConfigurationClient}
+        @param window: Seconds calls are buffered for before being written.
+        @type window: C{float}
+        @param max_concurrency: Maximum number of writes in flight.
+        @type max_concurrency: C{int}
+        @param on_error: Called as C{on_error(configuration_id, exception)}
+        for every write which fails.
+        @type on_error: C{callable}
+        """
+        self.client = client
+        self.window = window
+        self.max_concurrency = max_concurrency
+        self.on_error = on_error
+        self.coalesced = 0
+        self.closed = False
+        self._pending = {}
+        self._first_write = None
+        self._condition = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        forksafe.register(self)
+
+    def set(self, configuration_id, value):
+        self._buffer(configuration_id, (SET, value))
+
+    def remove(self, configuration_id):
+        self._buffer(configuration_id, (REMOVE, None))
+
+    def flush(self):
+        """
+        Write every buffered call now and wait for the writes to finish.
+
+        @return: A dictionary mapping the ids of the failed writes to their
+        exception.
+        @rtype: C{dict}
+        """
+        self._flush_lock.acquire()
+        try:
+            self._condition.acquire()
+            try:
+                pending = self._pending
+                self._pending = {}
+                self._first_write = None
+            finally:
+                self._condition.release()
+
+            return self._write(pending)
+        finally:
+            self._flush_lock.release()
+
+    def close(self):
+        """
+        Write every buffered call and stop the background thread. Calls
+        made after close() raise C{ValueError}.
+
+        @return: The errors of the last writes, see flush().
+        @rtype: C{dict}
+        """
+        self._condition.acquire()
+        try:
+            self.closed = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+        errors = self.flush()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        return errors
+
+    @property
+    def pending(self):
+        """
+        Number of configuration ids with a buffered call.
+        """
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _after_fork(self):
+        # The parent writes what was buffered before the fork.
+        self._pending = {}
+        self._first_write = None
+        self._condition = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _buffer(self, configuration_id, write):
+        forksafe.check()
+
+        self._condition.acquire()
+        try:
+            if self.closed:
+                raise ValueError('The write-behind buffer is closed')
+
+            if configuration_id in self._pending:
+                self.coalesced += 1
+            elif not self._pending:
+                self._first_write = time()
+
+            self._pending[configuration_id] = write
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self.closed:
+                    if not self._pending:
+                        self._condition.wait()
+                        continue
+
+                    remaining = self._first_write + self.window - time()
+
+                    if remaining <= 0:
+                        break
+
+                    self._condition.wait(remaining)
+
+                if self.closed:
+                    # close() writes what is left.
+                    return
+            finally:
+                self._condition.release()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write buffered configuration')
+
+    def _write(self, pending):
+        def call(item):
+            configuration_id, (operation, value) = item
+
+            if operation == SET:
+                return self.client.set(configuration_id, value)
+
+            return self.client.remove(configuration_id)
+
+        errors = {}
+        results = self.client._call_concurrently(call,
+                                                 sorted(pending.items()),
+                                                 self.max_concurrency)
+
+        for item, _, error in results:
+            if error:
+                errors[item[0]] = error
+
+                if self.on_error:
+                    self.on_error(item[0], error)
+
+        return errors
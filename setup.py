@@ -154,6 +154,7 @@ setup(
     install_requires=[
         'python-dateutil >= 2.1, < 2.2.0',
         'requests >= 1.1.0, < 1.2.0',
-        'apache-libcloud >= 0.12.1, < 0.13.0'
+        'apache-libcloud >= 0.12.1, < 0.13.0',
+        'futures >= 2.1.3'
     ]
 )